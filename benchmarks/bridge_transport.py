@@ -0,0 +1,152 @@
+"""Compares the transports between the proxy workers and the bridge.
+
+Usage:
+
+    $ python benchmarks/bridge_transport.py [nr_messages] [message_size]
+
+One producer process sends capture-like [topic, data] messages to one
+consumer process, over ZeroMQ TCP (the default setup), ZeroMQ IPC, and
+the shared-memory ring. Messages the transport doesn't accept right
+away are retried, as CapturePublisher does with its backlog.
+
+The throughput is measured with the producer going flat out. Latencies
+are measured in a separate, paced run, since a saturated transport
+only measures its queue length.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import tempfile
+import multiprocessing
+import zmq
+from shinpachi.shmring import SharedRing
+
+
+TOPIC = b'127.0.0.1:12345-10.0.0.1:443'
+STAMP = struct.Struct('=d')
+
+LATENCY_MESSAGES = 10000
+LATENCY_INTERVAL = 0.0002
+
+
+def make_payload(size):
+    return bytearray(max(size, STAMP.size))
+
+
+def zmq_producer(address, nr, size, interval):
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.XPUB)
+    sock.setsockopt(zmq.XPUB_NODROP, 1)
+    sock.connect(address)
+    # Wait for the subscription from the consumer
+    sock.recv()
+
+    payload = make_payload(size)
+    for _ in range(nr):
+        STAMP.pack_into(payload, 0, time.perf_counter())
+        while True:
+            try:
+                sock.send_multipart([TOPIC, payload], flags=zmq.NOBLOCK)
+                break
+            except zmq.ZMQError as e:
+                if e.errno != errno.EAGAIN:
+                    raise e
+                zmq.select([], [sock], [])
+        if interval:
+            time.sleep(interval)
+    sock.close(linger=-1)
+    ctx.term()
+
+
+def zmq_consumer(address, nr, size, interval, results):
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.XSUB)
+    sock.bind(address)
+    sock.send(b'\x01')
+
+    latencies = []
+    start = None
+    for _ in range(nr):
+        topic, data = sock.recv_multipart()
+        now = time.perf_counter()
+        if start is None:
+            start = now
+        latencies.append(now - STAMP.unpack_from(data)[0])
+    results.put((nr / (time.perf_counter() - start), latencies))
+    sock.close()
+    ctx.term()
+
+
+def shm_producer(ring, nr, size, interval):
+    payload = make_payload(size)
+    for _ in range(nr):
+        STAMP.pack_into(payload, 0, time.perf_counter())
+        while not ring.put(TOPIC, payload):
+            time.sleep(0)
+        if interval:
+            time.sleep(interval)
+
+
+def shm_consumer(ring, nr, size, interval, results):
+    latencies = []
+    start = None
+    received = 0
+    while received < nr:
+        select.select([ring.fileno()], [], [], 0.1)
+        for topic, data, kind in ring.get_all():
+            now = time.perf_counter()
+            if start is None:
+                start = now
+            latencies.append(now - STAMP.unpack_from(data)[0])
+            received += 1
+    results.put((nr / (time.perf_counter() - start), latencies))
+
+
+def run(producer, consumer, args):
+    results = multiprocessing.Queue()
+    c = multiprocessing.Process(target=consumer, args=args + (results,))
+    c.start()
+    p = multiprocessing.Process(target=producer, args=args)
+    p.start()
+    rate, latencies = results.get()
+    p.join()
+    c.join()
+    latencies.sort()
+    return (rate,
+            latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.99)])
+
+
+def main():
+    nr = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+
+    ipc_dir = tempfile.mkdtemp()
+    transports = [
+        ('tcp', zmq_producer, zmq_consumer, ('tcp://127.0.0.1:17999',)),
+        ('ipc', zmq_producer, zmq_consumer,
+         ('ipc://{}/bridge'.format(ipc_dir),)),
+        # The ring has to exist before forking
+        ('shm', shm_producer, shm_consumer, (SharedRing(16 * 1024 * 1024),)),
+    ]
+
+    print('{} messages of {} bytes'.format(nr, size))
+    for name, producer, consumer, args in transports:
+        rate, _p50, _p99 = run(producer, consumer, args + (nr, size, 0))
+        _rate, p50, p99 = run(producer, consumer,
+                              args + (LATENCY_MESSAGES, size,
+                                      LATENCY_INTERVAL))
+        print('{:<4} {:>10.0f} msg/s  p50: {:>8.1f}us  p99: {:>8.1f}us'
+              .format(name, rate, p50 * 1e6, p99 * 1e6))
+
+    for name in os.listdir(ipc_dir):
+        os.unlink(os.path.join(ipc_dir, name))
+    os.rmdir(ipc_dir)
+
+
+if __name__ == '__main__':
+    main()
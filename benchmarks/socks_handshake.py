@@ -0,0 +1,102 @@
+"""Measures SOCKS5 handshakes per second in a single worker.
+
+Usage:
+
+    $ python benchmarks/socks_handshake.py [nr_handshakes]
+
+The handshakes are fed to `SocksServerProtocol` through a fake
+transport, and the upstream connection is never actually made, so the
+numbers reflect the parsing and protocol overhead only.
+"""
+
+import sys
+import time
+import socket
+import asyncio
+from shinpachi.proxy import SocksServerProtocol
+from shinpachi.socks import Socks5Handshake
+
+
+class FakeTransport(asyncio.Transport):
+    def __init__(self):
+        super().__init__()
+        self.written = 0
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return ('127.0.0.1', 12345)
+        return default
+
+    def write(self, data):
+        self.written += len(data)
+
+    def close(self):
+        pass
+
+
+class FakeTask(object):
+    def add_done_callback(self, cb):
+        pass
+
+    def cancel(self):
+        pass
+
+
+class BenchSocksServerProtocol(SocksServerProtocol):
+    def start_connect(self, host, port):
+        return FakeTask()
+
+
+HANDSHAKES = {
+    'ipv4': (b'\x05\x01\x00',
+             b'\x05\x01\x00\x01' + socket.inet_aton('10.0.0.1') + b'\x00\x50'),
+    'ipv6': (b'\x05\x01\x00',
+             b'\x05\x01\x00\x04'
+             + socket.inet_pton(socket.AF_INET6, '2001:db8::1') + b'\x01\xbb'),
+    'domain': (b'\x05\x02\x00\x02',
+               b'\x05\x01\x00\x03\x0bexample.com\x01\xbb'),
+}
+
+
+def split_reads(msgs, mode):
+    if mode == 'pipelined':
+        return [b''.join(msgs)]
+    elif mode == 'per-message':
+        return list(msgs)
+    else:   # byte-by-byte
+        data = b''.join(msgs)
+        return [data[i:i+1] for i in range(len(data))]
+
+
+def bench_parser(reads, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        hs = Socks5Handshake()
+        for r in reads:
+            hs.feed(r)
+    return n / (time.perf_counter() - start)
+
+
+def bench_protocol(reads, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        proto = BenchSocksServerProtocol()
+        proto.connection_made(FakeTransport())
+        for r in reads:
+            proto.data_received(r)
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, msgs in sorted(HANDSHAKES.items()):
+        for mode in ('pipelined', 'per-message', 'byte-by-byte'):
+            reads = split_reads(msgs, mode)
+            print('{:<8} {:<14} parser: {:>10.0f}/s  protocol: {:>10.0f}/s'
+                  .format(name, mode,
+                          bench_parser(reads, n),
+                          bench_protocol(reads, n)))
+
+
+if __name__ == '__main__':
+    main()
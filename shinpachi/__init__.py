@@ -1,11 +1,12 @@
 import logging
 import sys
 from .processes import PROCESS_WORKERS
-from .processes import bridge_worker
+from .processes import spawn_bridge_workers
 from .processes import spawn_workers
 from .processes import monitor_workers
 from .config import init_config
 from .network import create_listen_sockets
+from .shmring import setup_bridge_rings
 from .log import logger
 from . import version
 
@@ -47,13 +48,28 @@ def main():
         logger.warning('No config file specified, using defaults')
     logger.info('log level = %s', config['log']['level'])
 
+    # Shared memory for the bridge transport must exist before forking
+    setup_bridge_rings(config)
+
     proxy_workers = create_workers('proxy', PROCESS_WORKERS, config)
     http_proxy_workers = create_workers('http_proxy', PROCESS_WORKERS, config)
     http_workers = create_workers('http', PROCESS_WORKERS, config)
-    bridge_workers = spawn_workers(bridge_worker, (config,), 1)
+    bridge_workers = spawn_bridge_workers(config)
+    if config['store'].getboolean('enabled'):
+        recorder_workers = spawn_workers(PROCESS_WORKERS['recorder'],
+                                         (config,), 1)
+    else:
+        recorder_workers = []
+    # The search index is fed by the recorder
+    if config['search'].getboolean('enabled'):
+        if config['store'].getboolean('enabled'):
+            recorder_workers.extend(spawn_workers(PROCESS_WORKERS['search'],
+                                                  (config,), 1))
+        else:
+            logger.warning('Search needs [store] enabled, not starting it')
 
     # --------- all done ---------
 
     workers = proxy_workers + http_proxy_workers \
-        + http_workers + bridge_workers
+        + http_workers + bridge_workers + recorder_workers
     monitor_workers(workers)
@@ -0,0 +1,307 @@
+import collections
+import heapq
+import errno
+import time
+import json
+import zmq
+from .capture import build_notice
+from .shmring import KIND_NOTICE
+from .log import logger
+
+
+__all__ = ['CaptureHistory', 'Bridge', 'REPLAY_PREFIX',
+           'replay_topic', 'split_replay_topic']
+
+
+# Consoles ask for a replay by subscribing to
+# `replay:<console id>:<topic prefix>`. Replayed messages are published
+# under `replay:<console id>:<original topic>`, so that only the asking
+# console gets them, and a 'replay_done' notice on the subscribed topic
+# itself ends the replay.
+REPLAY_PREFIX = b'replay:'
+
+STATS_TOPIC = b'bridge:stats'
+
+
+def replay_topic(console_id, topic):
+    return b''.join([REPLAY_PREFIX, console_id, b':', topic])
+
+
+def split_replay_topic(topic):
+    """Returns (console id, original topic), or None for other topics."""
+    if not topic.startswith(REPLAY_PREFIX):
+        return None
+    console_id, sep, orig_topic = \
+        topic[len(REPLAY_PREFIX):].partition(b':')
+    if not sep:
+        return None
+    return (console_id, orig_topic)
+
+
+class CaptureHistory(object):
+    """Keeps the most recent capture messages, up to `max_bytes`.
+
+    Messages are evicted oldest-first across all topics, and each topic
+    has its own index, so a replay only looks at the matching flows.
+    """
+
+    # Rough per-message overhead of the bookkeeping, so that floods of
+    # tiny messages are accounted for too
+    ENTRY_OVERHEAD = 128
+
+    def __init__(self, max_bytes, max_age=None):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.seq = 0
+        # (seq, timestamp, topic, frames, size)
+        self.entries = collections.deque()
+        # topic -> deque of entries
+        self.by_topic = {}
+        self.bytes = 0
+        self.evicted = 0
+
+    def add(self, topic, frames):
+        self.seq += 1
+        size = self.ENTRY_OVERHEAD + sum(len(f) for f in frames)
+        entry = (self.seq, time.monotonic(), topic, frames, size)
+        self.entries.append(entry)
+        topic_entries = self.by_topic.get(topic)
+        if topic_entries is None:
+            topic_entries = self.by_topic[topic] = collections.deque()
+        topic_entries.append(entry)
+        self.bytes += size
+
+        while self.bytes > self.max_bytes and self.entries:
+            self.evict()
+
+    def evict(self):
+        entry = self.entries.popleft()
+        topic_entries = self.by_topic[entry[2]]
+        # The oldest entry overall is also the oldest one of its topic
+        topic_entries.popleft()
+        if not topic_entries:
+            del self.by_topic[entry[2]]
+        self.bytes -= entry[4]
+        self.evicted += 1
+
+    def expire(self):
+        if self.max_age is None:
+            return
+        deadline = time.monotonic() - self.max_age
+        while self.entries and self.entries[0][1] < deadline:
+            self.evict()
+
+    def replay(self, prefix, max_age=None, max_bytes=None):
+        """Returns the frames of the messages whose topics start with
+        `prefix`, oldest first, limited to the last `max_age` seconds
+        and `max_bytes` bytes.
+        """
+        matching = [entries for topic, entries in self.by_topic.items()
+                    if topic.startswith(prefix)]
+        merged = heapq.merge(*[iter(e) for e in matching])
+
+        if max_age is not None:
+            deadline = time.monotonic() - max_age
+            selected = [e for e in merged if e[1] >= deadline]
+        else:
+            selected = list(merged)
+
+        if max_bytes is not None:
+            # Keep the newest messages that fit
+            total = 0
+            first = len(selected)
+            while first > 0 and total + selected[first - 1][4] <= max_bytes:
+                first -= 1
+                total += selected[first][4]
+            selected = selected[first:]
+
+        return [e[3] for e in selected]
+
+    def stats(self):
+        return {
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'messages': len(self.entries),
+            'topics': len(self.by_topic),
+            'evicted': self.evicted,
+        }
+
+
+class Bridge(object):
+    """Moves capture messages from the workers to the consoles.
+
+    Without history, the ZeroMQ transport just uses zmq.proxy(). This
+    class is for everything else: the shared-memory transport, keeping
+    a CaptureHistory to replay from when a console subscribes, and
+    feeding every flow to the recorder.
+    """
+
+    def __init__(self, xpub_sock, capture_sock=None, history=None,
+                 replay_age=None, replay_bytes=None, stats_interval=60.0,
+                 subscribe_all=False):
+        self.xpub_sock = xpub_sock
+        self.capture_sock = capture_sock
+        self.history = history
+        self.replay_age = replay_age
+        self.replay_bytes = replay_bytes
+        self.stats_interval = stats_interval
+        # Everything is needed for the history, or for the recorder
+        # listening on `capture_sock`
+        self.subscribe_all = subscribe_all or history is not None
+        self.subscriptions = set()
+        self.forwarded = 0
+        self.replayed = 0
+
+    def forward(self, frames):
+        self.xpub_sock.send_multipart(frames)
+        if self.capture_sock is not None:
+            self.capture_sock.send_multipart(frames)
+        if self.history is not None:
+            self.history.add(frames[0], frames)
+        self.forwarded += 1
+
+    def upstream_subscriptions(self):
+        """The topics the workers should publish."""
+        if self.subscribe_all:
+            return {b''}
+        return self.subscriptions
+
+    def read_subscriptions(self):
+        """Handles the subscription messages from the consoles.
+
+        Returns the messages to pass on to the workers.
+        """
+        upstream = []
+        while True:
+            try:
+                msg = self.xpub_sock.recv(flags=zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise e
+            if not msg or msg[0] not in (0, 1):
+                continue
+
+            topic = msg[1:]
+            replay = split_replay_topic(topic)
+            if replay is not None:
+                if msg[0] == 1:
+                    self.replay(topic, *replay)
+                continue
+
+            if msg[0] == 1:
+                self.subscriptions.add(topic)
+            else:
+                self.subscriptions.discard(topic)
+            if not self.subscribe_all:
+                upstream.append(msg)
+        return upstream
+
+    def replay(self, sub_topic, console_id, prefix):
+        nr_msgs = 0
+        nr_bytes = 0
+        if self.history is not None:
+            for frames in self.history.replay(prefix, self.replay_age,
+                                              self.replay_bytes):
+                self.xpub_sock.send_multipart(
+                    [replay_topic(console_id, frames[0])] + frames[1:])
+                nr_msgs += 1
+                nr_bytes += sum(len(f) for f in frames[1:])
+        self.xpub_sock.send_multipart(
+            [sub_topic, b'', build_notice('replay_done', messages=nr_msgs,
+                                          bytes=nr_bytes)])
+        self.replayed += nr_msgs
+        logger.debug('Replayed %d messages for %r', nr_msgs, sub_topic)
+
+    def stats(self):
+        stats = {
+            'forwarded': self.forwarded,
+            'replayed': self.replayed,
+            'subscriptions': len(self.subscriptions),
+        }
+        if self.history is not None:
+            stats['history'] = self.history.stats()
+        return stats
+
+    def publish_stats(self):
+        stats = self.stats()
+        logger.info('Bridge stats: %r', stats)
+        self.xpub_sock.send_multipart(
+            [STATS_TOPIC, b'', json.dumps(stats).encode('utf8')])
+
+    def run_zmq(self, xsub_sock, poll_interval=1.0):
+        for topic in self.upstream_subscriptions():
+            xsub_sock.send(b'\x01' + topic)
+
+        poller = zmq.Poller()
+        poller.register(xsub_sock, zmq.POLLIN)
+        poller.register(self.xpub_sock, zmq.POLLIN)
+
+        last_stats = time.monotonic()
+        while True:
+            events = dict(poller.poll(poll_interval * 1000))
+
+            if self.xpub_sock in events:
+                for msg in self.read_subscriptions():
+                    xsub_sock.send(msg)
+
+            if xsub_sock in events:
+                while True:
+                    try:
+                        frames = xsub_sock.recv_multipart(flags=zmq.NOBLOCK)
+                    except zmq.ZMQError as e:
+                        if e.errno == errno.EAGAIN:
+                            break
+                        raise e
+                    self.forward(frames)
+
+            last_stats = self.tick(last_stats)
+
+    def run_ring(self, ring, control_sock, poll_interval=0.1,
+                 resync_interval=5.0):
+        """The loop for the shared-memory transport.
+
+        Subscriptions go back to the workers through `control_sock`,
+        along with a snapshot of the whole set every `resync_interval`
+        seconds, for workers that missed some.
+
+        The ring is also drained every `poll_interval` seconds, in case
+        a wakeup got lost: nothing orders the position stores and loads
+        between processes.
+        """
+        poller = zmq.Poller()
+        poller.register(self.xpub_sock, zmq.POLLIN)
+        poller.register(ring.fileno(), zmq.POLLIN)
+
+        last_sync = 0
+        last_stats = time.monotonic()
+        while True:
+            events = dict(poller.poll(poll_interval * 1000))
+
+            if self.xpub_sock in events:
+                for msg in self.read_subscriptions():
+                    control_sock.send(msg)
+
+            for topic, data, kind in ring.get_all():
+                if kind == KIND_NOTICE:
+                    self.forward([topic, b'', data])
+                else:
+                    self.forward([topic, data])
+
+            now = time.monotonic()
+            if now - last_sync >= resync_interval:
+                last_sync = now
+                control_sock.send(b''.join(
+                    [b'\x02'] + [t + b'\n' for t in
+                                 sorted(self.upstream_subscriptions())]))
+
+            last_stats = self.tick(last_stats)
+
+    def tick(self, last_stats):
+        if self.history is not None:
+            self.history.expire()
+        now = time.monotonic()
+        if self.stats_interval > 0 and now - last_stats >= self.stats_interval:
+            self.publish_stats()
+            return now
+        return last_stats
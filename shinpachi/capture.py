@@ -0,0 +1,701 @@
+import asyncio
+import errno
+import weakref
+import collections
+import tempfile
+import struct
+import json
+import fnmatch
+import zlib
+import zmq
+from .shmring import (RingProducer, MessageTooLarge, get_bridge_ring)
+from .log import logger
+
+
+__all__ = ['CapturePublisher', 'ShardedCapturePublisher',
+           'create_capture_publisher',
+           'get_bridge_address', 'get_bridge_addresses', 'topic_shard',
+           'OVERFLOW_POLICIES', 'build_notice', 'parse_capture_message',
+           'CapturePolicy', 'CapturePolicies', 'CaptureBudget',
+           'DEFAULT_CAPTURE_POLICY', 'create_capture_policies']
+
+
+# Payloads larger than this are handed to ZeroMQ without copying. Below
+# it, the bookkeeping for zero-copy sends costs more than a memcpy.
+COPY_THRESHOLD = 65536
+
+OVERFLOW_DROP_NEWEST = 'drop-newest'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_SPILL = 'spill'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL)
+
+
+def build_notice(notice, **fields):
+    fields['notice'] = notice
+    return json.dumps(fields, sort_keys=True).encode('utf8')
+
+
+def parse_capture_message(frames):
+    """Splits a message received from the bridge.
+
+    Capture data comes in as [topic, data], where an empty `data` marks
+    the end of a stream. Out-of-band notices about a flow (e.g. data
+    being dropped) come in as [topic, b'', json].
+
+    Returns (topic, data, notice), `notice` being None or a dict.
+    """
+    topic, data = frames[0], frames[1]
+    if len(frames) > 2 and not data:
+        try:
+            notice = json.loads(frames[2].decode('utf8'))
+        except ValueError:
+            notice = None
+        if isinstance(notice, dict):
+            return (topic, data, notice)
+    return (topic, data, None)
+
+
+# max_bytes: how many bytes to capture per direction per flow, 0 means
+#            unlimited
+# headers_only: only capture the heads of plain HTTP messages
+CapturePolicy = collections.namedtuple(
+    'CapturePolicy', ['max_bytes', 'headers_only'])
+
+DEFAULT_CAPTURE_POLICY = CapturePolicy(0, False)
+
+
+class CapturePolicies(object):
+    """Maps destination hosts to capture policies.
+
+    `rules` is a list of (pattern, policy) pairs, where `pattern` is a
+    shell-style wildcard. The first matching rule wins, and `default`
+    applies when nothing matches.
+    """
+
+    MAX_CACHED_HOSTS = 4096
+
+    def __init__(self, default=DEFAULT_CAPTURE_POLICY, rules=()):
+        self.default = default
+        self.rules = [(pattern.lower(), policy) for pattern, policy in rules]
+        self.cache = {}
+
+    def for_host(self, host):
+        if host is None:
+            return self.default
+        host = host.lower()
+        policy = self.cache.get(host)
+        if policy is not None:
+            return policy
+
+        policy = self.default
+        for pattern, rule_policy in self.rules:
+            if fnmatch.fnmatchcase(host, pattern):
+                policy = rule_policy
+                break
+
+        if len(self.cache) >= self.MAX_CACHED_HOSTS:
+            self.cache.clear()
+        self.cache[host] = policy
+        return policy
+
+
+class CaptureBudget(object):
+    """Counts the bytes going one way in a flow, and cuts the captured
+    part off at `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.captured = 0
+        self.total = 0
+        self.truncated = False
+
+    @property
+    def exhausted(self):
+        return self.max_bytes > 0 and self.captured >= self.max_bytes
+
+    def take(self, data):
+        """Returns the part of `data` that may be captured."""
+        size = len(data)
+        self.total += size
+        if self.max_bytes <= 0:
+            self.captured += size
+            return data
+
+        left = self.max_bytes - self.captured
+        if size <= left:
+            self.captured += size
+            return data
+
+        self.truncated = True
+        if left <= 0:
+            return b''
+        self.captured += left
+        return data[:left]
+
+    def count(self, size):
+        """Counts `size` bytes nobody wanted captured. They don't use
+        up the budget.
+        """
+        self.total += size
+
+    def skip(self, size):
+        """Counts `size` bytes that will not be captured."""
+        self.total += size
+        if size > 0:
+            self.truncated = True
+
+    def notice_fields(self):
+        return {'captured_bytes': self.captured, 'total_bytes': self.total}
+
+
+class _SpillFile(object):
+    """Length-prefixed capture messages in an unlinked temp file."""
+
+    HEADER = struct.Struct('>III')
+
+    def __init__(self, spill_dir=None):
+        self.file = tempfile.TemporaryFile(dir=spill_dir)
+        self.read_offset = 0
+        self.write_offset = 0
+
+    @property
+    def size(self):
+        return self.write_offset - self.read_offset
+
+    def write(self, topic, data, notice=None):
+        if notice is None:
+            notice = b''
+        self.file.seek(self.write_offset)
+        self.file.write(self.HEADER.pack(len(topic), len(data), len(notice)))
+        self.file.write(topic)
+        self.file.write(data)
+        self.file.write(notice)
+        self.write_offset = self.file.tell()
+
+    def read(self, max_bytes):
+        msgs = []
+        nbytes = 0
+        self.file.seek(self.read_offset)
+        while self.read_offset < self.write_offset and nbytes < max_bytes:
+            topic_len, data_len, notice_len = \
+                self.HEADER.unpack(self.file.read(self.HEADER.size))
+            topic = self.file.read(topic_len)
+            data = self.file.read(data_len)
+            notice = self.file.read(notice_len) if notice_len else None
+            msgs.append((topic, data, notice))
+            nbytes += data_len
+            self.read_offset += \
+                self.HEADER.size + topic_len + data_len + notice_len
+
+        if self.read_offset >= self.write_offset:
+            # Drained, start over so that the file doesn't keep growing
+            self.file.truncate(0)
+            self.read_offset = self.write_offset = 0
+        return msgs
+
+    def close(self):
+        self.file.close()
+
+
+class CapturePublisher(object):
+    """Publishes captured traffic to the bridge.
+
+    The underlying socket is an XPUB socket connected to the bridge's
+    XSUB socket, so the subscriptions made by the consoles are forwarded
+    back to us. Flows that nobody subscribed to can then skip topic
+    generation and serialization altogether.
+
+    Publishing never blocks. When the bridge can't keep up, messages
+    are kept in a local backlog of at most `backlog_bytes`, and once
+    that's full, the `overflow` policy decides what to do: drop the new
+    messages, drop the oldest ones in the backlog, or spill to a
+    temporary file (up to `spill_max_bytes`). End-of-stream markers are
+    never dropped. Consoles are told about lost data with a notice
+    message sent before the next message of the affected flow.
+
+    `sock` may also be any object with the same send methods (see
+    `shmring.RingProducer`), in which case the subscription messages
+    come from a separate `sub_sock`. Objects that can't be polled for
+    writing tell us how often to retry with a `retry_interval`.
+    """
+
+    def __init__(self, sock, loop=None, flush_interval=0,
+                 batch_bytes=262144, merge_bytes=COPY_THRESHOLD,
+                 overflow=OVERFLOW_DROP_NEWEST, backlog_bytes=1048576,
+                 spill_dir=None, spill_max_bytes=268435456, sub_sock=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
+
+        self.sock = sock
+        self.sub_sock = sub_sock if sub_sock is not None else sock
+        self.subscriptions = set()
+        self.sub_prefixes = ()
+        # Bumped every time the subscription set changes, so that
+        # callers can cache the result of `wanted(...)`
+        self.generation = 0
+        # Objects to notify when the subscription set changes
+        self.watchers = weakref.WeakSet()
+
+        # Messages are batched, and flushed once per loop iteration
+        # (flush_interval == 0), or every `flush_interval` seconds, or
+        # when `batch_bytes` are pending, whichever comes first.
+        self.flush_interval = flush_interval
+        self.batch_bytes = batch_bytes
+        self.merge_bytes = merge_bytes
+        # [[topic, [chunk, ...], size, notice], ...], in publishing order
+        self.pending = []
+        self.pending_bytes = 0
+        # topic -> the pending entry new chunks can still be merged into
+        self.open_entries = {}
+        self.flush_handle = None
+
+        self.overflow = overflow
+        self.backlog_limit = backlog_bytes
+        # (topic, data, notice) the socket didn't accept yet
+        self.backlog = collections.deque()
+        self.backlog_bytes = 0
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.spill = None
+        self.waiting_write = False
+        self.retry_interval = getattr(sock, 'retry_interval', None)
+        self.retry_handle = None
+        # topic -> [messages, bytes, total messages, total bytes], the
+        # first two are reset every time a notice is sent
+        self.flow_drops = {}
+
+        self.published = 0
+        self.sent = 0
+        self.dropped_messages = 0
+        self.dropped_bytes = 0
+        self.spilled_bytes = 0
+
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.loop.add_reader(self.sub_sock, self.subscription_ready)
+
+    def subscription_ready(self):
+        changed = False
+        while True:
+            try:
+                msg = self.sub_sock.recv(flags=zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                else:
+                    raise e
+
+            if not msg:
+                continue
+            if msg[0] == 1:
+                logger.debug('Bridge subscribed to %r', msg[1:])
+                self.subscriptions.add(msg[1:])
+                changed = True
+            elif msg[0] == 0:
+                logger.debug('Bridge unsubscribed from %r', msg[1:])
+                self.subscriptions.discard(msg[1:])
+                changed = True
+            elif msg[0] == 2:
+                # A snapshot of the whole subscription set, every topic
+                # followed by a newline
+                subscriptions = set(msg[1:].split(b'\n')[:-1])
+                if subscriptions != self.subscriptions:
+                    logger.debug('Bridge subscriptions: %r', subscriptions)
+                    self.subscriptions = subscriptions
+                    changed = True
+
+        if changed:
+            self.sub_prefixes = tuple(self.subscriptions)
+            self.generation += 1
+            for w in list(self.watchers):
+                w.subscriptions_changed()
+
+    def add_watcher(self, watcher):
+        self.watchers.add(watcher)
+
+    def remove_watcher(self, watcher):
+        self.watchers.discard(watcher)
+
+    def wanted(self, topic):
+        # ZeroMQ does prefix matching on topics, so do we
+        return topic.startswith(self.sub_prefixes)
+
+    def send(self, topic, data):
+        """Queues `data` for publishing under `topic`.
+
+        An empty `data` marks the end of the stream. Adjacent small
+        chunks in the same direction get merged, and large ones are
+        sent without copying, so the caller must not touch `data`
+        afterwards.
+        """
+        self.published += 1
+        size = len(data)
+
+        entry = self.open_entries.get(topic)
+        if entry is not None and 0 < size < COPY_THRESHOLD \
+                and entry[2] + size <= self.merge_bytes:
+            entry[1].append(data)
+            entry[2] += size
+        else:
+            entry = [topic, [data], size, None]
+            self.pending.append(entry)
+            if 0 < size < COPY_THRESHOLD:
+                self.open_entries[topic] = entry
+            else:
+                self.open_entries.pop(topic, None)
+
+        # Chunks going the other way must not be merged across this one
+        src, _sep, dst = topic.partition(b'-')
+        self.open_entries.pop(dst + b'-' + src, None)
+
+        self.pending_bytes += size
+        self.schedule_flush()
+
+    def send_notice(self, topic, notice, **fields):
+        """Queues an out-of-band notice about the flow behind `topic`.
+
+        The notice keeps its place among the flow's data messages.
+        """
+        self.published += 1
+        self.open_entries.pop(topic, None)
+        self.pending.append([topic, [b''], 0, build_notice(notice, **fields)])
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.pending_bytes >= self.batch_bytes:
+            self.flush()
+        elif self.flush_handle is None:
+            if self.flush_interval > 0:
+                self.flush_handle = self.loop.call_later(
+                    self.flush_interval, self.flush)
+            else:
+                self.flush_handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        pending = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        self.open_entries.clear()
+
+        for topic, chunks, size, notice in pending:
+            if len(chunks) == 1:
+                data = chunks[0]
+            else:
+                data = b''.join(chunks)
+            self.send_now(topic, data, notice)
+
+    def send_now(self, topic, data, notice=None):
+        if self.backlog or (self.spill is not None and self.spill.size > 0):
+            # Keep the ordering
+            self.queue(topic, data, notice)
+        elif not self.try_send(topic, data, notice):
+            self.queue(topic, data, notice)
+            self.wait_writable()
+
+    def try_send(self, topic, data, notice=None):
+        drops = self.flow_drops.get(topic)
+        try:
+            if drops is not None and drops[0] > 0:
+                self.sock.send_multipart(
+                    [topic, b'', build_notice('dropped',
+                                              messages=drops[0],
+                                              bytes=drops[1],
+                                              total_messages=drops[2],
+                                              total_bytes=drops[3])],
+                    flags=zmq.NOBLOCK)
+                drops[0] = drops[1] = 0
+
+            if notice is not None:
+                self.sock.send_multipart([topic, b'', notice],
+                                         flags=zmq.NOBLOCK)
+            else:
+                self.sock.send(topic, flags=zmq.NOBLOCK | zmq.SNDMORE)
+                self.sock.send(data, flags=zmq.NOBLOCK,
+                               copy=(len(data) < COPY_THRESHOLD))
+        except zmq.ZMQError as e:
+            if e.errno != errno.EAGAIN:
+                raise e
+            return False
+        except MessageTooLarge:
+            # Larger than the whole shm ring, waiting won't help. The
+            # consoles get a 'dropped' notice with the flow's next
+            # message.
+            self.drop(topic, len(data))
+            return True
+
+        self.sent += 1
+        if drops is not None and not data and notice is None:
+            # The flow is closed
+            del self.flow_drops[topic]
+        return True
+
+    def queue(self, topic, data, notice=None):
+        size = len(data)
+        if self.spill is not None and self.spill.size > 0:
+            self.spill_msg(topic, data, notice)
+            return
+
+        if size > 0 and self.backlog_bytes + size > self.backlog_limit:
+            if not self.backlog_bytes:
+                logger.warning('Capture queue overflow, policy = %r',
+                               self.overflow)
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                self.drop(topic, size)
+                return
+            elif self.overflow == OVERFLOW_SPILL:
+                self.spill_msg(topic, data)
+                return
+
+        self.backlog.append((topic, data, notice))
+        self.backlog_bytes += size
+
+        if self.overflow == OVERFLOW_DROP_OLDEST:
+            kept = []
+            while self.backlog_bytes > self.backlog_limit and self.backlog:
+                msg = self.backlog.popleft()
+                if msg[1]:
+                    self.backlog_bytes -= len(msg[1])
+                    self.drop(msg[0], len(msg[1]))
+                else:
+                    # End-of-stream markers and notices are kept
+                    kept.append(msg)
+            self.backlog.extendleft(reversed(kept))
+
+    def spill_msg(self, topic, data, notice=None):
+        if self.spill is None:
+            self.spill = _SpillFile(self.spill_dir)
+        if data and self.spill.size + len(data) > self.spill_max_bytes:
+            self.drop(topic, len(data))
+            return
+        self.spill.write(topic, data, notice)
+        self.spilled_bytes += len(data)
+
+    def drop(self, topic, size):
+        self.dropped_messages += 1
+        self.dropped_bytes += size
+        drops = self.flow_drops.get(topic)
+        if drops is None:
+            drops = self.flow_drops[topic] = [0, 0, 0, 0]
+        drops[0] += 1
+        drops[1] += size
+        drops[2] += 1
+        drops[3] += size
+
+    def wait_writable(self):
+        if not self.waiting_write:
+            self.waiting_write = True
+            if self.retry_interval is not None:
+                self.retry_handle = self.loop.call_later(
+                    self.retry_interval, self.retry_write)
+            else:
+                self.loop.add_writer(self.sock, self.write_ready)
+
+    def stop_waiting_write(self):
+        if self.waiting_write:
+            self.waiting_write = False
+            if self.retry_interval is None:
+                self.loop.remove_writer(self.sock)
+            elif self.retry_handle is not None:
+                self.retry_handle.cancel()
+                self.retry_handle = None
+
+    def retry_write(self):
+        self.retry_handle = None
+        self.write_ready()
+        if self.waiting_write:
+            self.retry_handle = self.loop.call_later(
+                self.retry_interval, self.retry_write)
+
+    def write_ready(self):
+        while True:
+            if not self.backlog \
+                    and self.spill is not None and self.spill.size > 0:
+                for msg in self.spill.read(self.backlog_limit):
+                    self.backlog.append(msg)
+                    self.backlog_bytes += len(msg[1])
+            if not self.backlog:
+                break
+
+            topic, data, notice = self.backlog[0]
+            if not self.try_send(topic, data, notice):
+                return
+            self.backlog.popleft()
+            self.backlog_bytes -= len(data)
+
+        self.stop_waiting_write()
+
+    def stats(self):
+        return {
+            'published': self.published,
+            'sent': self.sent,
+            'pending_bytes': self.pending_bytes,
+            'backlog_bytes': self.backlog_bytes,
+            'spill_bytes': self.spill.size if self.spill is not None else 0,
+            'spilled_bytes': self.spilled_bytes,
+            'dropped_messages': self.dropped_messages,
+            'dropped_bytes': self.dropped_bytes,
+            'lossy_flows': len(self.flow_drops),
+        }
+
+    def close(self):
+        self.flush()
+        self.write_ready()
+        self.stop_waiting_write()
+        if self.backlog or self.spill is not None and self.spill.size > 0:
+            logger.warning('Discarding %r bytes of unpublished capture data',
+                           self.backlog_bytes + (self.spill.size
+                                                 if self.spill is not None
+                                                 else 0))
+        if self.spill is not None:
+            self.spill.close()
+        self.loop.remove_reader(self.sub_sock)
+        if self.sub_sock is not self.sock:
+            self.sub_sock.close()
+        self.sock.close()
+
+
+def topic_shard(topic, nr_shards):
+    """Maps `topic` to a bridge shard.
+
+    Both directions of a flow go to the same shard, so that consoles
+    see them in order.
+    """
+    src, _sep, dst = topic.partition(b'-')
+    if dst < src:
+        src, dst = dst, src
+    return zlib.crc32(src + b'-' + dst) % nr_shards
+
+
+class ShardedCapturePublisher(object):
+    """Spreads capture messages over the bridge shards by topic.
+
+    Each shard has its own CapturePublisher, with its own view of the
+    subscriptions, since consoles subscribe to every shard.
+    """
+
+    def __init__(self, publishers):
+        self.publishers = publishers
+
+    @property
+    def generation(self):
+        return sum(p.generation for p in self.publishers)
+
+    def shard_for(self, topic):
+        return self.publishers[topic_shard(topic, len(self.publishers))]
+
+    def add_watcher(self, watcher):
+        for p in self.publishers:
+            p.add_watcher(watcher)
+
+    def remove_watcher(self, watcher):
+        for p in self.publishers:
+            p.remove_watcher(watcher)
+
+    def wanted(self, topic):
+        return self.shard_for(topic).wanted(topic)
+
+    def send(self, topic, data):
+        self.shard_for(topic).send(topic, data)
+
+    def send_notice(self, topic, notice, **fields):
+        self.shard_for(topic).send_notice(topic, notice, **fields)
+
+    def flush(self):
+        for p in self.publishers:
+            p.flush()
+
+    def stats(self):
+        stats = {}
+        for p in self.publishers:
+            for k, v in p.stats().items():
+                stats[k] = stats.get(k, 0) + v
+        stats['shards'] = [p.stats() for p in self.publishers]
+        return stats
+
+    def close(self):
+        for p in self.publishers:
+            p.close()
+
+
+def get_bridge_address(config, name, shard):
+    """Returns the address `name` (e.g. 'xsub_address') of a bridge shard.
+
+    A `{shard}` placeholder in the configured address gets replaced with
+    the shard number. Otherwise, shard 0 uses the address as-is, TCP
+    ports are moved `shard_port_stride` ports up for every shard, and
+    other addresses get a `.<shard>` suffix.
+    """
+    address = config['bridge'][name]
+    if '{shard}' in address:
+        return address.replace('{shard}', str(shard))
+    if shard == 0:
+        return address
+    if address.startswith('tcp://'):
+        host, _sep, port = address[len('tcp://'):].rpartition(':')
+        stride = config['bridge'].getint('shard_port_stride')
+        return 'tcp://{}:{}'.format(host, int(port) + shard * stride)
+    return '{}.{}'.format(address, shard)
+
+
+def get_bridge_addresses(config, name):
+    return [get_bridge_address(config, name, shard)
+            for shard in range(config['bridge'].getint('shards'))]
+
+
+def create_capture_publisher(config, loop=None):
+    publishers = [_create_shard_publisher(config, shard, loop)
+                  for shard in range(config['bridge'].getint('shards'))]
+    if len(publishers) == 1:
+        return publishers[0]
+    return ShardedCapturePublisher(publishers)
+
+
+def _create_shard_publisher(config, shard, loop):
+    ctx = zmq.Context.instance()
+    if config['bridge']['transport'] == 'shm':
+        sock = RingProducer(get_bridge_ring(shard))
+        sub_sock = ctx.socket(zmq.SUB)
+        sub_sock.setsockopt(zmq.SUBSCRIBE, b'')
+        sub_sock.connect(get_bridge_address(config, 'control_address', shard))
+    else:
+        sock = ctx.socket(zmq.XPUB)
+        sock.setsockopt(zmq.SNDHWM, config['capture'].getint('sndhwm'))
+        # Report EAGAIN instead of silently dropping messages at the
+        # HWM, so that the overflow policy can kick in
+        sock.setsockopt(zmq.XPUB_NODROP, 1)
+        sock.connect(get_bridge_address(config, 'xsub_address', shard))
+        sub_sock = None
+    return CapturePublisher(
+        sock, loop=loop, sub_sock=sub_sock,
+        flush_interval=config['capture'].getfloat('flush_interval'),
+        batch_bytes=config['capture'].getint('batch_bytes'),
+        merge_bytes=config['capture'].getint('merge_bytes'),
+        overflow=config['capture']['overflow'],
+        backlog_bytes=config['capture'].getint('backlog_bytes'),
+        spill_dir=config['capture']['spill_dir'] or None,
+        spill_max_bytes=config['capture'].getint('spill_max_bytes'))
+
+
+def create_capture_policies(config):
+    cconfig = config['capture']
+    default = CapturePolicy(cconfig.getint('max_bytes_per_direction'),
+                            cconfig.getboolean('http_headers_only'))
+
+    rules = []
+    for section in config.sections():
+        if not section.startswith('capture:'):
+            continue
+        pattern = section[len('capture:'):].strip()
+        sconfig = config[section]
+        rules.append((pattern, CapturePolicy(
+            sconfig.getint('max_bytes_per_direction',
+                           fallback=default.max_bytes),
+            sconfig.getboolean('http_headers_only',
+                               fallback=default.headers_only))))
+    return CapturePolicies(default, rules)
@@ -23,6 +23,9 @@ def init_config(file_name=None):
             'port': '9999',
             'backlog': '128',
             'processes': str(multiprocessing.cpu_count()),
+            'write_buffer_high': '262144',
+            'write_buffer_low': '65536',
+            'splice_relay': 'no',
         },
         'http_proxy': {
             'enabled': 'yes',
@@ -32,6 +35,9 @@ def init_config(file_name=None):
             'processes': str(multiprocessing.cpu_count()),
             'auth_ip': 'no',
             'loop_detection_ip': '127.0.0.1',
+            'write_buffer_high': '262144',
+            'write_buffer_low': '65536',
+            'splice_relay': 'no',
         },
         'http': {
             'enabled': 'yes',
@@ -43,16 +49,87 @@ def init_config(file_name=None):
             'ssl_key': '',
             'ssl_cert': '',
             'need_auth': 'no',
+            'trigger_max_flows': '65536',
+            'hub_stats_interval': '60',
+            'ws_batch_messages': '256',
+            'ws_batch_bytes': '262144',
+            'ws_queue_bytes': '4194304',
+            'ws_overflow': 'drop-oldest',
+            'ws_deflate': 'yes',
+            'ws_deflate_level': '3',
+            'ws_deflate_threshold': '256',
+            'ws_deflate_context_takeover': 'yes',
+            'filter_max_flows': '4096',
+            'filter_max_pending_bytes': '1048576',
+        },
+        'resolver': {
+            'backend': 'system',
+            'nameservers': '',
+            'timeout': '2.0',
+            'positive_ttl': '300',
+            'negative_ttl': '30',
+            'max_entries': '4096',
+            'stats_interval': '60',
         },
         'redis': {
             'host': 'localhost',
             'port': '6379',
             'pool_size': '5',
         },
+        'capture': {
+            'flush_interval': '0',
+            'batch_bytes': '262144',
+            'merge_bytes': '65536',
+            'sndhwm': '1000',
+            'overflow': 'drop-newest',
+            'backlog_bytes': '1048576',
+            'spill_dir': '',
+            'spill_max_bytes': '268435456',
+            'max_bytes_per_direction': '0',
+            'http_headers_only': 'no',
+        },
+        'sampling': {
+            'enabled': 'no',
+            'default_percent': '100',
+            'stats_interval': '60',
+        },
         'bridge': {
             'xsub_address': 'tcp://127.0.0.1:7999',
             'xpub_address': 'tcp://127.0.0.1:7997',
             'pub_address': 'tcp://127.0.0.1:7995',
+            'shards': '1',
+            'shard_port_stride': '10',
+            'transport': 'zmq',
+            'ring_bytes': '16777216',
+            'control_address': 'tcp://127.0.0.1:7993',
+            'history_bytes': '0',
+            'history_max_age': '0',
+            'replay_seconds': '60',
+            'replay_bytes': '4194304',
+            'stats_interval': '60',
+        },
+        'store': {
+            'enabled': 'no',
+            'path': 'capture_store',
+            'segment_bytes': '67108864',
+            'max_bytes': '1073741824',
+            'dedup_min_bytes': '4096',
+            'dedup_buffer_bytes': '268435456',
+            'flush_interval': '1.0',
+            'index_max_flows': '1000000',
+            'query_address': 'tcp://127.0.0.1:7991',
+            'export_max_flows': '10000',
+            'stats_interval': '60',
+        },
+        'search': {
+            'enabled': 'no',
+            'max_bytes': '268435456',
+            'generations': '8',
+            'max_bytes_per_flow': '1048576',
+            'feed_address': 'tcp://127.0.0.1:7989',
+            'feed_hwm': '10000',
+            'query_address': 'tcp://127.0.0.1:7987',
+            'stats_interval': '60',
         },
         'twitter_login': {
             'consumer_key': '',
@@ -0,0 +1,511 @@
+import array
+import base64
+import codecs
+import datetime
+import heapq
+import ipaddress
+import json
+import struct
+import sys
+import zlib
+from urllib import parse as urlparse
+from .version import __version__
+
+
+__all__ = ['HttpStreamParser', 'har_pieces', 'pcapng_pieces',
+           'buffered_pieces', 'flow_records']
+
+
+# Flush the output to the client in pieces of about this size
+EXPORT_BUFFER_BYTES = 65536
+
+# Give up on a flow if a message head grows larger than this
+MAX_HEAD_BYTES = 65536
+
+# Payload bytes per synthesized TCP segment
+PCAP_MSS = 1460
+
+
+def flow_records(store, flow, topic):
+    """Yields (timestamp, data, notice) of one direction of an indexed
+    flow. Records from other flows on the same endpoints are skipped.
+
+    The store stamps the records it put back together with the capture
+    time of their first byte, so they fall within the flow's window
+    like the messages the index saw.
+    """
+    start = flow['start']
+    # Allow for the rounding in `duration`
+    end = start + flow['duration'] + 0.001
+    for ts, data, notice in store.read_flow(topic.encode('utf8')):
+        if ts < start:
+            continue
+        if ts > end:
+            break
+        yield (ts, data, notice)
+
+
+def buffered_pieces(pieces, size=EXPORT_BUFFER_BYTES):
+    """Joins small pieces into chunks of about `size` bytes."""
+    buf = []
+    buf_size = 0
+    for piece in pieces:
+        if isinstance(piece, str):
+            piece = piece.encode('utf8')
+        buf.append(piece)
+        buf_size += len(piece)
+        if buf_size >= size:
+            yield b''.join(buf)
+            buf = []
+            buf_size = 0
+    if buf:
+        yield b''.join(buf)
+
+
+class HttpStreamParser(object):
+    """Splits one direction of a captured flow into HTTP messages.
+
+    Message heads are returned whole, and bodies are yielded in
+    pieces, so that large bodies are never held in memory.
+    """
+
+    def __init__(self, records):
+        self.records = iter(records)
+        self.buf = bytearray()
+        self.ts = None
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        for ts, data, notice in self.records:
+            if notice is not None:
+                continue
+            self.ts = ts
+            if not data:
+                break
+            self.buf.extend(data)
+            return True
+        self.eof = True
+        return False
+
+    def read_head(self):
+        """Returns (timestamp, start line, [(name, value), ...]) of the
+        next message, or None.
+        """
+        if not self.buf and not self.fill():
+            return None
+        ts = self.ts
+        while True:
+            end = self.buf.find(b'\r\n\r\n')
+            if end >= 0:
+                break
+            if len(self.buf) > MAX_HEAD_BYTES or not self.fill():
+                return None
+        lines = self.buf[:end].decode('latin-1').split('\r\n')
+        del self.buf[:(end + 4)]
+
+        headers = []
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers.append((name.strip(), value.strip()))
+        return (ts, lines[0], headers)
+
+    def read_exact(self, size):
+        while size > 0:
+            if not self.buf and not self.fill():
+                return
+            piece = bytes(self.buf[:size])
+            del self.buf[:len(piece)]
+            size -= len(piece)
+            yield piece
+
+    def read_line(self):
+        while True:
+            end = self.buf.find(b'\r\n')
+            if end >= 0:
+                line = bytes(self.buf[:end])
+                del self.buf[:(end + 2)]
+                return line
+            if len(self.buf) > MAX_HEAD_BYTES or not self.fill():
+                return None
+
+    def read_body(self, headers, until_eof=False):
+        """Yields the (de-chunked) body of the message with `headers`."""
+        te = get_header(headers, 'Transfer-Encoding')
+        cl = get_header(headers, 'Content-Length')
+        if te is not None and 'chunked' in te.lower():
+            while True:
+                line = self.read_line()
+                if line is None:
+                    return
+                try:
+                    size = int(line.split(b';')[0], 16)
+                except ValueError:
+                    return
+                if size == 0:
+                    # Trailers
+                    while self.read_line():
+                        pass
+                    return
+                yield from self.read_exact(size)
+                self.read_line()
+        elif cl is not None:
+            try:
+                size = int(cl)
+            except ValueError:
+                return
+            yield from self.read_exact(size)
+        elif until_eof:
+            while self.buf or self.fill():
+                piece = bytes(self.buf)
+                self.buf.clear()
+                yield piece
+
+
+def get_header(headers, name):
+    name = name.lower()
+    for n, v in headers:
+        if n.lower() == name:
+            return v
+    return None
+
+
+def has_body(headers):
+    te = get_header(headers, 'Transfer-Encoding')
+    cl = get_header(headers, 'Content-Length')
+    return (te is not None and 'chunked' in te.lower()) \
+        or (cl is not None and cl.strip() != '0')
+
+
+def format_ts(ts):
+    return datetime.datetime.fromtimestamp(
+        ts, datetime.timezone.utc).isoformat()
+
+
+def json_string_pieces(chunks, binary):
+    """Yields a JSON string literal holding the concatenated `chunks`,
+    as base64 if `binary`, or decoded as UTF-8 otherwise.
+    """
+    yield '"'
+    if binary:
+        rest = b''
+        for chunk in chunks:
+            chunk = rest + chunk
+            cut = len(chunk) - len(chunk) % 3
+            rest = chunk[cut:]
+            yield base64.b64encode(chunk[:cut])
+        yield base64.b64encode(rest)
+    else:
+        decoder = codecs.getincrementaldecoder('utf8')('replace')
+        for chunk in chunks:
+            yield json.dumps(decoder.decode(chunk))[1:-1]
+        yield json.dumps(decoder.decode(b'', final=True))[1:-1]
+    yield '"'
+
+
+def counted(chunks, counter):
+    for chunk in chunks:
+        counter[0] += len(chunk)
+        yield chunk
+
+
+def is_text(mime_type):
+    mime_type = (mime_type or '').lower()
+    return mime_type.startswith('text/') \
+        or 'json' in mime_type or 'xml' in mime_type \
+        or 'javascript' in mime_type \
+        or 'x-www-form-urlencoded' in mime_type
+
+
+def har_headers(headers):
+    return [{'name': n, 'value': v} for n, v in headers]
+
+
+def har_flow_entries(store, flow):
+    """Yields the pieces of the HAR entries of one flow, each entry
+    preceded by a `None` separator marker.
+    """
+    req_parser = HttpStreamParser(
+        flow_records(store, flow, flow['uplink_topic']))
+    res_parser = HttpStreamParser(
+        flow_records(store, flow, flow['downlink_topic']))
+
+    while True:
+        req_head = req_parser.read_head()
+        if req_head is None:
+            return
+        req_ts, request_line, req_headers = req_head
+        try:
+            method, target, req_version = request_line.split(' ', 2)
+        except ValueError:
+            return
+
+        if '://' in target:
+            url = target
+        elif method == 'CONNECT':
+            url = target
+        else:
+            host = get_header(req_headers, 'Host') or flow['server']
+            url = 'http://{}{}'.format(host, target)
+
+        yield None
+        yield '{{"startedDateTime": {}, "request": '.format(
+            json.dumps(format_ts(req_ts)))
+        yield json.dumps({
+            'method': method,
+            'url': url,
+            'httpVersion': req_version,
+            'headers': har_headers(req_headers),
+            'queryString': [
+                {'name': n, 'value': v} for n, v in
+                urlparse.parse_qsl(urlparse.urlsplit(url).query,
+                                   keep_blank_values=True)],
+            'cookies': [],
+            'headersSize': -1,
+        })[:-1]
+
+        req_size = [0]
+        if has_body(req_headers):
+            req_type = get_header(req_headers, 'Content-Type')
+            req_body = counted(req_parser.read_body(req_headers), req_size)
+            yield ', "postData": {{"mimeType": {}, "text": '.format(
+                json.dumps(req_type or ''))
+            yield from json_string_pieces(req_body, False)
+            yield '}'
+        yield ', "bodySize": {}}}'.format(req_size[0])
+        req_end_ts = req_parser.ts or req_ts
+
+        res_head = res_parser.read_head()
+        if res_head is None:
+            status, status_text, res_version, res_headers = \
+                0, '', '', []
+            res_ts = res_end_ts = req_end_ts
+        else:
+            res_ts, status_line, res_headers = res_head
+            parts = status_line.split(' ', 2)
+            res_version = parts[0]
+            try:
+                status = int(parts[1])
+            except (IndexError, ValueError):
+                status = 0
+            status_text = parts[2] if len(parts) > 2 else ''
+
+        yield ', "response": '
+        yield json.dumps({
+            'status': status,
+            'statusText': status_text,
+            'httpVersion': res_version,
+            'headers': har_headers(res_headers),
+            'cookies': [],
+            'redirectURL': get_header(res_headers, 'Location') or '',
+            'headersSize': -1,
+        })[:-1]
+
+        res_size = [0]
+        res_type = get_header(res_headers, 'Content-Type') or ''
+        if res_head is None or method == 'HEAD' \
+                or status in (204, 304) or 100 <= status < 200:
+            res_body = iter(())
+        else:
+            res_body = res_parser.read_body(res_headers, until_eof=True)
+        res_body = counted(res_body, res_size)
+        binary = not is_text(res_type)
+        yield ', "content": {{"mimeType": {}, {}"text": '.format(
+            json.dumps(res_type),
+            '"encoding": "base64", ' if binary else '')
+        yield from json_string_pieces(res_body, binary)
+        if res_head is not None:
+            res_end_ts = res_parser.ts or res_ts
+        yield ', "size": {0}}}, "bodySize": {0}}}'.format(res_size[0])
+
+        wait = max(0.0, res_ts - req_end_ts) * 1000
+        receive = max(0.0, res_end_ts - res_ts) * 1000
+        send = max(0.0, req_end_ts - req_ts) * 1000
+        yield ', "cache": {{}}, "time": {}, "timings": {}}}'.format(
+            send + wait + receive,
+            json.dumps({'send': send, 'wait': wait, 'receive': receive}))
+
+        if method == 'CONNECT' or status == 101:
+            # The rest is a tunnel, or some other protocol
+            return
+
+
+def har_pieces(store, flows):
+    """Yields a HAR document of `flows`, piece by piece."""
+    yield '{"log": '
+    yield json.dumps({'version': '1.2',
+                      'creator': {'name': 'shinpachi',
+                                  'version': __version__},
+                      'pages': []})[:-1]
+    yield ', "entries": ['
+    first = True
+    for flow in flows:
+        for piece in har_flow_entries(store, flow):
+            if piece is None:
+                if not first:
+                    yield ', '
+                first = False
+            else:
+                yield piece
+    yield ']}}'
+
+
+_PCAPNG_BLOCK = struct.Struct('=II')
+_PCAPNG_SHB = struct.Struct('=IHHq')
+_PCAPNG_IDB = struct.Struct('=HHI')
+_PCAPNG_EPB = struct.Struct('=IIIII')
+_PCAPNG_SHB_TYPE = 0x0A0D0D0A
+_PCAPNG_IDB_TYPE = 0x00000001
+_PCAPNG_EPB_TYPE = 0x00000006
+_PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+# Raw IPv4/IPv6 packets, no link layer
+_LINKTYPE_RAW = 101
+
+_IPV4_HEADER = struct.Struct('>BBHHHBBH4s4s')
+_IPV6_HEADER = struct.Struct('>IHBB16s16s')
+_TCP_HEADER = struct.Struct('>HHIIBBHHH')
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_PSH = 0x08
+TCP_ACK = 0x10
+
+
+def pcapng_block(block_type, body):
+    pad = b'\0' * (-len(body) % 4)
+    total = _PCAPNG_BLOCK.size + len(body) + len(pad) + 4
+    return b''.join([_PCAPNG_BLOCK.pack(block_type, total), body, pad,
+                     struct.pack('=I', total)])
+
+
+def inet_checksum(data, initial=0):
+    if len(data) % 2:
+        data = data + b'\0'
+    s = initial + sum(array.array('H', data))
+    while s >> 16:
+        s = (s & 0xffff) + (s >> 16)
+    # The sum was done in the native byte order
+    if sys.byteorder == 'little':
+        s = ((s & 0xff) << 8) | (s >> 8)
+    return ~s & 0xffff
+
+
+def parse_endpoint(ep):
+    """'1.2.3.4:80' or '[::1]:80' -> (ip_address, port)"""
+    host, _, port = ep.rpartition(':')
+    return (ipaddress.ip_address(host.strip('[]')), int(port))
+
+
+class TcpFlowSynthesizer(object):
+    """Makes up the TCP segments carrying a captured flow, with a
+    handshake at the start, and a FIN for each direction's EOF.
+    """
+
+    def __init__(self, flow):
+        client, self.client_port = parse_endpoint(flow['client'])
+        server, self.server_port = parse_endpoint(flow['server'])
+        if client.version != server.version:
+            # A dual-stack proxy, show everything as IPv6
+            client, server = (ipaddress.IPv6Address('::ffff:' + str(a))
+                              if a.version == 4 else a
+                              for a in (client, server))
+        self.version = client.version
+        self.client = client.packed
+        self.server = server.packed
+        self.uplink = flow['uplink_topic'].encode('utf8')
+        # Initial sequence numbers, client and server
+        self.seq = [zlib.crc32(self.uplink) & 0xffffffff,
+                    zlib.crc32(flow['downlink_topic'].encode('utf8'))
+                    & 0xffffffff]
+        self.ip_id = 0
+        self.started = False
+
+    def packet(self, from_client, flags, payload=b''):
+        me, peer = (0, 1) if from_client else (1, 0)
+        if from_client:
+            src, dst = self.client, self.server
+            sport, dport = self.client_port, self.server_port
+        else:
+            src, dst = self.server, self.client
+            sport, dport = self.server_port, self.client_port
+
+        tcp_len = _TCP_HEADER.size + len(payload)
+        if self.version == 4:
+            pseudo = src + dst + struct.pack('>BBH', 0, 6, tcp_len)
+        else:
+            pseudo = src + dst + struct.pack('>IxxxB', tcp_len, 6)
+        header = _TCP_HEADER.pack(
+            sport, dport, self.seq[me],
+            self.seq[peer] if flags & TCP_ACK else 0,
+            5 << 4, flags, 65535, 0, 0)
+        checksum = inet_checksum(pseudo + header + payload)
+        header = header[:16] + struct.pack('>H', checksum) + header[18:]
+
+        if self.version == 4:
+            self.ip_id = (self.ip_id + 1) & 0xffff
+            ip = _IPV4_HEADER.pack(0x45, 0, 20 + tcp_len, self.ip_id,
+                                   0x4000, 64, 6, 0, src, dst)
+            ip = ip[:10] + struct.pack('>H', inet_checksum(ip)) + ip[12:]
+        else:
+            ip = _IPV6_HEADER.pack(6 << 28, tcp_len, 6, 64, src, dst)
+
+        self.seq[me] = (self.seq[me] + len(payload)
+                        + (1 if flags & (TCP_SYN | TCP_FIN) else 0)) \
+            & 0xffffffff
+        return b''.join([ip, header, payload])
+
+    def packets(self, topic, data):
+        """Returns the packets for a capture message of the flow."""
+        from_client = topic == self.uplink
+        packets = []
+        if not self.started:
+            self.started = True
+            packets.append(self.packet(True, TCP_SYN))
+            packets.append(self.packet(False, TCP_SYN | TCP_ACK))
+            packets.append(self.packet(True, TCP_ACK))
+        if not data:
+            packets.append(self.packet(from_client, TCP_FIN | TCP_ACK))
+        for offset in range(0, len(data), PCAP_MSS):
+            packets.append(self.packet(
+                from_client, TCP_PSH | TCP_ACK,
+                bytes(data[offset:(offset + PCAP_MSS)])))
+        return packets
+
+
+def pcapng_pieces(store, flows):
+    """Yields a pcapng file of `flows`, with the packets of all the
+    flows interleaved in capture order.
+    """
+    yield pcapng_block(_PCAPNG_SHB_TYPE, _PCAPNG_SHB.pack(
+        _PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1))
+    yield pcapng_block(_PCAPNG_IDB_TYPE, _PCAPNG_IDB.pack(
+        _LINKTYPE_RAW, 0, 0))
+
+    def tagged(records, n, topic):
+        for ts, data, notice in records:
+            if notice is None:
+                yield (ts, n, topic, data)
+
+    streams = []
+    synths = []
+    for n, flow in enumerate(flows):
+        try:
+            synths.append(TcpFlowSynthesizer(flow))
+        except ValueError:
+            # Not an ip:port pair
+            synths.append(None)
+            continue
+        for topic in (flow['uplink_topic'], flow['downlink_topic']):
+            streams.append(tagged(flow_records(store, flow, topic),
+                                  n, topic.encode('utf8')))
+
+    # Only the next record of each flow direction is held in memory
+    for ts, n, topic, data in heapq.merge(*streams):
+        usecs = int(ts * 1000000)
+        for packet in synths[n].packets(topic, data):
+            yield pcapng_block(_PCAPNG_EPB_TYPE, b''.join([
+                _PCAPNG_EPB.pack(0, usecs >> 32, usecs & 0xffffffff,
+                                 len(packet), len(packet)),
+                packet]))
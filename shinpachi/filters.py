@@ -0,0 +1,398 @@
+import collections
+import fnmatch
+import re
+from .flowindex import (parse_request_head, parse_status_line, parse_status,
+                        HEADER_SCAN_BYTES)
+from .log import logger
+
+
+__all__ = ['SubscriptionFilter', 'FlowFilter']
+
+
+CONTENT_TYPE_HEADER_RE = re.compile(
+    b'\\r\\ncontent-type:[ \\t]*([^;\\r\\n]+)', re.IGNORECASE)
+
+
+def parse_content_type(data):
+    head = bytes(data[:HEADER_SCAN_BYTES])
+    match = CONTENT_TYPE_HEADER_RE.search(head.partition(b'\r\n\r\n')[0])
+    if match is None:
+        return ''
+    return match.group(1).decode('ascii', 'replace').strip().lower()
+
+
+class SubscriptionFilter(object):
+    """What the flows of a subscription must look like to be sent to
+    the console.
+
+    `method` is matched exactly, `host` may be a glob pattern, `path`
+    is a regex searched in the request path, `status` is a code, a
+    class like `5xx` or a range like `400-499`, `content_type` matches
+    the start of the response's Content-Type, and `min_bytes` is the
+    least number of bytes the flow carries in both directions. Only the
+    first request and response of a flow are looked at.
+    """
+
+    # Command argument -> keyword
+    KEYS = {
+        'method': 'method',
+        'host': 'host',
+        'path': 'path',
+        'status': 'status',
+        'type': 'content_type',
+        'min_bytes': 'min_bytes',
+    }
+
+    def __init__(self, method=None, host=None, path=None, status=None,
+                 content_type=None, min_bytes=0):
+        self.method = method.upper() if method else None
+        self.host = host.lower() if host else None
+        self.path = re.compile(path) if path else None
+        self.status = parse_status(status)
+        self.content_type = content_type.lower() if content_type else None
+        self.min_bytes = int(min_bytes)
+
+    @classmethod
+    def parse(cls, args):
+        """Builds a filter from `key=value` command arguments.
+
+        Raises ValueError for bad arguments.
+        """
+        kwargs = {}
+        for arg in args:
+            key, sep, value = arg.partition('=')
+            if not sep or key not in cls.KEYS:
+                raise ValueError('Bad filter argument: {!r}'.format(arg))
+            kwargs[cls.KEYS[key]] = value
+        try:
+            return cls(**kwargs)
+        except re.error as e:
+            raise ValueError('Bad path regex: {}'.format(e))
+
+    def match(self, flow):
+        """Returns True or False, or None if it can't tell yet."""
+        result = True
+        if self.method is not None or self.host is not None \
+                or self.path is not None:
+            request = flow.request
+            if request is None:
+                if flow.heads_done():
+                    return False
+                result = None
+            else:
+                method, host, path = request
+                if self.method is not None and method != self.method:
+                    return False
+                if self.host is not None \
+                        and not fnmatch.fnmatchcase(host, self.host):
+                    return False
+                if self.path is not None and not self.path.search(path):
+                    return False
+
+        if self.status is not None or self.content_type is not None:
+            if flow.status is None:
+                if flow.heads_done():
+                    return False
+                result = None
+            else:
+                if self.status is not None \
+                        and not self.status[0] <= flow.status \
+                        <= self.status[1]:
+                    return False
+                if self.content_type is not None \
+                        and not flow.content_type.startswith(
+                            self.content_type):
+                    return False
+
+        if flow.bytes < self.min_bytes:
+            if flow.closed():
+                return False
+            result = None
+        return result
+
+
+class FilteredFlow(object):
+    """What's known about a flow, and what's held back until it's known
+    whether the flow matches.
+    """
+
+    __slots__ = ('filters', 'decision', 'request', 'status',
+                 'content_type', 'heads', 'eofs', 'bytes', 'pending',
+                 'pending_bytes')
+
+    def __init__(self, filters):
+        self.filters = filters
+        self.decision = None
+        self.request = None
+        self.status = None
+        self.content_type = ''
+        # Topics we've seen the first data of
+        self.heads = set()
+        self.eofs = set()
+        self.bytes = 0
+        self.pending = []
+        self.pending_bytes = 0
+
+    def heads_done(self):
+        return len(self.heads) >= 2 or self.closed()
+
+    def closed(self):
+        return len(self.eofs) >= 2
+
+    def update(self, msg):
+        if msg.notice is not None:
+            return
+        if not msg.data:
+            self.eofs.add(msg.topic)
+            return
+        self.bytes += len(msg.data)
+        if msg.topic in self.heads:
+            return
+        self.heads.add(msg.topic)
+        if self.request is None:
+            self.request = parse_request_head(msg.data)
+            if self.request is not None:
+                return
+        if self.status is None:
+            self.status = parse_status_line(msg.data)
+            if self.status is not None:
+                self.content_type = parse_content_type(msg.data)
+
+    def evaluate(self):
+        undecided = False
+        for f in self.filters:
+            result = f.match(self)
+            if result:
+                return True
+            elif result is None:
+                undecided = True
+        return None if undecided else False
+
+
+class FlowFilter(object):
+    """Applies a console's subscription filters to the flows sent to it.
+
+    A flow is subject to the filters of the subscriptions matching
+    either of its topics, and goes through if any of them matches, or
+    if one of the subscriptions has no filter. Messages are held back
+    until it's clear whether the flow matches; a flow that would hold
+    back more than `max_pending_bytes` is let through anyway, since
+    showing one flow too many is better than losing one, and so are the
+    flows holding back the most when all of them together hold back
+    more than `max_total_pending_bytes`. At most `max_flows` flows are
+    tracked, the oldest being forgotten first, with what it held back
+    let through for the same reason. The decisions on the forgotten
+    flows are kept (as many again), so that the rest of them isn't
+    judged without their heads.
+    """
+
+    def __init__(self, max_flows=4096, max_pending_bytes=1048576,
+                 max_total_pending_bytes=4194304):
+        self.max_flows = max_flows
+        self.max_pending_bytes = max_pending_bytes
+        self.max_total_pending_bytes = max_total_pending_bytes
+        # subscription topic -> SubscriptionFilter
+        self.filters = {}
+        # (endpoint, endpoint), sorted -> FilteredFlow
+        self.flows = collections.OrderedDict()
+        # (endpoint, endpoint), sorted -> [decision, topics with EOFs],
+        # for the flows forgotten before they were done
+        self.decisions = collections.OrderedDict()
+        self.pending_bytes = 0
+        self.passed = 0
+        self.rejected = 0
+        self.overflowed = 0
+        self.evicted = 0
+        self.dropped_messages = 0
+        self.dropped_bytes = 0
+
+    def __len__(self):
+        return len(self.filters)
+
+    def set_filter(self, topic, sub_filter):
+        if sub_filter is None:
+            self.filters.pop(topic, None)
+        else:
+            self.filters[topic] = sub_filter
+
+    def refilter(self, topics, subscriptions):
+        """Applies the filters of the subscriptions `topics` anew to
+        the flows they cover, e.g. after they changed or were removed.
+        The other flows are left as they are.
+
+        Returns the messages to send to the console now.
+        """
+        for pair in list(self.decisions):
+            if self.covers(topics, pair) \
+                    and not self.subscription_filters(
+                        b'-'.join(pair), subscriptions):
+                # Not filtered, or not subscribed to, anymore
+                del self.decisions[pair]
+
+        released = []
+        for pair, flow in list(self.flows.items()):
+            if not self.covers(topics, pair):
+                continue
+            filters = self.subscription_filters(b'-'.join(pair),
+                                                subscriptions)
+            if filters is None:
+                # Not filtered anymore, the messages go straight through
+                del self.flows[pair]
+                released.extend(self.take_pending(flow))
+                continue
+            if not filters:
+                # Not subscribed to anymore
+                del self.flows[pair]
+                self.drop(flow)
+                continue
+            flow.filters = filters
+            # What was already sent or dropped stays that way, but the
+            # rest of the flow follows the new filters, once they can
+            # tell
+            decision = flow.evaluate()
+            if decision is not None and decision != flow.decision:
+                released.extend(self.decide(flow, decision))
+        return released
+
+    def covers(self, topics, pair):
+        topic = b'-'.join(pair)
+        reverse = b'-'.join(reversed(pair))
+        return any(topic.startswith(t) or reverse.startswith(t)
+                   for t in topics)
+
+    def take_pending(self, flow):
+        pending, flow.pending = flow.pending, []
+        self.pending_bytes -= flow.pending_bytes
+        flow.pending_bytes = 0
+        return pending
+
+    def drop(self, flow):
+        self.dropped_messages += len(flow.pending)
+        self.dropped_bytes += flow.pending_bytes
+        self.take_pending(flow)
+
+    def subscription_filters(self, topic, subscriptions):
+        """Returns the filters of the subscriptions covering `topic`,
+        None if one of them has no filter, or an empty list if none of
+        them covers it.
+        """
+        src, sep, dst = topic.partition(b'-')
+        reverse = b''.join([dst, sep, src])
+        filters = []
+        for sub_topic in subscriptions:
+            if topic.startswith(sub_topic) or reverse.startswith(sub_topic):
+                sub_filter = self.filters.get(sub_topic)
+                if sub_filter is None:
+                    # Subscribed without a filter
+                    return None
+                filters.append(sub_filter)
+        return filters
+
+    def new_flow(self, topic, subscriptions):
+        filters = self.subscription_filters(topic, subscriptions)
+        return FilteredFlow(filters) if filters else None
+
+    def decide(self, flow, decision):
+        """Returns the held back messages to send, now that `flow` is
+        decided.
+        """
+        flow.decision = decision
+        if decision:
+            self.passed += 1
+            return self.take_pending(flow)
+        self.rejected += 1
+        self.drop(flow)
+        return []
+
+    def evict(self):
+        """Forgets the oldest flow, and returns what it held back."""
+        pair, flow = self.flows.popitem(last=False)
+        released = []
+        if flow.decision is None:
+            self.evicted += 1
+            released = self.decide(flow, True)
+        self.decisions[pair] = [flow.decision, set(flow.eofs)]
+        if len(self.decisions) > self.max_flows:
+            self.decisions.popitem(last=False)
+        return released
+
+    def relieve(self):
+        """Lets the flows holding back the most through, until they all
+        hold back no more than `max_total_pending_bytes` together.
+        """
+        released = []
+        while self.pending_bytes > self.max_total_pending_bytes:
+            flow = max(self.flows.values(), key=lambda f: f.pending_bytes)
+            logger.debug('Too much pending data for the filtered flows, '
+                         'letting the largest through')
+            self.overflowed += 1
+            released.extend(self.decide(flow, True))
+        return released
+
+    def forward(self, msg, decision):
+        if decision:
+            return [msg]
+        self.dropped_messages += 1
+        self.dropped_bytes += len(msg.data)
+        return []
+
+    def feed(self, msg, subscriptions):
+        """Returns the messages to send to the console now."""
+        src, sep, dst = msg.topic.partition(b'-')
+        if not sep:
+            return [msg]
+        pair = (src, dst) if src < dst else (dst, src)
+
+        released = []
+        flow = self.flows.get(pair)
+        if flow is None:
+            remembered = self.decisions.get(pair)
+            if remembered is not None:
+                decision, eofs = remembered
+                if not msg.data and msg.notice is None:
+                    eofs.add(msg.topic)
+                    if len(eofs) >= 2:
+                        del self.decisions[pair]
+                return self.forward(msg, decision)
+
+            flow = self.new_flow(msg.topic, subscriptions)
+            if flow is None:
+                return [msg]
+            self.flows[pair] = flow
+            if len(self.flows) > self.max_flows:
+                released = self.evict()
+
+        flow.update(msg)
+        if flow.closed():
+            del self.flows[pair]
+
+        if flow.decision is not None:
+            return released + self.forward(msg, flow.decision)
+
+        flow.pending.append(msg)
+        flow.pending_bytes += len(msg.data)
+        self.pending_bytes += len(msg.data)
+        decision = flow.evaluate()
+        if decision is None and flow.pending_bytes > self.max_pending_bytes:
+            logger.debug('Too much pending data for a filtered flow, '
+                         'letting it through: %r', pair)
+            self.overflowed += 1
+            decision = True
+        if decision is not None:
+            released.extend(self.decide(flow, decision))
+        released.extend(self.relieve())
+        return released
+
+    def stats(self):
+        return {
+            'filters': len(self.filters),
+            'flows': len(self.flows),
+            'remembered_flows': len(self.decisions),
+            'pending_bytes': self.pending_bytes,
+            'passed': self.passed,
+            'rejected': self.rejected,
+            'overflowed': self.overflowed,
+            'evicted': self.evicted,
+            'dropped_messages': self.dropped_messages,
+            'dropped_bytes': self.dropped_bytes,
+        }
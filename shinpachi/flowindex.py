@@ -0,0 +1,479 @@
+import asyncio
+import array
+import bisect
+import errno
+import fnmatch
+import json
+import re
+import zmq
+from urllib import parse as urlparse
+from .log import logger
+
+
+__all__ = ['StringTable', 'FlowIndex', 'query_flow_index',
+           'parse_request_head', 'parse_status_line', 'parse_status']
+
+
+REQUEST_LINE_RE = re.compile(
+    b'^([A-Z]+) ([^ \\r\\n]+) HTTP/[0-9]\\.[0-9]\\r\\n')
+HOST_HEADER_RE = re.compile(b'\\r\\nhost:[ \\t]*([^\\r\\n]+)', re.IGNORECASE)
+STATUS_LINE_RE = re.compile(b'^HTTP/[0-9]\\.[0-9] ([0-9]{3})')
+
+# Only look this far into the first chunk for the HTTP headers
+HEADER_SCAN_BYTES = 8192
+
+FLAG_TRUNCATED = 0x01
+FLAG_DROPPED = 0x02
+FLAG_CLOSED = 0x04
+
+MAX_QUERY_LIMIT = 500
+
+
+class StringTable(object):
+    """Interns strings, so that columns only hold integer ids.
+
+    Id 0 is the empty string, meaning "unknown".
+    """
+
+    def __init__(self):
+        self.strings = ['']
+        self.ids = {'': 0}
+
+    def intern(self, s):
+        sid = self.ids.get(s)
+        if sid is None:
+            sid = self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return sid
+
+    def get(self, sid):
+        return self.strings[sid]
+
+    def lookup(self, s):
+        return self.ids.get(s)
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class FlowIndex(object):
+    """A searchable summary of every recorded flow.
+
+    A flow is both directions of a connection. Its first topic is taken
+    as the client-to-server direction. Flows are kept in columns of
+    `array`s, in the order they started, so a time range is found by
+    bisecting, and the hosts and status codes have per-value lists of
+    flow ids. At most `max_flows` flows are kept.
+    """
+
+    # name -> array typecode
+    COLUMNS = [
+        ('start', 'd'),
+        ('end', 'd'),
+        ('client', 'I'),
+        ('server', 'I'),
+        ('method', 'I'),
+        ('host', 'I'),
+        ('path', 'I'),
+        ('status', 'H'),
+        ('up_bytes', 'Q'),
+        ('down_bytes', 'Q'),
+        ('flags', 'B'),
+    ]
+
+    # Columns holding StringTable ids
+    STRING_COLUMNS = ('client', 'server', 'method', 'host', 'path')
+
+    def __init__(self, max_flows=1000000):
+        self.max_flows = max_flows
+        self.strings = StringTable()
+        self.columns = {name: array.array(tc) for name, tc in self.COLUMNS}
+        # Id of the flow in the first row
+        self.base = 1
+        self.host_flows = {}
+        self.status_flows = {}
+        # sorted endpoint pair -> flow id, for flows still open
+        self.open_flows = {}
+        # flow id -> [uplink seen, downlink seen, uplink EOF, downlink EOF]
+        self.flow_state = {}
+
+    def __len__(self):
+        return len(self.columns['start'])
+
+    def next_id(self):
+        return self.base + len(self)
+
+    def new_flow(self, ts, client, server):
+        flow_id = self.next_id()
+        cols = self.columns
+        cols['start'].append(ts)
+        cols['end'].append(ts)
+        cols['client'].append(self.strings.intern(client))
+        cols['server'].append(self.strings.intern(server))
+        for name in ('method', 'host', 'path', 'status',
+                     'up_bytes', 'down_bytes', 'flags'):
+            cols[name].append(0)
+        self.flow_state[flow_id] = [False, False, False, False]
+
+        if len(self) > self.max_flows + self.max_flows // 4:
+            self.trim(len(self) - self.max_flows)
+        return flow_id
+
+    def add(self, ts, topic, data, notice=None):
+        """Updates the index with a capture message.
+
+        Returns the id of the message's flow, or None.
+        """
+        src, sep, dst = topic.partition(b'-')
+        if not sep:
+            return None
+        src = src.decode('utf8', 'replace')
+        dst = dst.decode('utf8', 'replace')
+        pair = (src, dst) if src < dst else (dst, src)
+
+        flow_id = self.open_flows.get(pair)
+        if flow_id is None:
+            if not data and notice is None:
+                return None
+            flow_id = self.open_flows[pair] = self.new_flow(ts, src, dst)
+
+        row = flow_id - self.base
+        cols = self.columns
+        state = self.flow_state[flow_id]
+        uplink = self.strings.get(cols['client'][row]) == src
+        cols['end'][row] = ts
+
+        if notice is not None:
+            if notice.get('notice') == 'truncated':
+                cols['flags'][row] |= FLAG_TRUNCATED
+            elif notice.get('notice') == 'dropped':
+                cols['flags'][row] |= FLAG_DROPPED
+            return flow_id
+
+        if not data:
+            state[2 if uplink else 3] = True
+            if state[2] and state[3]:
+                cols['flags'][row] |= FLAG_CLOSED
+                del self.open_flows[pair]
+                del self.flow_state[flow_id]
+            return flow_id
+
+        if uplink:
+            cols['up_bytes'][row] += len(data)
+            if not state[0]:
+                state[0] = True
+                self.parse_request(flow_id, row, data)
+        else:
+            cols['down_bytes'][row] += len(data)
+            if not state[1]:
+                state[1] = True
+                self.parse_response(flow_id, row, data)
+        return flow_id
+
+    def parse_request(self, flow_id, row, data):
+        request = parse_request_head(data)
+        if request is None:
+            return
+        method, host, path = request
+
+        cols = self.columns
+        cols['method'][row] = self.strings.intern(method)
+        cols['path'][row] = self.strings.intern(path)
+        host_id = cols['host'][row] = self.strings.intern(host)
+        if host_id:
+            self.add_posting(self.host_flows, host_id, flow_id)
+
+    def parse_response(self, flow_id, row, data):
+        status = parse_status_line(data)
+        if status is None:
+            return
+        self.columns['status'][row] = status
+        self.add_posting(self.status_flows, status, flow_id)
+
+    def add_posting(self, postings, key, flow_id):
+        flows = postings.get(key)
+        if flows is None:
+            flows = postings[key] = array.array('Q')
+        flows.append(flow_id)
+
+    def trim(self, n):
+        """Drops the `n` oldest flows."""
+        for col in self.columns.values():
+            del col[:n]
+        self.base += n
+        for postings in (self.host_flows, self.status_flows):
+            for key in list(postings):
+                flows = postings[key]
+                first = bisect.bisect_left(flows, self.base)
+                if first >= len(flows):
+                    del postings[key]
+                elif first > 0:
+                    del flows[:first]
+        for pair, flow_id in list(self.open_flows.items()):
+            if flow_id < self.base:
+                del self.open_flows[pair]
+                del self.flow_state[flow_id]
+        self.compact_strings()
+
+    def compact_strings(self):
+        strings = StringTable()
+        remap = {0: 0}
+        for name in self.STRING_COLUMNS:
+            col = self.columns[name]
+            for row, sid in enumerate(col):
+                new_sid = remap.get(sid)
+                if new_sid is None:
+                    new_sid = remap[sid] = \
+                        strings.intern(self.strings.get(sid))
+                col[row] = new_sid
+        self.host_flows = {remap[sid]: flows
+                           for sid, flows in self.host_flows.items()
+                           if sid in remap}
+        self.strings = strings
+
+    def expire(self, oldest_ts):
+        """Drops the flows that started before `oldest_ts`, e.g. because
+        their data is gone from the store.
+        """
+        n = bisect.bisect_left(self.columns['start'], oldest_ts)
+        if n > 0:
+            self.trim(n)
+
+    def get_flow(self, flow_id):
+        row = flow_id - self.base
+        cols = self.columns
+        get = self.strings.get
+        client = get(cols['client'][row])
+        server = get(cols['server'][row])
+        flags = cols['flags'][row]
+        return {
+            'id': flow_id,
+            'start': cols['start'][row],
+            'duration': cols['end'][row] - cols['start'][row],
+            'client': client,
+            'server': server,
+            'uplink_topic': '{}-{}'.format(client, server),
+            'downlink_topic': '{}-{}'.format(server, client),
+            'method': get(cols['method'][row]) or None,
+            'host': get(cols['host'][row]) or None,
+            'path': get(cols['path'][row]) or None,
+            'status': cols['status'][row] or None,
+            'up_bytes': cols['up_bytes'][row],
+            'down_bytes': cols['down_bytes'][row],
+            'truncated': bool(flags & FLAG_TRUNCATED),
+            'dropped': bool(flags & FLAG_DROPPED),
+            'closed': bool(flags & FLAG_CLOSED),
+        }
+
+    def candidates(self, lo, hi, host, status, ids):
+        """Yields the flow ids in [lo, hi) that may match, newest first,
+        using the posting lists where possible.
+        """
+        flows = None
+        if ids is not None:
+            flows = sorted(set(int(i) for i in ids))
+        elif host is not None and '*' not in host and '?' not in host:
+            host_id = self.strings.lookup(host)
+            flows = self.host_flows.get(host_id) if host_id else None
+            if flows is None:
+                return
+        elif status is not None and status[0] == status[1]:
+            flows = self.status_flows.get(status[0])
+            if flows is None:
+                return
+
+        if flows is None:
+            for flow_id in range(hi - 1, lo - 1, -1):
+                yield flow_id
+        else:
+            first = bisect.bisect_left(flows, lo)
+            last = bisect.bisect_left(flows, hi)
+            for i in range(last - 1, first - 1, -1):
+                yield flows[i]
+
+    def query(self, since=None, until=None, client=None, server=None,
+              method=None, host=None, path=None, status=None,
+              min_bytes=None, ids=None, before=None, limit=50):
+        """Returns the matching flows, newest first.
+
+        `since` and `until` are timestamps, `client` and `server` match
+        endpoint prefixes, `host` may be a glob pattern, `path` matches
+        a prefix, `status` is a code or a class like '5xx', and `ids`
+        picks flows by id. Pass the returned `next` as `before` to get
+        the next page.
+        """
+        limit = max(1, min(int(limit), MAX_QUERY_LIMIT))
+        start_col = self.columns['start']
+        lo = self.base
+        hi = self.next_id()
+        if since is not None:
+            lo = self.base + bisect.bisect_left(start_col, float(since))
+        if until is not None:
+            hi = self.base + bisect.bisect_right(start_col, float(until))
+        if before is not None:
+            hi = min(hi, int(before))
+
+        if host is not None:
+            host = host.lower()
+        if method is not None:
+            method = method.upper()
+        status_range = parse_status(status)
+
+        cols = self.columns
+        get = self.strings.get
+        flows = []
+        next_id = None
+        for flow_id in self.candidates(lo, hi, host, status_range, ids):
+            row = flow_id - self.base
+            if status_range is not None \
+                    and not status_range[0] <= cols['status'][row] \
+                    <= status_range[1]:
+                continue
+            if host is not None \
+                    and not fnmatch.fnmatchcase(get(cols['host'][row]), host):
+                continue
+            if method is not None and get(cols['method'][row]) != method:
+                continue
+            if path is not None \
+                    and not get(cols['path'][row]).startswith(path):
+                continue
+            if client is not None \
+                    and not get(cols['client'][row]).startswith(client):
+                continue
+            if server is not None \
+                    and not get(cols['server'][row]).startswith(server):
+                continue
+            if min_bytes is not None and \
+                    cols['up_bytes'][row] + cols['down_bytes'][row] \
+                    < int(min_bytes):
+                continue
+            if len(flows) >= limit:
+                next_id = flows[-1]['id']
+                break
+            flows.append(self.get_flow(flow_id))
+
+        return {'flows': flows, 'next': next_id}
+
+    def stats(self):
+        return {
+            'flows': len(self),
+            'open_flows': len(self.open_flows),
+            'strings': len(self.strings),
+        }
+
+    def rebuild(self, store):
+        count = 0
+        for ts, topic, data, notice in store.records():
+            self.add(ts, topic, data, notice)
+            count += 1
+        logger.info('Rebuilt the flow index from %d stored messages: %r',
+                    count, self.stats())
+
+
+def strip_port(hostport):
+    if hostport.startswith('['):
+        # [IPv6 address]:port
+        return hostport[1:].partition(']')[0]
+    if hostport.count(':') == 1:
+        return hostport.partition(':')[0]
+    return hostport
+
+
+def parse_request_head(data):
+    """Returns (method, host, path) from the head of an HTTP request,
+    or None.
+    """
+    head = bytes(data[:HEADER_SCAN_BYTES])
+    match = REQUEST_LINE_RE.match(head)
+    if match is None:
+        return None
+    method = match.group(1).decode('ascii')
+    target = match.group(2).decode('utf8', 'replace')
+
+    host = None
+    if method == 'CONNECT':
+        host, path = strip_port(target), ''
+    elif '://' in target:
+        # Absolute form, as sent to HTTP proxies
+        parts = urlparse.urlsplit(target)
+        host = parts.hostname
+        path = parts.path or '/'
+    else:
+        path = target.partition('?')[0]
+    if host is None:
+        match = HOST_HEADER_RE.search(head)
+        if match is not None:
+            host = strip_port(
+                match.group(1).decode('utf8', 'replace').strip())
+    return (method, (host or '').lower(), path)
+
+
+def parse_status_line(data):
+    """Returns the status code of an HTTP response, or None."""
+    match = STATUS_LINE_RE.match(bytes(data[:32]))
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def parse_status(status):
+    """Returns (min, max) of the status codes to match, or None.
+
+    `status` is a code, a class like `5xx`, or a range like `400-499`.
+    """
+    if status is None:
+        return None
+    status = str(status).lower()
+    if len(status) == 3 and status.endswith('xx') and status[0].isdigit():
+        base = int(status[0]) * 100
+        return (base, base + 99)
+    low, sep, high = status.partition('-')
+    if sep:
+        return (int(low), int(high))
+    code = int(status)
+    return (code, code)
+
+
+def handle_query(index, request):
+    """Serves a request from the query socket."""
+    try:
+        params = json.loads(request.decode('utf8'))
+        if not isinstance(params, dict):
+            raise ValueError('Query must be an object')
+        result = index.query(**params)
+    except (ValueError, TypeError) as e:
+        result = {'error': str(e)}
+    return json.dumps(result).encode('utf8')
+
+
+@asyncio.coroutine
+def query_flow_index(address, params, timeout=5.0, loop=None):
+    """Sends a JSON query to a REP socket (the recorder's or the search
+    process'), returns the decoded reply.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    ctx = zmq.Context.instance()
+    sock = ctx.socket(zmq.REQ)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.connect(address)
+    future = asyncio.Future(loop=loop)
+
+    def read_ready():
+        if future.done():
+            return
+        try:
+            future.set_result(sock.recv(flags=zmq.NOBLOCK))
+        except zmq.ZMQError as e:
+            if e.errno != errno.EAGAIN:
+                future.set_exception(e)
+
+    try:
+        sock.send(json.dumps(params).encode('utf8'))
+        loop.add_reader(sock, read_ready)
+        reply = yield from asyncio.wait_for(future, timeout, loop=loop)
+    finally:
+        loop.remove_reader(sock)
+        sock.close()
+    return json.loads(reply.decode('utf8'))
@@ -2,17 +2,26 @@ import aiohttp
 import aiohttp.server
 import aiohttp.websocket
 import asyncio
-import zmq
 import socket
 import collections
 import re
+import json
+import os
+import binascii
+import time
 from urllib import parse as urlparse
 from .http_base import (HttpPathHandler, path)
 from .user import (get_user, oauth_login, oauth2_code_cb)
 from .user.errors import  (OAuth2StepError, OAuth2BadData)
-from .network import getaddrinfo_async
 from .io import aiohttp_read_all_into_bytearray
-from .proxy import TopicMixin
+from .hub import (HubMessage, ConsoleSendQueue, get_console_hub)
+from .websocket import do_handshake
+from .filters import (SubscriptionFilter, FlowFilter)
+from .bridge import (replay_topic, split_replay_topic)
+from .flowindex import query_flow_index
+from .store import (get_capture_store_reader, get_capture_store_executor)
+from .sampling import get_sampling_stats
+from .export import (har_pieces, pcapng_pieces, buffered_pieces)
 from .log import logger
 from .version import (__version__, SERVER_SOFTWARE)
 
@@ -178,6 +187,9 @@ class OAuth2CodeCBHandler(HttpPathHandler):
 class WebsocketHandler(ShinpachiAuthPathHandler):
     TOPIC_EP_RE = re.compile(b'^(([0-9]+(\\.[0-9]+){3})|\\[([:0-9a-fA-F]+)\\])(:([0-9]+))?$')
 
+    # Give up waiting for the bridge to finish a replay after this long
+    REPLAY_TIMEOUT = 5.0
+
     @asyncio.coroutine
     def do_handle(self, message, payload, user):
         if ('UPGRADE' not in message.headers) or \
@@ -185,68 +197,57 @@ class WebsocketHandler(ShinpachiAuthPathHandler):
             logger.debug('Invalid websocket request')
             raise aiohttp.HttpErrorException(400)
 
-        evloop = asyncio.get_event_loop()
-
-        zmq_ctx = zmq.Context.instance()
-        zmq_sock = zmq_ctx.socket(zmq.SUB)
-        xpub_addr = self.kw['config']['bridge']['xpub_address']
-        yield from evloop.run_in_executor(None, zmq_sock.connect, xpub_addr)
-
-        self.zmq_sock = zmq_sock
+        # Consoles share one subscriber socket per worker
+        self.hub = yield from get_console_hub(self.kw['config'])
         self.sub_topics = set()
         self.sub_triggers = set()
-        self.triggered_sub_topics = collections.defaultdict(list)
-
-        status, headers, parser, writer = \
-            aiohttp.websocket.do_handshake(
-                message.method, message.headers,
-                self.protocol.transport)
+        # trigger -> set of topics subscribed because of it
+        self.triggered_sub_topics = collections.defaultdict(set)
+        # triggered topic -> set of the live flows that triggered it
+        self.triggered_flows = {}
+
+        # New subscriptions start with a replay from the bridge history.
+        # Live messages are held back until the replays are done.
+        bconfig = self.kw['config']['bridge']
+        self.replay_enabled = bconfig.getint('history_bytes') > 0
+        self.nr_shards = bconfig.getint('shards')
+        self.console_id = binascii.hexlify(os.urandom(8))
+        # replay topic -> number of shards yet to finish
+        self.pending_replays = {}
+        self.held_messages = []
+        self.held_bytes = 0
+
+        hconfig = self.kw['config']['http']
+        deflate_options = None
+        if hconfig.getboolean('ws_deflate'):
+            deflate_options = {
+                'level': hconfig.getint('ws_deflate_level'),
+                'threshold': hconfig.getint('ws_deflate_threshold'),
+                'context_takeover':
+                    hconfig.getboolean('ws_deflate_context_takeover'),
+            }
+        status, headers, parser, writer, deflate = do_handshake(
+            message.method, message.headers, self.protocol.transport,
+            deflate_options)
         response = self.start_response(status, message.version)
         response.add_headers(*headers)
         response.send_headers()
 
+        # Messages are encoded once by the hub, and queued as they are
+        self.send_queue = ConsoleSendQueue(
+            self.protocol.transport, self.protocol.writer,
+            max_bytes=hconfig.getint('ws_queue_bytes'),
+            overflow=hconfig['ws_overflow'],
+            batch_bytes=hconfig.getint('ws_batch_bytes'),
+            deflate=deflate)
+        # Subscriptions may come with filters on the flows to send. What
+        # they hold back is bounded like the send queue.
+        self.flow_filter = FlowFilter(
+            hconfig.getint('filter_max_flows'),
+            hconfig.getint('filter_max_pending_bytes'),
+            hconfig.getint('ws_queue_bytes'))
         dataqueue = self.protocol.reader.set_parser(parser)
 
-        def zmq_read_ready():
-            try:
-                from_zmq = zmq_sock.recv(flags=zmq.NOBLOCK)
-            except zmq.ZMQError as e:
-                if e.errno == errno.EAGAIN:
-                    from_zmq = None
-                else:
-                    raise e
-            if from_zmq is not None:
-                if len(self.sub_triggers) > 0:
-                    decoded_topic = TopicMixin.decode_topic(from_zmq)
-                    if decoded_topic is not None:
-                        (src_ip, src_port), (dst_ip, dst_port) = decoded_topic
-                        src_full = src_ip + b':' + src_port
-                        dst_full = dst_ip + b':' + dst_port
-
-                        do_trigger = None
-                        if src_ip in self.sub_triggers:
-                            do_trigger = src_ip
-                        elif src_full in self.sub_triggers:
-                            do_trigger = src_full
-
-                        if do_trigger is not None \
-                                and dst_full not in self.sub_topics:
-                            self.add_triggered_subscription(dst_full, do_trigger)
-
-                        do_trigger = None
-                        if dst_ip in self.sub_triggers:
-                            do_trigger = dst_ip
-                        elif dst_full in self.sub_triggers:
-                            do_trigger = dst_full
-
-                        if do_trigger is not None \
-                                and src_full not in self.sub_topics:
-                            self.add_triggered_subscription(src_full, do_trigger)
-
-                writer.send(from_zmq, binary=True)
-
-        evloop.add_reader(zmq_sock, zmq_read_ready)
-
         while True:
             try:
                 msg = yield from dataqueue.read()
@@ -262,13 +263,75 @@ class WebsocketHandler(ShinpachiAuthPathHandler):
                 # Command from the client
                 self.handle_ws_cmd(msg.data)
 
+    def hub_deliver(self, msg):
+        replay = split_replay_topic(msg.topic)
+        if replay is not None:
+            if msg.notice is not None \
+                    and msg.notice.get('notice') == 'replay_done':
+                self.finish_replay(msg.topic)
+            else:
+                # Replayed messages go out under their original topics
+                self.deliver(HubMessage(replay[1], msg.data, msg.notice))
+        elif self.pending_replays:
+            self.hold(msg)
+        else:
+            self.deliver(msg)
+
+    def hold(self, msg):
+        # Held data counts against the bound of the send queue, and is
+        # dropped like queued data when it doesn't fit. EOFs and notices
+        # are always kept.
+        if msg.data and msg.notice is None:
+            size = len(msg.record())
+            if self.send_queue.queued_bytes + self.held_bytes + size \
+                    > self.send_queue.max_bytes:
+                self.send_queue.drop_message(msg)
+                return
+            self.held_bytes += size
+        self.held_messages.append(msg)
+
+    def deliver(self, msg):
+        if self.flow_filter:
+            for m in self.flow_filter.feed(msg, self.sub_topics):
+                self.send_queue.put(m)
+        else:
+            self.send_queue.put(msg)
+
+    def flow_triggered(self, flow, trigger, topic):
+        """Called by the hub when one end of a new flow matches one of
+        our triggers, `topic` being the other end.
+        """
+        if trigger not in self.sub_triggers:
+            return
+        flows = self.triggered_flows.get(topic)
+        if flows is None:
+            if topic in self.sub_topics:
+                # Subscribed explicitly, it's not ours to expire
+                return
+            self.add_triggered_subscription(topic, trigger)
+            flows = self.triggered_flows[topic] = set()
+        flows.add(flow)
+
+    def flow_closed(self, flow, topic):
+        """Expires a triggered subscription after its last flow."""
+        flows = self.triggered_flows.get(topic)
+        if flows is None:
+            return
+        flows.discard(flow)
+        if not flows:
+            logger.debug('Triggered topic expired: %r', topic)
+            self.unsubscribe(topic)
+
     def close(self):
-        zmq_sock = getattr(self, 'zmq_sock', None)
-        if zmq_sock:
-            logger.debug('Cleaning up zmq_sock')
-            loop = asyncio.get_event_loop()
-            loop.remove_reader(zmq_sock)
-            zmq_sock.close()
+        hub = getattr(self, 'hub', None)
+        if hub:
+            logger.debug('Removing console from the hub')
+            hub.remove(self)
+            # So that pending replay timeouts leave the hub alone
+            self.pending_replays.clear()
+        send_queue = getattr(self, 'send_queue', None)
+        if send_queue:
+            send_queue.close()
 
         if hasattr(self, 'sub_topics') \
                 and self.kw['config']['http_proxy'].getboolean('auth_ip') \
@@ -278,25 +341,70 @@ class WebsocketHandler(ShinpachiAuthPathHandler):
 
     def add_subscription(self, topic):
         logger.debug('Adding new topic: %r', topic)
-        if topic not in self.sub_topics:
+        if topic in self.triggered_flows:
+            # Subscribing explicitly to a triggered topic keeps it from
+            # expiring
+            self.forget_triggered(topic)
+        elif topic not in self.sub_topics:
             ep_ip = self.get_ip_from_topic(topic)
             if ep_ip is None:
                 logger.debug('Bad topic: %r', topic)
                 return
             self.sub_topics.add(topic)
-            self.zmq_sock.setsockopt(zmq.SUBSCRIBE, topic)
+            self.hub.subscribe(self, topic)
             self.set_ip_auth(ep_ip)
+            if self.replay_enabled:
+                self.start_replay(topic)
+
+    def start_replay(self, topic):
+        r_topic = replay_topic(self.console_id, topic)
+        if r_topic in self.pending_replays:
+            return
+        self.pending_replays[r_topic] = self.nr_shards
+        self.hub.subscribe(self, r_topic)
+        asyncio.get_event_loop().call_later(
+            self.REPLAY_TIMEOUT, self.finish_replay, r_topic, True)
+
+    def finish_replay(self, r_topic, timed_out=False):
+        remaining = self.pending_replays.get(r_topic)
+        if remaining is None:
+            return
+        if remaining > 1 and not timed_out:
+            # Other shards are still replaying
+            self.pending_replays[r_topic] = remaining - 1
+            return
+        if timed_out:
+            logger.debug('Replay timed out: %r', r_topic)
+
+        del self.pending_replays[r_topic]
+        self.hub.unsubscribe(self, r_topic)
+
+        if not self.pending_replays:
+            held, self.held_messages = self.held_messages, []
+            self.held_bytes = 0
+            for msg in held:
+                self.deliver(msg)
 
     def add_triggered_subscription(self, topic, trigger):
         logger.debug('Adding triggered new topic from %r: %r', trigger, topic)
         if topic not in self.sub_topics:
-            self.triggered_sub_topics[trigger].append(topic)
+            self.triggered_sub_topics[trigger].add(topic)
             self.add_subscription(topic)
+            # Flows found through a trigger are filtered the same way
+            sub_filter = self.flow_filter.filters.get(trigger)
+            if sub_filter is not None:
+                self.flow_filter.set_filter(topic, sub_filter)
+
+    def forget_triggered(self, topic):
+        del self.triggered_flows[topic]
+        for triggered in self.triggered_sub_topics.values():
+            triggered.discard(topic)
 
     def add_trigger(self, trigger):
         if trigger not in self.sub_triggers:
             logger.debug('Adding new trigger: %r', trigger)
             self.sub_triggers.add(trigger)
+            self.hub.triggers.add(self, trigger)
             self.add_subscription(trigger)
 
     def get_ip_from_topic(self, topic):
@@ -331,25 +439,55 @@ class WebsocketHandler(ShinpachiAuthPathHandler):
         elif cmd == 'unsubscribe':
             for t in args:
                 self.unsubscribe(t)
+        elif cmd == 'filter' and len(split_line) > 1:
+            # filter <topic> [key=value ...], no conditions to clear
+            self.set_filter(split_line[1].encode('utf8'), split_line[2:])
+
+    def set_filter(self, topic, args):
+        args = [a for a in args if a]
+        try:
+            sub_filter = SubscriptionFilter.parse(args) if args else None
+        except ValueError as e:
+            logger.debug('Bad filter for %r: %s', topic, e)
+            return
+        logger.debug('Setting filter for %r: %r', topic, args)
+        topics = [topic]
+        topics.extend(self.triggered_sub_topics.get(topic, ()))
+        for t in topics:
+            self.flow_filter.set_filter(t, sub_filter)
+        # Decisions were made with the old filters
+        for msg in self.flow_filter.refilter(topics, self.sub_topics):
+            self.send_queue.put(msg)
 
     def unsubscribe(self, topic):
         logger.debug('Unsubscribe: %r', topic)
+        removed = []
         if topic in self.sub_topics:
-            self.zmq_sock.setsockopt(zmq.UNSUBSCRIBE, topic)
+            self.hub.unsubscribe(self, topic)
             self.sub_topics.remove(topic)
             self.clear_ip_auth(self.get_ip_from_topic(topic))
+            self.flow_filter.set_filter(topic, None)
+            removed.append(topic)
+        if topic in self.triggered_flows:
+            self.forget_triggered(topic)
         if topic in self.sub_triggers:
-            triggered = self.triggered_sub_topics[topic]
+            self.hub.triggers.remove(self, topic)
+            triggered = self.triggered_sub_topics.pop(topic, ())
             logger.debug('Unsubscribe to triggered topics: %r', triggered)
             for tt in triggered:
-                self.zmq_sock.setsockopt(zmq.UNSUBSCRIBE, tt)
-                try:
+                self.triggered_flows.pop(tt, None)
+                if tt in self.sub_topics:
+                    self.hub.unsubscribe(self, tt)
                     self.sub_topics.remove(tt)
                     self.clear_ip_auth(self.get_ip_from_topic(tt))
-                except KeyError:
-                    pass
-            self.triggered_sub_topics.pop(topic)
+                    self.flow_filter.set_filter(tt, None)
+                    removed.append(tt)
             self.sub_triggers.remove(topic)
+        if removed:
+            # Flows still covered by other subscriptions go on under
+            # their filters, what the others held back is dropped
+            for msg in self.flow_filter.refilter(removed, self.sub_topics):
+                self.send_queue.put(msg)
 
 
 @path('^/proxy.json$',
@@ -370,8 +508,7 @@ class PACHandler(HttpPathHandler):
             host = host.split(':')[0]
             http_addr_infos = [(host, self.kw['config']['http_proxy'].getint('port'))]
         else:
-            http_addr_infos = yield from getaddrinfo_async(
-                asyncio.get_event_loop(),
+            http_addr_infos = yield from self.kw['resolver'].getaddrinfo(
                 self.kw['config']['http_proxy']['host'],
                 self.kw['config']['http_proxy'].getint('port'))
             http_addr_infos = map(lambda info: info[4],
@@ -385,8 +522,209 @@ class PACHandler(HttpPathHandler):
         return response
 
 
+class FlowQueryMixin(object):
+    # Query string parameters, and how to convert them
+    QUERY_PARAMS = {
+        'since': float,
+        'until': float,
+        'client': str,
+        'server': str,
+        'method': str,
+        'host': str,
+        'path': str,
+        'status': str,
+        'min_bytes': int,
+        'ids': lambda v: [int(i) for i in v.split(',') if i],
+        'before': int,
+        'limit': int,
+    }
+
+    def parse_flow_query(self, message):
+        if not self.kw['config']['store'].getboolean('enabled'):
+            raise aiohttp.HttpErrorException(404)
+
+        spath, qs = urlparse.splitquery(message.path)
+        qs = urlparse.parse_qs(qs or '')
+        params = {}
+        try:
+            for name, values in qs.items():
+                if name == 'last':
+                    # Seconds back from now
+                    params['since'] = time.time() - float(values[-1])
+                elif name in self.QUERY_PARAMS:
+                    params[name] = self.QUERY_PARAMS[name](values[-1])
+        except ValueError:
+            raise aiohttp.HttpErrorException(400)
+        return params
+
+    @asyncio.coroutine
+    def query_flows(self, params):
+        try:
+            result = yield from query_flow_index(
+                self.kw['config']['store']['query_address'], params)
+        except asyncio.TimeoutError:
+            logger.warning('Flow index query timed out')
+            raise aiohttp.HttpErrorException(503)
+        return result
+
+
+@path('^/flows.json$')
+class FlowsHandler(ShinpachiAuthPathHandler, FlowQueryMixin):
+    """Queries the flow index of the recorder.
+
+    e.g. /flows.json?host=example.com&status=5xx&last=600&limit=50
+    Pass `next` from the result as `before` to get the next page.
+    """
+
+    @asyncio.coroutine
+    def do_handle(self, message, payload, user):
+        params = self.parse_flow_query(message)
+        result = yield from self.query_flows(params)
+
+        response = self.start_response(
+            400 if 'error' in result else 200, message.version)
+        response.add_header('Content-Type', 'application/json')
+        response.send_headers()
+        response.write(json.dumps(result).encode('utf8'))
+        return response
+
+
+@path('^/stats.json$')
+class StatsHandler(ShinpachiAuthPathHandler):
+    """Stats of the consoles served by the worker handling the request,
+    e.g. how much data is queued for them, and of its name resolver.
+    With sampling enabled, the per-rule counters of all the proxy
+    workers are there too.
+    """
+
+    @asyncio.coroutine
+    def do_handle(self, message, payload, user):
+        config = self.kw['config']
+        hub = yield from get_console_hub(config)
+        stats = {'pid': os.getpid(),
+                 'hub': hub.stats(),
+                 'resolver': self.kw['resolver'].stats()}
+        interval = config['sampling'].getfloat('stats_interval')
+        if config['sampling'].getboolean('enabled') and interval > 0:
+            # Workers that missed a few updates are gone
+            stats['sampling'] = yield from get_sampling_stats(
+                self.kw['redis'], interval * 3)
+
+        response = self.start_response(200, message.version)
+        response.add_header('Content-Type', 'application/json')
+        response.send_headers()
+        response.write(json.dumps(stats).encode('utf8'))
+        return response
+
+
+@path('^/search.json$')
+class SearchHandler(ShinpachiAuthPathHandler, FlowQueryMixin):
+    """Full-text search over the recorded flows.
+
+    e.g. /search.json?q=invalid+token&limit=50 returns the ids of the
+    flows having all the words, newest first, and their summaries.
+    """
+
+    @asyncio.coroutine
+    def do_handle(self, message, payload, user):
+        config = self.kw['config']
+        # Without the store, there's no search process to ask
+        if not config['search'].getboolean('enabled') \
+                or not config['store'].getboolean('enabled'):
+            raise aiohttp.HttpErrorException(404)
+        params = self.parse_flow_query(message)
+
+        spath, qs = urlparse.splitquery(message.path)
+        qs = urlparse.parse_qs(qs or '')
+        if 'q' not in qs:
+            raise aiohttp.HttpErrorException(400)
+        search_params = {'q': qs['q'][-1],
+                         'limit': params.get('limit', 50)}
+        try:
+            result = yield from query_flow_index(
+                config['search']['query_address'], search_params)
+        except asyncio.TimeoutError:
+            logger.warning('Search query timed out')
+            raise aiohttp.HttpErrorException(503)
+
+        if 'error' not in result and result['ids']:
+            # The index may have dropped some of them already
+            flows = yield from self.query_flows(
+                {'ids': result['ids'], 'limit': len(result['ids'])})
+            result['flows'] = flows.get('flows', [])
+        else:
+            result['flows'] = []
+
+        response = self.start_response(
+            400 if 'error' in result else 200, message.version)
+        response.add_header('Content-Type', 'application/json')
+        response.send_headers()
+        response.write(json.dumps(result).encode('utf8'))
+        return response
+
+
+@path('^/export.har$',
+      export_pieces=har_pieces,
+      file_name='shinpachi.har',
+      content_type='application/json')
+@path('^/export.pcapng$',
+      export_pieces=pcapng_pieces,
+      file_name='shinpachi.pcapng',
+      content_type='application/x-pcapng')
+class ExportHandler(ShinpachiAuthPathHandler, FlowQueryMixin):
+    """Streams the flows matching a /flows.json query (all pages of it,
+    up to `limit` flows in all) out of the store, oldest first.
+    """
+
+    @asyncio.coroutine
+    def do_handle(self, message, payload, user):
+        params = self.parse_flow_query(message)
+        max_flows = self.kw['config']['store'].getint('export_max_flows')
+        # `limit` caps the whole export here, not just a page
+        max_flows = min(max_flows, params.get('limit', max_flows))
+        params['limit'] = max_flows
+
+        flows = []
+        while len(flows) < max_flows:
+            result = yield from self.query_flows(params)
+            if 'error' in result:
+                raise aiohttp.HttpErrorException(400)
+            flows.extend(result['flows'])
+            if result['next'] is None:
+                break
+            params['before'] = result['next']
+        flows = flows[:max_flows]
+        flows.reverse()
+
+        # Reading the store blocks, keep it off the loop that serves the
+        # consoles
+        loop = asyncio.get_event_loop()
+        executor = get_capture_store_executor()
+        store = yield from loop.run_in_executor(
+            executor, get_capture_store_reader, self.kw['config'])
+
+        response = self.start_response(200, message.version)
+        response.add_header('Content-Type', self.kw['content_type'])
+        response.add_header('Content-Disposition',
+                            'attachment; filename="{}"'
+                            .format(self.kw['file_name']))
+        response.send_headers()
+
+        # Write as we go, waiting for the client to drain the
+        # transport, so nothing piles up in memory
+        pieces = buffered_pieces(self.kw['export_pieces'](store, flows))
+        while True:
+            chunk = yield from loop.run_in_executor(
+                executor, next, pieces, None)
+            if chunk is None:
+                break
+            yield from response.write(chunk)
+        return response
+
+
 class HttpProtocol(aiohttp.server.ServerHttpProtocol):
-    def __init__(self, matcher, tmpl_env, res_mgr, res_provider, redis, config):
+    def __init__(self, matcher, tmpl_env, res_mgr, res_provider, redis, config,
+                 resolver):
         if config['log']['level'].strip().upper() == 'DEBUG':
             debug = True
         else:
@@ -396,6 +734,7 @@ class HttpProtocol(aiohttp.server.ServerHttpProtocol):
         self.tmpl_env = tmpl_env
         self.config = config
         self.redis = redis
+        self.resolver = resolver
         self.resource_mgr = res_mgr
         self.resource_provider = res_provider
         self.need_auth = config['http'].getboolean('need_auth')
@@ -411,6 +750,7 @@ class HttpProtocol(aiohttp.server.ServerHttpProtocol):
                                     response_cls=HttpResponse,
                                     config=self.config,
                                     redis=self.redis,
+                                    resolver=self.resolver,
                                     tmpl_env=self.tmpl_env)
 
         logger.debug('message = %r, payload = %r', message, payload)
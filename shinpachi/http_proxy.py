@@ -2,7 +2,9 @@ import asyncio
 import aiohttp
 import aiohttp.server
 import aiohttp.client
+import aiohttp.connector
 import re
+import socket
 import urllib.parse
 from .proxy import (ProxyClientProtocol, ProxyPipe,
                     ProxyPipeEpMixin, TopicMixin)
@@ -10,6 +12,7 @@ from .proxy import (new_proxy_connection, get_peername_bytes)
 from .http import HttpResponse
 from .io import (aiohttp_read_all, aiohttp_read_all_into_bytearray)
 from .network import getaddrinfo_async
+from .capture import (CaptureBudget, DEFAULT_CAPTURE_POLICY)
 from .log import logger
 
 
@@ -73,13 +76,31 @@ class ProxyRequest(aiohttp.client.ClientRequest):
         self.path = urllib.parse.urlunsplit(('', '', path, query, fragment))
 
 
+class ResolverConnector(aiohttp.connector.TCPConnector):
+    """Makes aiohttp resolve names through our caching resolver."""
+
+    def __init__(self, resolver, *args, **kw_args):
+        super().__init__(*args, **kw_args)
+        self.resolver = resolver
+
+    @asyncio.coroutine
+    def _resolve_host(self, host, port):
+        addr_infos = yield from self.resolver.getaddrinfo(host, port)
+        return [{'hostname': host,
+                 'host': sockaddr[0], 'port': sockaddr[1],
+                 'family': af, 'proto': proto,
+                 'flags': socket.AI_NUMERICHOST}
+                for af, _socktype, proto, _canonname, sockaddr in addr_infos]
+
+
 class HttpProxyProtocol(aiohttp.server.ServerHttpProtocol,
                         ProxyPipeEpMixin, TopicMixin):
     DEFAULT_HTTP_VERSION = (1, 1)
     SCHEME_RE = re.compile('^[a-zA-Z]+[a-zA-Z0-9]*:(//){0,1}')
     CONNECT_DST_RE = re.compile('([\-a-zA-Z0-9.]+):([0-9]+)')
 
-    def __init__(self, config, redis=None, pub=None):
+    def __init__(self, config, redis=None, pub=None, resolver=None,
+                 policies=None, sampler=None, splice=False):
         if config['log']['level'].strip().upper() == 'DEBUG':
             debug = True
         else:
@@ -87,8 +108,13 @@ class HttpProxyProtocol(aiohttp.server.ServerHttpProtocol,
         super().__init__(debug=debug, keep_alive=75)
         self.pub = pub
         self.redis = redis
+        self.resolver = resolver
+        self.policies = policies
+        self.sampler = sampler
+        self.sampled = True
         self.config = config
         self.streaming = False
+        self.splice_relay = splice
 
     @asyncio.coroutine
     def handle_request(self, message, payload):
@@ -103,6 +129,8 @@ class HttpProxyProtocol(aiohttp.server.ServerHttpProtocol,
             yield from self.handle_ip_auth_failure(message, payload)
             return
 
+        self.sampled = self.sample_flow(message)
+
         if message.method == 'CONNECT':
             yield from self.handle_method_connect(message, payload)
         else:
@@ -125,7 +153,8 @@ class HttpProxyProtocol(aiohttp.server.ServerHttpProtocol,
 
         try:
             client_transport, client_proto = \
-                yield from new_proxy_connection(host, port, ProxyClientProtocol)
+                yield from new_proxy_connection(host, port, ProxyClientProtocol,
+                                                resolver=self.resolver)
             exc = None
         except Exception as e:
             exc = e
@@ -135,7 +164,11 @@ class HttpProxyProtocol(aiohttp.server.ServerHttpProtocol,
                 and client_proto is not None:
             response = self.start_response(200, message)
             response.send_headers()
-            p_pipe = ProxyPipe(client_proto, self, pub=self.pub)
+            p_pipe = ProxyPipe(client_proto, self,
+                               pub=self.pub if self.sampled else None,
+                               write_limits=self.get_write_limits(),
+                               splice=self.splice_relay,
+                               policy=self.get_capture_policy(host))
             self.streaming = True
             if self._request_handler is not None:
                 self._request_handler.cancel()
@@ -156,6 +189,10 @@ class HttpProxyProtocol(aiohttp.server.ServerHttpProtocol,
         url = self.build_url(message.headers, message.path)
         logger.debug('url = %r', url)
 
+        policy = self.get_capture_policy(urllib.parse.urlsplit(url).hostname)
+        req_budget = CaptureBudget(policy.max_bytes)
+        res_budget = CaptureBudget(policy.max_bytes)
+
         data = yield from aiohttp_read_all_into_bytearray(payload)
 
         pub_buf, req_headers = \
@@ -164,7 +201,6 @@ class HttpProxyProtocol(aiohttp.server.ServerHttpProtocol,
                                 message.method, message.path,
                                 message.version[0],
                                 message.version[1]).encode('utf8'))
-        pub_buf.extend(data)
 
         logger.debug('Sending http request to %r', url)
         client_res = yield from aiohttp.request(message.method, url,
@@ -172,16 +208,20 @@ class HttpProxyProtocol(aiohttp.server.ServerHttpProtocol,
                                                 data=data,
                                                 version=self.DEFAULT_HTTP_VERSION,
                                                 allow_redirects=False,
-                                                request_class=ProxyRequest)
+                                                request_class=ProxyRequest,
+                                                connector=self.new_connector())
         logger.debug('Sent http request to %r', url)
 
         res_peername = client_res.connection._transport.get_extra_info('peername')
         res_peername_bytes = get_peername_bytes(res_peername)
 
-        topic_data = self.add_topic(pub_buf, dst=res_peername_bytes)
-        self.pub.send(topic_data)
-        pub_eof = self.add_topic(b'', dst=res_peername_bytes)
-        self.pub.send(pub_eof)
+        # The body goes in its own frame, so it's never copied
+        self.publish(pub_buf, dst=res_peername_bytes, budget=req_budget)
+        if policy.headers_only:
+            req_budget.skip(len(data))
+        elif data:
+            self.publish(data, dst=res_peername_bytes, budget=req_budget)
+        self.publish(b'', dst=res_peername_bytes, budget=req_budget)
 
         response = self.start_response(client_res.status, message)
 
@@ -192,20 +232,20 @@ class HttpProxyProtocol(aiohttp.server.ServerHttpProtocol,
         response.add_headers(*res_headers)
         response.send_headers()
 
-        topic_data = self.add_topic(pub_buf, src=res_peername_bytes)
-        self.pub.send(topic_data)
+        self.publish(pub_buf, src=res_peername_bytes, budget=res_budget)
 
         orig_stream = client_res.content
 
         def cb(c):
             yield from response.write(c)
-            topic_data = self.add_topic(c, src=res_peername_bytes)
-            self.pub.send(topic_data)
+            if policy.headers_only:
+                res_budget.skip(len(c))
+            else:
+                self.publish(c, src=res_peername_bytes, budget=res_budget)
         yield from aiohttp_read_all(orig_stream, cb)
 
         client_res.close()
-        pub_eof = self.add_topic(b'', src=res_peername_bytes)
-        self.pub.send(pub_eof)
+        self.publish(b'', src=res_peername_bytes, budget=res_budget)
 
         yield from response.write_eof()
         #if response.keep_alive():
@@ -213,6 +253,52 @@ class HttpProxyProtocol(aiohttp.server.ServerHttpProtocol,
         #    self.cleanup_topics()
         self.keep_alive(False)
 
+    def publish(self, data, src=None, dst=None, budget=None):
+        # Subscriptions may come and go while the body is streaming,
+        # so check them for every chunk
+        if self.pub is None or not self.sampled:
+            return
+        topic = self.gen_topic(src=src, dst=dst)
+        if not self.pub.wanted(topic):
+            if budget is not None:
+                budget.count(len(data))
+            return
+        if budget is not None and data:
+            data = budget.take(data)
+            if not data:
+                return
+        if budget is not None and budget.truncated and not data:
+            self.pub.send_notice(topic, 'truncated',
+                                 **budget.notice_fields())
+        self.pub.send(topic, data)
+
+    def sample_flow(self, message):
+        if self.sampler is None:
+            return True
+
+        if message.method == 'CONNECT':
+            match = self.CONNECT_DST_RE.match(message.path)
+            if match:
+                host, port = match.group(1), int(match.group(2))
+            else:
+                host, port = None, None
+            path = None
+        else:
+            url = urllib.parse.urlsplit(
+                self.build_url(message.headers, message.path))
+            host = url.hostname
+            port = url.port or (443 if url.scheme == 'https' else 80)
+            path = url.path or '/'
+
+        return self.sampler.sample(host=host, port=port,
+                                   client_ip=self.peername[0],
+                                   method=message.method, path=path)
+
+    def get_capture_policy(self, host):
+        if self.policies is None:
+            return DEFAULT_CAPTURE_POLICY
+        return self.policies.for_host(host)
+
     @asyncio.coroutine
     def handle_ip_auth_failure(self, message, payload):
         raise aiohttp.HttpErrorException(403)
@@ -241,6 +327,20 @@ class HttpProxyProtocol(aiohttp.server.ServerHttpProtocol,
         else:
             super().data_received(data)
 
+    def pause_writing(self):
+        super().pause_writing()
+        if self.streaming:
+            self.pause_pipe_peers()
+
+    def resume_writing(self):
+        super().resume_writing()
+        if self.streaming:
+            self.resume_pipe_peers()
+
+    def get_write_limits(self):
+        return (self.config['http_proxy'].getint('write_buffer_high'),
+                self.config['http_proxy'].getint('write_buffer_low'))
+
     def close_transport(self):
         super().close_transport()
         if self._request_handler is not None:
@@ -260,6 +360,13 @@ class HttpProxyProtocol(aiohttp.server.ServerHttpProtocol,
             logger.warning('extra_content = %r', extra_content)
         return extra_content
 
+    def new_connector(self):
+        if self.resolver is None:
+            return None
+        # Like aiohttp's default connector, so that upstream sockets
+        # aren't parked in a pool nobody will ever use again
+        return ResolverConnector(self.resolver, force_close=True)
+
     def build_url(self, headers, orig_path):
         if self.SCHEME_RE.match(orig_path):
             return orig_path
@@ -281,8 +388,11 @@ class HttpProxyProtocol(aiohttp.server.ServerHttpProtocol,
                 or host == self.config['http_proxy']['host'].lower():
             return True
 
-        addrinfo_list = yield from getaddrinfo_async(
-            asyncio.get_event_loop(), host, port)
+        if self.resolver is not None:
+            addrinfo_list = yield from self.resolver.getaddrinfo(host, port)
+        else:
+            addrinfo_list = yield from getaddrinfo_async(
+                asyncio.get_event_loop(), host, port)
         local_ips = self.config['http_proxy']['loop_detection_ip'].split(' ')
         for ai in addrinfo_list:
             _af, _socktype, _proto, _canonname, sockaddr = ai
@@ -0,0 +1,548 @@
+import asyncio
+import collections
+import errno
+import json
+import struct
+import zmq
+import aiohttp.websocket
+from .capture import (parse_capture_message, get_bridge_addresses)
+from .bridge import split_replay_topic
+from .websocket import encode_frame
+from .log import logger
+
+
+__all__ = ['HubMessage', 'TriggerIndex', 'ConsoleSendQueue', 'ConsoleHub',
+           'get_console_hub', 'BATCH_RECORD_HEADER',
+           'SEND_OVERFLOW_POLICIES']
+
+
+# Binary frames to the consoles carry batches of capture messages, each
+# prefixed with its length
+BATCH_RECORD_HEADER = struct.Struct('>I')
+
+SEND_OVERFLOW_DROP_OLDEST = 'drop-oldest'
+SEND_OVERFLOW_COLLAPSE = 'collapse'
+SEND_OVERFLOW_DISCONNECT = 'disconnect'
+SEND_OVERFLOW_POLICIES = (SEND_OVERFLOW_DROP_OLDEST, SEND_OVERFLOW_COLLAPSE,
+                          SEND_OVERFLOW_DISCONNECT)
+
+# How much of the first line of a collapsed flow to show the console
+SUMMARY_HEAD_BYTES = 200
+
+
+def split_endpoint(endpoint):
+    """Returns the IP part of `ip:port` or `[ipv6]:port`."""
+    return endpoint.rpartition(b':')[0]
+
+
+class HubMessage(object):
+    """A capture message on its way to the consoles.
+
+    Notices are encoded as the payloads of text frames, and captured
+    data as records to put in batch frames, at most once however many
+    consoles get the message.
+    """
+
+    __slots__ = ('topic', 'data', 'notice', '_encoded')
+
+    def __init__(self, topic, data, notice):
+        self.topic = topic
+        self.data = data
+        self.notice = notice
+        self._encoded = None
+
+    def text(self):
+        """Returns the text frame payload of a notice."""
+        if self._encoded is None:
+            # Notices go out as text frames, so that the console can
+            # tell them apart from the captured data
+            notice = dict(self.notice, topic=self.topic.decode('utf8'))
+            self._encoded = json.dumps(notice).encode('utf8')
+        return self._encoded
+
+    def record(self):
+        """Returns the batch record of captured data."""
+        if self._encoded is None:
+            # The console expects `<topic>:\r\n<data>`
+            self._encoded = b''.join([
+                BATCH_RECORD_HEADER.pack(
+                    len(self.topic) + 3 + len(self.data)),
+                self.topic, b':\r\n', self.data])
+        return self._encoded
+
+
+class FlowTriggers(object):
+    """The triggers a flow matched, and which directions were closed."""
+
+    __slots__ = ('matches', 'closed')
+
+    def __init__(self, matches):
+        # [(console, trigger, peer topic)]
+        self.matches = matches
+        self.closed = [False, False]
+
+
+class TriggerIndex(object):
+    """Matches new flows against the consoles' triggers.
+
+    Triggers are IPs or `ip:port` endpoints. When one end of a flow
+    matches a console's trigger, the console gets a flow_triggered()
+    call, with the other end as the topic to subscribe to, and a
+    flow_closed() call once both directions of the flow are closed.
+    Each flow is evaluated on its first message, and against the
+    triggers added while it goes on. The flows seen are remembered until
+    they close, or up to `max_flows` of them, the oldest being forgotten
+    first. A forgotten flow isn't taken for closed, it's evaluated again
+    if it turns out to be still going.
+    """
+
+    def __init__(self, max_flows=65536):
+        self.max_flows = max_flows
+        # trigger -> set of consoles
+        self.triggers = {}
+        # (endpoint, endpoint), sorted -> FlowTriggers
+        self.flows = collections.OrderedDict()
+        self.evaluated = 0
+        self.matched = 0
+        self.closed = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.triggers)
+
+    def add(self, console, trigger):
+        consoles = self.triggers.get(trigger)
+        if consoles is None:
+            consoles = self.triggers[trigger] = set()
+        elif console in consoles:
+            return
+        consoles.add(console)
+
+        # The flows going on may match the new trigger too, whatever
+        # else they matched
+        for pair, flow in self.flows.items():
+            for endpoint, peer in (pair, pair[::-1]):
+                if trigger not in (split_endpoint(endpoint), endpoint):
+                    continue
+                if not flow.matches:
+                    self.matched += 1
+                flow.matches.append((console, trigger, peer))
+                console.flow_triggered(pair, trigger, peer)
+
+    def remove(self, console, trigger):
+        consoles = self.triggers.get(trigger)
+        if consoles is None:
+            return
+        consoles.discard(console)
+        if not consoles:
+            del self.triggers[trigger]
+
+    def remove_console(self, console):
+        for trigger, consoles in list(self.triggers.items()):
+            if console in consoles:
+                self.remove(console, trigger)
+        for flow in self.flows.values():
+            if flow.matches:
+                flow.matches = [m for m in flow.matches if m[0] is not console]
+
+    def match(self, endpoint, peer, matches):
+        for key in (split_endpoint(endpoint), endpoint):
+            consoles = self.triggers.get(key)
+            if consoles:
+                for console in consoles:
+                    matches.append((console, key, peer))
+
+    def evaluate(self, msg, topic):
+        src, sep, dst = topic.partition(b'-')
+        if not sep:
+            return
+        pair = (src, dst) if src < dst else (dst, src)
+
+        flow = self.flows.get(pair)
+        if flow is None:
+            if not msg.data and msg.notice is None:
+                # Closing a flow we never saw
+                return
+            self.evaluated += 1
+            matches = []
+            self.match(src, dst, matches)
+            self.match(dst, src, matches)
+            flow = self.flows[pair] = FlowTriggers(matches)
+            if len(self.flows) > self.max_flows:
+                # It may well be going on, so the consoles keep their
+                # subscriptions
+                self.flows.popitem(last=False)
+                self.evicted += 1
+            if matches:
+                self.matched += 1
+                for console, trigger, peer in matches:
+                    console.flow_triggered(pair, trigger, peer)
+
+        if not msg.data and msg.notice is None:
+            flow.closed[0 if src == pair[0] else 1] = True
+            if flow.closed[0] and flow.closed[1]:
+                del self.flows[pair]
+                self.closed += 1
+                self.notify_closed(pair, flow)
+
+    def notify_closed(self, pair, flow):
+        for console, _trigger, peer in flow.matches:
+            console.flow_closed(pair, peer)
+
+    def stats(self):
+        return {
+            'triggers': len(self.triggers),
+            'flows': len(self.flows),
+            'evaluated': self.evaluated,
+            'matched': self.matched,
+            'closed': self.closed,
+            'evicted': self.evicted,
+        }
+
+
+class ConsoleSendQueue(object):
+    """The outgoing queue of one console, bounded in bytes.
+
+    A writer task takes the queued messages out in order, batches the
+    captured data into as few frames as possible, and waits for the
+    transport to drain before writing more. When more than `max_bytes`
+    are queued, the `overflow` policy decides what to do: drop the
+    oldest data, collapse all the queued data into a summary per flow,
+    or disconnect the console. End-of-stream markers and notices are
+    never dropped, and the console is told about lost data with a
+    notice sent before the next message of the affected flow.
+
+    Frames are compressed with `deflate`, a PerMessageDeflate, when
+    the console negotiated it.
+    """
+
+    def __init__(self, transport, writer, max_bytes=4194304,
+                 overflow=SEND_OVERFLOW_DROP_OLDEST, batch_bytes=262144,
+                 deflate=None, loop=None):
+        if overflow not in SEND_OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.transport = transport
+        self.writer = writer
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.batch_bytes = batch_bytes
+        self.deflate = deflate
+
+        # (topic, payload, is a notice, droppable), in sending order.
+        # Notices are queued as text payloads, and captured data as
+        # batch records.
+        self.entries = collections.deque()
+        self.queued_bytes = 0
+        self.peak_bytes = 0
+        self.waiter = None
+        self.closed = False
+        # topic -> [messages, bytes, head], reset when a notice is sent
+        self.flow_drops = {}
+        self.dropped_messages = 0
+        self.dropped_bytes = 0
+        self.overflows = 0
+        self.sent_bytes = 0
+        self.wire_bytes = 0
+        self.task = asyncio.Task(self.run(), loop=loop)
+
+    def put(self, msg):
+        if self.closed:
+            return
+        if msg.notice is not None:
+            entry = (msg.topic, msg.text(), True, False)
+        else:
+            entry = (msg.topic, msg.record(), False, bool(msg.data))
+        size = len(entry[1])
+
+        if entry[3] and self.queued_bytes + size > self.max_bytes:
+            self.overflows += 1
+            if self.overflow == SEND_OVERFLOW_DISCONNECT:
+                logger.warning('Console send queue overflow, disconnecting')
+                self.close()
+                self.transport.close()
+                return
+            elif self.overflow == SEND_OVERFLOW_COLLAPSE:
+                self.collapse()
+
+        self.entries.append(entry)
+        self.queued_bytes += size
+
+        if self.overflow == SEND_OVERFLOW_DROP_OLDEST:
+            kept = []
+            while self.queued_bytes > self.max_bytes and self.entries:
+                entry = self.entries.popleft()
+                if entry[3]:
+                    self.queued_bytes -= len(entry[1])
+                    self.drop(entry)
+                else:
+                    kept.append(entry)
+            self.entries.extendleft(reversed(kept))
+
+        self.peak_bytes = max(self.peak_bytes, self.queued_bytes)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def collapse(self):
+        kept = collections.deque()
+        for entry in self.entries:
+            if entry[3]:
+                self.queued_bytes -= len(entry[1])
+                self.drop(entry, summary=True)
+            else:
+                kept.append(entry)
+        self.entries = kept
+
+    def drop(self, entry, summary=False):
+        topic, record = entry[0], entry[1]
+        size = len(record) - BATCH_RECORD_HEADER.size - len(topic) - 3
+        self.dropped_messages += 1
+        self.dropped_bytes += size
+        drops = self.flow_drops.get(topic)
+        if drops is None:
+            drops = self.flow_drops[topic] = [0, 0, None]
+        drops[0] += 1
+        drops[1] += size
+        if summary and drops[2] is None:
+            start = len(record) - size
+            head = record[start:(start + SUMMARY_HEAD_BYTES)]
+            drops[2] = head.split(b'\r\n', 1)[0].decode('utf8', 'replace')
+
+    def drop_message(self, msg):
+        """Counts the captured data in `msg` as dropped before it was
+        queued, so that the console hears about it all the same.
+        """
+        self.drop((msg.topic, msg.record()))
+
+    def drop_notice(self, topic):
+        drops = self.flow_drops.pop(topic, None)
+        if drops is None:
+            return None
+        notice = {'notice': 'dropped', 'topic': topic.decode('utf8'),
+                  'messages': drops[0], 'bytes': drops[1],
+                  'reason': 'slow-console'}
+        if drops[2] is not None:
+            notice['head'] = drops[2]
+        return json.dumps(notice, sort_keys=True).encode('utf8')
+
+    def write(self, payload, opcode=aiohttp.websocket.OPCODE_BINARY):
+        if self.deflate is not None:
+            frame = self.deflate.encode_frame(payload, opcode)
+        else:
+            frame = encode_frame(payload, opcode)
+        self.sent_bytes += len(payload)
+        self.wire_bytes += len(frame)
+        self.transport.write(frame)
+
+    @asyncio.coroutine
+    def run(self):
+        while not self.closed:
+            if not self.entries:
+                self.waiter = asyncio.Future(loop=self.loop)
+                yield from self.waiter
+                continue
+
+            records = []
+            size = 0
+            while self.entries and size < self.batch_bytes:
+                topic, payload, is_notice, _droppable = \
+                    self.entries.popleft()
+                self.queued_bytes -= len(payload)
+                notice = self.drop_notice(topic) if self.flow_drops else None
+                if notice is not None or is_notice:
+                    if records:
+                        self.write(b''.join(records))
+                        records = []
+                        size = 0
+                    if notice is not None:
+                        self.write(notice, aiohttp.websocket.OPCODE_TEXT)
+                    if is_notice:
+                        self.write(payload, aiohttp.websocket.OPCODE_TEXT)
+                        continue
+                records.append(payload)
+                size += len(payload)
+            if records:
+                self.write(b''.join(records))
+
+            try:
+                yield from self.writer.drain()
+            except ConnectionError:
+                break
+
+    def close(self):
+        self.closed = True
+        self.entries.clear()
+        self.queued_bytes = 0
+        self.flow_drops.clear()
+        if not self.task.done():
+            self.task.cancel()
+
+    def stats(self):
+        return {
+            'bytes': self.queued_bytes,
+            'peak_bytes': self.peak_bytes,
+            'dropped_messages': self.dropped_messages,
+            'dropped_bytes': self.dropped_bytes,
+            'overflows': self.overflows,
+            'sent_bytes': self.sent_bytes,
+            'wire_bytes': self.wire_bytes,
+        }
+
+
+class ConsoleHub(object):
+    """One SUB socket per HTTP worker, shared by all the consoles.
+
+    Consoles subscribe to topic prefixes here instead of on their own
+    sockets. Every message is received once, checked against the
+    consoles' triggers, and handed to each matching console's
+    hub_deliver(), as a HubMessage.
+    """
+
+    def __init__(self, trigger_max_flows=65536, batch_messages=256,
+                 loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        # Don't hog the event loop when the bridge is busy
+        self.batch_messages = batch_messages
+        ctx = zmq.Context.instance()
+        self.sock = ctx.socket(zmq.SUB)
+        # prefix -> set of consoles
+        self.subscribers = {}
+        # prefix length -> number of prefixes that long
+        self.prefix_lengths = collections.Counter()
+        self.triggers = TriggerIndex(trigger_max_flows)
+        self.received = 0
+        self.connected = None
+
+    @asyncio.coroutine
+    def connect(self, addresses):
+        # With a sharded bridge, connect to every shard, and the SUB
+        # socket merges the streams
+        for address in addresses:
+            yield from self.loop.run_in_executor(
+                None, self.sock.connect, address)
+        self.loop.add_reader(self.sock, self.read_ready)
+
+    def subscribe(self, console, prefix):
+        consoles = self.subscribers.get(prefix)
+        if consoles is None:
+            consoles = self.subscribers[prefix] = set()
+            self.prefix_lengths[len(prefix)] += 1
+            self.sock.setsockopt(zmq.SUBSCRIBE, prefix)
+        consoles.add(console)
+
+    def unsubscribe(self, console, prefix):
+        consoles = self.subscribers.get(prefix)
+        if consoles is None:
+            return
+        consoles.discard(console)
+        if not consoles:
+            del self.subscribers[prefix]
+            self.prefix_lengths[len(prefix)] -= 1
+            if self.prefix_lengths[len(prefix)] <= 0:
+                del self.prefix_lengths[len(prefix)]
+            self.sock.setsockopt(zmq.UNSUBSCRIBE, prefix)
+
+    def remove(self, console):
+        self.triggers.remove_console(console)
+        for prefix, consoles in list(self.subscribers.items()):
+            if console in consoles:
+                self.unsubscribe(console, prefix)
+
+    def consoles_for(self, topic):
+        """Returns the consoles subscribed to any prefix of `topic`."""
+        matched = None
+        for length in self.prefix_lengths:
+            consoles = self.subscribers.get(topic[:length])
+            if consoles:
+                if matched is None:
+                    matched = set(consoles)
+                else:
+                    matched.update(consoles)
+        return matched or ()
+
+    def read_ready(self):
+        for _ in range(self.batch_messages):
+            try:
+                frames = self.sock.recv_multipart(flags=zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise e
+            self.received += 1
+            topic, data, notice = parse_capture_message(frames)
+            msg = HubMessage(topic, data, notice)
+            if self.triggers:
+                # Replayed flows may fire triggers too
+                replay = split_replay_topic(topic)
+                try:
+                    self.triggers.evaluate(
+                        msg, topic if replay is None else replay[1])
+                except Exception:
+                    logger.exception('Failed to evaluate triggers for %r',
+                                     topic)
+            for console in self.consoles_for(topic):
+                try:
+                    console.hub_deliver(msg)
+                except Exception:
+                    logger.exception('Failed to deliver to console %r',
+                                     console)
+        else:
+            # Read at most `batch_messages` in one go, so that the
+            # consoles' writers and other callbacks get to run, and come
+            # back for the rest in the next loop iteration
+            self.loop.call_soon(self.read_ready)
+
+    def stats(self):
+        consoles = set().union(*self.subscribers.values())
+        queues = [c.send_queue.stats() for c in consoles]
+        filters = [c.flow_filter.stats() for c in consoles]
+        return {
+            'received': self.received,
+            'prefixes': len(self.subscribers),
+            'consoles': len(consoles),
+            'triggers': self.triggers.stats(),
+            'send_queues': {
+                'bytes': sum(q['bytes'] for q in queues),
+                'max_bytes': max([q['bytes'] for q in queues] or [0]),
+                'dropped_messages':
+                    sum(q['dropped_messages'] for q in queues),
+                'overflows': sum(q['overflows'] for q in queues),
+                'sent_bytes': sum(q['sent_bytes'] for q in queues),
+                'wire_bytes': sum(q['wire_bytes'] for q in queues),
+            },
+            'filters': {
+                key: sum(f[key] for f in filters)
+                for key in ('flows', 'passed', 'rejected', 'overflowed',
+                            'dropped_messages', 'dropped_bytes')
+            },
+        }
+
+    @asyncio.coroutine
+    def log_stats_loop(self, interval):
+        while True:
+            yield from asyncio.sleep(interval)
+            logger.info('Console hub stats: %r', self.stats())
+
+
+_console_hub = None
+
+
+@asyncio.coroutine
+def get_console_hub(config):
+    """Returns the hub of this worker, starting it on first use."""
+    global _console_hub
+    if _console_hub is None:
+        hconfig = config['http']
+        _console_hub = ConsoleHub(hconfig.getint('trigger_max_flows'),
+                                  hconfig.getint('ws_batch_messages'))
+        _console_hub.connected = asyncio.Task(_console_hub.connect(
+            get_bridge_addresses(config, 'xpub_address')))
+        interval = hconfig.getfloat('hub_stats_interval')
+        if interval > 0:
+            asyncio.Task(_console_hub.log_stats_loop(interval))
+    yield from _console_hub.connected
+    return _console_hub
@@ -1,5 +1,9 @@
 import socket
 import asyncio
+import collections
+import random
+import struct
+import time
 try:
     import ssl
 except ImportError:
@@ -34,6 +38,478 @@ def getaddrinfo_async(loop, host, port, flags=0):
     return addr_infos
 
 
+def is_ip_address(host):
+    for af in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(af, host)
+            return af
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+def make_sockaddr(af, ip, port):
+    if af == socket.AF_INET6:
+        return (ip, port, 0, 0)
+    else:
+        return (ip, port)
+
+
+# DNS message constants, see RFC 1035
+DNS_QTYPE_A = 1
+DNS_QTYPE_AAAA = 28
+DNS_QCLASS_IN = 1
+DNS_RCODE_NXDOMAIN = 3
+DNS_HEADER = struct.Struct('!HHHHHH')
+DNS_RR_HEADER = struct.Struct('!HHIH')
+DNS_QUESTION_TAIL = struct.Struct('!HH')
+
+
+def read_resolv_conf(fname='/etc/resolv.conf'):
+    nameservers = []
+    try:
+        with open(fname) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    nameservers.append(fields[1])
+    except OSError:
+        pass
+    return nameservers
+
+
+class _DnsQueryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, future, query_id):
+        self.future = future
+        self.query_id = query_id
+
+    def datagram_received(self, data, addr):
+        if len(data) < DNS_HEADER.size or self.future.done():
+            return
+        if DNS_HEADER.unpack_from(data)[0] != self.query_id:
+            # Not ours, probably a late answer or a spoofing attempt
+            return
+        self.future.set_result(data)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class DnsClient(object):
+    """A minimal non-threaded DNS client, A and AAAA queries over UDP.
+
+    Unlike getaddrinfo(3) it tells us the record TTLs, so the resolver
+    cache can honour them.
+    """
+
+    def __init__(self, nameservers, loop=None, timeout=2.0, retries=2):
+        if not nameservers:
+            raise RuntimeError('No nameservers configured')
+        self.nameservers = nameservers
+        self.timeout = timeout
+        self.retries = retries
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+
+    @asyncio.coroutine
+    def resolve(self, host):
+        """Returns a list of (af, ip) pairs and the TTL of the result."""
+        results = yield from asyncio.gather(
+            self.query(host, DNS_QTYPE_AAAA),
+            self.query(host, DNS_QTYPE_A),
+            return_exceptions=True)
+
+        addrs = []
+        ttl = None
+        errors = []
+        for res in results:
+            if isinstance(res, Exception):
+                errors.append(res)
+                continue
+            res_addrs, res_ttl = res
+            addrs.extend(res_addrs)
+            if res_ttl is not None:
+                ttl = res_ttl if ttl is None else min(ttl, res_ttl)
+
+        if not addrs:
+            if errors:
+                raise errors[0]
+            raise socket.gaierror(socket.EAI_NONAME,
+                                  'No address associated with hostname')
+        return (addrs, ttl)
+
+    @asyncio.coroutine
+    def query(self, host, qtype):
+        exc = None
+        for i in range(self.retries + 1):
+            ns = self.nameservers[i % len(self.nameservers)]
+            try:
+                answer = yield from self.send_query(ns, host, qtype)
+                return self.parse_answer(answer, qtype)
+            except (asyncio.TimeoutError, OSError) as e:
+                if isinstance(e, socket.gaierror) \
+                        and e.errno != socket.EAI_AGAIN:
+                    raise
+                exc = e
+        raise socket.gaierror(socket.EAI_AGAIN,
+                              'DNS query failed: {!r}'.format(exc))
+
+    @asyncio.coroutine
+    def send_query(self, nameserver, host, qtype):
+        query_id = random.randint(0, 0xffff)
+        future = asyncio.Future(loop=self.loop)
+        transport, _proto = yield from self.loop.create_datagram_endpoint(
+            lambda: _DnsQueryProtocol(future, query_id),
+            remote_addr=(nameserver, 53))
+        try:
+            transport.sendto(self.build_query(query_id, host, qtype))
+            answer = yield from asyncio.wait_for(
+                future, self.timeout)
+        finally:
+            transport.close()
+        return answer
+
+    def build_query(self, query_id, host, qtype):
+        buf = bytearray(DNS_HEADER.pack(query_id, 0x0100, 1, 0, 0, 0))
+        for label in host.encode('idna').split(b'.'):
+            if label:
+                buf.append(len(label))
+                buf.extend(label)
+        buf.append(0)
+        buf.extend(DNS_QUESTION_TAIL.pack(qtype, DNS_QCLASS_IN))
+        return bytes(buf)
+
+    def skip_name(self, data, offset):
+        while True:
+            length = data[offset]
+            if length & 0xc0 == 0xc0:   # compression pointer
+                return offset + 2
+            offset += 1
+            if length == 0:
+                return offset
+            offset += length
+
+    def parse_answer(self, data, qtype):
+        try:
+            _qid, flags, qdcount, ancount, _nscount, _arcount = \
+                DNS_HEADER.unpack_from(data)
+            rcode = flags & 0x0f
+            if rcode == DNS_RCODE_NXDOMAIN:
+                raise socket.gaierror(socket.EAI_NONAME,
+                                      'Name or service not known')
+            elif rcode != 0 or flags & 0x0200:  # error or truncated
+                raise socket.gaierror(socket.EAI_AGAIN,
+                                      'DNS server error {}'.format(rcode))
+
+            offset = DNS_HEADER.size
+            for _ in range(qdcount):
+                offset = self.skip_name(data, offset) + DNS_QUESTION_TAIL.size
+
+            addrs = []
+            ttl = None
+            for _ in range(ancount):
+                offset = self.skip_name(data, offset)
+                rtype, rclass, rttl, rdlength = \
+                    DNS_RR_HEADER.unpack_from(data, offset)
+                offset += DNS_RR_HEADER.size
+                rdata = data[offset:(offset + rdlength)]
+                offset += rdlength
+
+                if rclass != DNS_QCLASS_IN or rtype != qtype:
+                    continue    # CNAMEs etc.
+                if rtype == DNS_QTYPE_A and rdlength == 4:
+                    addrs.append((socket.AF_INET,
+                                  socket.inet_ntop(socket.AF_INET, rdata)))
+                elif rtype == DNS_QTYPE_AAAA and rdlength == 16:
+                    addrs.append((socket.AF_INET6,
+                                  socket.inet_ntop(socket.AF_INET6, rdata)))
+                else:
+                    continue
+                ttl = rttl if ttl is None else min(ttl, rttl)
+        except (IndexError, struct.error):
+            raise socket.gaierror(socket.EAI_AGAIN, 'Malformed DNS answer')
+
+        return (addrs, ttl)
+
+
+class Resolver(object):
+    """Caching name resolver, one per worker process.
+
+    Both successful and failed lookups are cached, and concurrent
+    lookups for the same name share a single query.
+    """
+
+    def __init__(self, loop=None, dns_client=None, positive_ttl=300,
+                 negative_ttl=30, max_entries=4096):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.dns_client = dns_client
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+
+        # host -> (expire time, [(af, ip), ...] or exception)
+        self.cache = collections.OrderedDict()
+        # host -> Task
+        self.inflight = {}
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'entries': len(self.cache),
+        }
+
+    @asyncio.coroutine
+    def log_stats_loop(self, interval):
+        while True:
+            yield from asyncio.sleep(interval)
+            logger.info('Resolver stats: %r', self.stats())
+
+    @asyncio.coroutine
+    def getaddrinfo(self, host, port, flags=0):
+        """Drop-in replacement for `getaddrinfo_async`"""
+        if host == '*' or host is None or (flags & socket.AI_PASSIVE):
+            addr_infos = yield from \
+                getaddrinfo_async(self.loop, host, port, flags)
+            return addr_infos
+
+        af = is_ip_address(host)
+        if af is not None:
+            addrs = [(af, host)]
+        else:
+            addrs = yield from self.lookup(host)
+
+        return [(af, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+                 make_sockaddr(af, ip, port))
+                for af, ip in addrs]
+
+    @asyncio.coroutine
+    def lookup(self, host):
+        host = host.lower()
+        entry = self.cache.get(host)
+        if entry is not None:
+            expires, result = entry
+            if expires > self.loop.time():
+                self.cache.move_to_end(host)
+                if isinstance(result, Exception):
+                    self.negative_hits += 1
+                    raise result
+                self.hits += 1
+                return result
+            del self.cache[host]
+
+        task = self.inflight.get(host)
+        if task is None:
+            self.misses += 1
+            task = asyncio.Task(self.query(host), loop=self.loop)
+            task.add_done_callback(
+                lambda t: self.query_done(host, t))
+            self.inflight[host] = task
+        else:
+            self.coalesced += 1
+
+        # Don't let an impatient caller cancel the query for everyone
+        addrs, _ttl = yield from asyncio.shield(task)
+        return addrs
+
+    @asyncio.coroutine
+    def query(self, host):
+        if self.dns_client is not None:
+            addrs, ttl = yield from self.dns_client.resolve(host)
+            if ttl is None or ttl > self.positive_ttl:
+                ttl = self.positive_ttl
+            return (addrs, ttl)
+
+        addr_infos = yield from getaddrinfo_async(self.loop, host, None)
+        addrs = []
+        for af, _socktype, _proto, _canonname, sockaddr in addr_infos:
+            if (af, sockaddr[0]) not in addrs:
+                addrs.append((af, sockaddr[0]))
+        return (addrs, self.positive_ttl)
+
+    def query_done(self, host, task):
+        del self.inflight[host]
+        if task.cancelled():
+            return
+
+        exc = task.exception()
+        if exc is None:
+            addrs, ttl = task.result()
+            self.store(host, ttl, addrs)
+        elif isinstance(exc, socket.gaierror) \
+                and exc.errno != socket.EAI_AGAIN:
+            self.store(host, self.negative_ttl, exc)
+
+    def store(self, host, ttl, result):
+        if ttl <= 0:
+            return
+        self.cache[host] = (self.loop.time() + ttl, result)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+
+def create_resolver(config, loop=None):
+    rconfig = config['resolver']
+    if rconfig['backend'] == 'udp':
+        nameservers = rconfig['nameservers'].split()
+        if not nameservers:
+            nameservers = read_resolv_conf()
+        dns_client = DnsClient(nameservers, loop=loop,
+                               timeout=rconfig.getfloat('timeout'))
+    else:
+        dns_client = None
+
+    return Resolver(loop=loop, dns_client=dns_client,
+                    positive_ttl=rconfig.getint('positive_ttl'),
+                    negative_ttl=rconfig.getint('negative_ttl'),
+                    max_entries=rconfig.getint('max_entries'))
+
+
+# RFC 8305, section 5 recommends 250ms
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+
+def interleave_addr_infos(addr_infos):
+    """Alternates between address families, as described in RFC 8305,
+    section 4. The family of the first address goes first.
+    """
+    by_family = collections.OrderedDict()
+    for ai in addr_infos:
+        by_family.setdefault(ai[0], []).append(ai)
+
+    queues = list(by_family.values())
+    interleaved = []
+    while queues:
+        for q in queues:
+            interleaved.append(q.pop(0))
+        queues = [q for q in queues if q]
+    return interleaved
+
+
+class ConnectAttempt(object):
+    def __init__(self, sockaddr):
+        self.sockaddr = sockaddr
+        self.started = time.monotonic()
+        self.elapsed = None
+        self.result = None
+        self.error = None
+
+    def finish(self, result, error=None):
+        self.elapsed = time.monotonic() - self.started
+        self.result = result
+        self.error = error
+
+    def __repr__(self):
+        if self.elapsed is None:
+            return '<ConnectAttempt {!r} pending>'.format(self.sockaddr)
+        return '<ConnectAttempt {!r} {} in {:.3f}s{}>'.format(
+            self.sockaddr, self.result, self.elapsed,
+            '' if self.error is None else ', error = {!r}'.format(self.error))
+
+
+class ConnectionRacer(object):
+    """Happy Eyeballs connection establishment (RFC 8305).
+
+    Attempts are started one after another, `attempt_delay` seconds
+    apart, or as soon as the previous one fails. The first connection
+    made wins and the other attempts are cancelled. Timings of all the
+    attempts are kept in `attempts`.
+    """
+
+    def __init__(self, proto_factory, addr_infos, loop=None,
+                 attempt_delay=CONNECTION_ATTEMPT_DELAY):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.proto_factory = proto_factory
+        self.addr_infos = interleave_addr_infos(addr_infos)
+        self.attempt_delay = attempt_delay
+        self.attempts = []
+
+    @asyncio.coroutine
+    def connect(self):
+        if not self.addr_infos:
+            raise OSError('No address to connect to')
+
+        winner = None
+        exc = None
+        pending = set()
+        next_idx = 0
+        try:
+            while winner is None \
+                    and (next_idx < len(self.addr_infos) or pending):
+                if next_idx < len(self.addr_infos):
+                    pending.add(asyncio.Task(
+                        self.attempt(self.addr_infos[next_idx]),
+                        loop=self.loop))
+                    next_idx += 1
+                    if next_idx < len(self.addr_infos):
+                        timeout = self.attempt_delay
+                    else:
+                        timeout = None
+                else:
+                    timeout = None
+
+                done, pending = yield from asyncio.wait(
+                    pending, timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        exc = task.exception()
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        # Lost the race by a hair
+                        task.result()[0].close()
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(self.close_late_winner)
+
+        if winner is None:
+            raise exc
+        return winner
+
+    def close_late_winner(self, task):
+        if not task.cancelled() and task.exception() is None:
+            task.result()[0].close()
+
+    @asyncio.coroutine
+    def attempt(self, addr_info):
+        af, socktype, proto, _canonname, sockaddr = addr_info
+        record = ConnectAttempt(sockaddr)
+        self.attempts.append(record)
+
+        sock = socket.socket(family=af, type=socktype, proto=proto)
+        try:
+            sock.setblocking(False)
+            yield from self.loop.sock_connect(sock, sockaddr)
+            transport, protocol = yield from \
+                self.loop.create_connection(self.proto_factory, sock=sock)
+        except asyncio.CancelledError:
+            sock.close()
+            record.finish('cancelled')
+            raise
+        except Exception as e:
+            sock.close()
+            record.finish('failed', e)
+            raise
+
+        record.finish('connected')
+        return (transport, protocol)
+
+
 def create_listen_sockets(host, port, backlog):
     # Most of these code ripped from
     # asyncio.base_events.BaseEventLoop.create_server
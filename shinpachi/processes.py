@@ -8,8 +8,17 @@ from .proxy import SocksServerProtocol
 from .http_proxy import HttpProxyProtocol
 from .http_base import (scan_handlers, StaticPathHandler)
 from .http import HttpProtocol
+from .capture import (create_capture_publisher, create_capture_policies,
+                      get_bridge_address, get_bridge_addresses)
 from .io import (install_zmq_event_loop, get_redis_async_connection)
-from .network import create_ssl_context
+from .network import (create_ssl_context, create_resolver)
+from .splice import SPLICE_AVAILABLE
+from .sampling import create_flow_sampler
+from .shmring import get_bridge_ring
+from .bridge import (Bridge, CaptureHistory)
+from .store import (Recorder, create_capture_store)
+from .flowindex import FlowIndex
+from .search import (SearchIndex, Searcher)
 from .log import logger
 
 
@@ -20,19 +29,55 @@ def init_redis_connection(config):
     return get_redis_async_connection(redis_host, redis_port, redis_pool_size)
 
 
+def check_splice_relay(config, name):
+    if not config[name].getboolean('splice_relay'):
+        return False
+    if not SPLICE_AVAILABLE:
+        logger.warning('splice(2) relaying is not available on this system')
+        return False
+    return True
+
+
+def init_resolver(config):
+    resolver = create_resolver(config)
+    interval = config['resolver'].getfloat('stats_interval')
+    if interval > 0:
+        asyncio.Task(resolver.log_stats_loop(interval))
+    return resolver
+
+
+def init_flow_sampler(config, redis=None):
+    sampler = create_flow_sampler(config)
+    interval = config['sampling'].getfloat('stats_interval')
+    if sampler is not None and interval > 0:
+        if redis is None:
+            # The counters go to Redis, for /stats.json
+            redis = init_redis_connection(config)
+        asyncio.Task(sampler.log_stats_loop(interval, redis))
+    return sampler
+
+
 def proxy_worker(listen_socks, config):
     me = multiprocessing.process.current_process()
     logger.info('Proxy worker %d started on sockets %r',
                 me.pid, listen_socks)
 
-    ctx = zmq.Context.instance()
-    pub = ctx.socket(zmq.PUB)
-    pub.connect(config['bridge']['xsub_address'])
-
+    install_zmq_event_loop()
     loop = asyncio.get_event_loop()
 
+    pub = create_capture_publisher(config)
+    policies = create_capture_policies(config)
+    sampler = init_flow_sampler(config)
+
+    write_limits = (config['proxy'].getint('write_buffer_high'),
+                    config['proxy'].getint('write_buffer_low'))
+    splice = check_splice_relay(config, 'proxy')
+    resolver = init_resolver(config)
+
     def proto_factory():
-        return SocksServerProtocol(pub=pub)
+        return SocksServerProtocol(pub=pub, write_limits=write_limits,
+                                   splice=splice, resolver=resolver,
+                                   policies=policies, sampler=sampler)
 
     for sock in listen_socks:
         server = loop.create_server(proto_factory, sock=sock)
@@ -46,18 +91,23 @@ def http_proxy_worker(listen_socks, config):
     logger.info('HTTP proxy worker %d started on sockets %r',
                 me.pid, listen_socks)
 
+    install_zmq_event_loop()
     loop = asyncio.get_event_loop()
 
-    # ZeroMQ stuff
-    ctx = zmq.Context.instance()
-    pub = ctx.socket(zmq.PUB)
-    pub.connect(config['bridge']['xsub_address'])
-
     # Redis stuff
     redis = init_redis_connection(config)
 
+    # ZeroMQ stuff
+    pub = create_capture_publisher(config)
+    policies = create_capture_policies(config)
+    sampler = init_flow_sampler(config, redis)
+
+    splice = check_splice_relay(config, 'http_proxy')
+    resolver = init_resolver(config)
+
     def proto_factory():
-        return HttpProxyProtocol(config, redis, pub)
+        return HttpProxyProtocol(config, redis, pub, resolver,
+                                 policies, sampler, splice=splice)
 
     for sock in listen_socks:
         server = loop.create_server(proto_factory, sock=sock)
@@ -93,9 +143,11 @@ def http_worker(listen_socks, config):
     # Redis stuff
     redis = init_redis_connection(config)
 
+    resolver = init_resolver(config)
+
     def proto_factory():
         return HttpProtocol(
-            matcher, tmpl_env, res_mgr, res_provider, redis, config)
+            matcher, tmpl_env, res_mgr, res_provider, redis, config, resolver)
 
     for sock in listen_socks:
         server = loop.create_server(proto_factory, sock=sock, ssl=sslcontext)
@@ -104,26 +156,120 @@ def http_worker(listen_socks, config):
     loop.run_forever()
 
 
-def bridge_worker(config):
-    ctx = zmq.Context.instance()
+def bridge_worker(config, shard=0):
+    me = multiprocessing.process.current_process()
+    logger.info('Bridge worker %d started for shard %d', me.pid, shard)
 
-    xsub_address = config['bridge']['xsub_address']
-    xsub_sock = ctx.socket(zmq.XSUB)
-    xsub_sock.bind(xsub_address)
+    ctx = zmq.Context.instance()
 
-    xpub_address = config['bridge']['xpub_address']
+    xpub_address = get_bridge_address(config, 'xpub_address', shard)
     xpub_sock = ctx.socket(zmq.XPUB)
     xpub_sock.bind(xpub_address)
 
-    pub_address = config['bridge']['pub_address']
+    pub_address = get_bridge_address(config, 'pub_address', shard)
     pub_sock = ctx.socket(zmq.PUB)
     pub_sock.bind(pub_address)
 
-    logger.debug('xsub_address = %r', xsub_address)
     logger.debug('xpub_address = %r', xpub_address)
     logger.debug('pub_address = %r', pub_address)
 
-    zmq.proxy(xpub_sock, xsub_sock, pub_sock)
+    bconfig = config['bridge']
+    history_bytes = bconfig.getint('history_bytes')
+    if history_bytes > 0:
+        history = CaptureHistory(
+            history_bytes, bconfig.getfloat('history_max_age') or None)
+    else:
+        history = None
+    bridge = Bridge(xpub_sock, pub_sock, history,
+                    replay_age=bconfig.getfloat('replay_seconds') or None,
+                    replay_bytes=bconfig.getint('replay_bytes') or None,
+                    stats_interval=bconfig.getfloat('stats_interval'),
+                    subscribe_all=config['store'].getboolean('enabled'))
+
+    if bconfig['transport'] == 'shm':
+        control_address = get_bridge_address(config, 'control_address', shard)
+        control_sock = ctx.socket(zmq.PUB)
+        control_sock.bind(control_address)
+        logger.debug('control_address = %r', control_address)
+
+        bridge.run_ring(get_bridge_ring(shard), control_sock)
+    else:
+        xsub_address = get_bridge_address(config, 'xsub_address', shard)
+        xsub_sock = ctx.socket(zmq.XSUB)
+        xsub_sock.bind(xsub_address)
+        logger.debug('xsub_address = %r', xsub_address)
+
+        if not bridge.subscribe_all:
+            zmq.proxy(xpub_sock, xsub_sock, pub_sock)
+        else:
+            bridge.run_zmq(xsub_sock)
+
+
+def recorder_worker(config):
+    me = multiprocessing.process.current_process()
+    logger.info('Recorder worker %d started', me.pid)
+
+    store = create_capture_store(config)
+    logger.info('Recording to %r', store.path)
+
+    ctx = zmq.Context.instance()
+    sub_sock = ctx.socket(zmq.SUB)
+    for pub_address in get_bridge_addresses(config, 'pub_address'):
+        sub_sock.connect(pub_address)
+        logger.debug('pub_address = %r', pub_address)
+    sub_sock.setsockopt(zmq.SUBSCRIBE, b'')
+
+    sconfig = config['store']
+    index = FlowIndex(sconfig.getint('index_max_flows'))
+    index.rebuild(store)
+
+    query_sock = ctx.socket(zmq.REP)
+    query_sock.bind(sconfig['query_address'])
+    logger.debug('query_address = %r', sconfig['query_address'])
+
+    if config['search'].getboolean('enabled'):
+        feed_sock = ctx.socket(zmq.PUSH)
+        feed_sock.setsockopt(zmq.SNDHWM, config['search'].getint('feed_hwm'))
+        feed_sock.connect(config['search']['feed_address'])
+    else:
+        feed_sock = None
+
+    recorder = Recorder(store, index,
+                        flush_interval=sconfig.getfloat('flush_interval'),
+                        stats_interval=sconfig.getfloat('stats_interval'),
+                        feed_sock=feed_sock)
+    recorder.run(sub_sock, query_sock)
+
+
+def search_worker(config):
+    me = multiprocessing.process.current_process()
+    logger.info('Search worker %d started', me.pid)
+
+    sconfig = config['search']
+    index = SearchIndex(
+        sconfig.getint('max_bytes'),
+        generations=sconfig.getint('generations'),
+        max_bytes_per_flow=sconfig.getint('max_bytes_per_flow'))
+
+    ctx = zmq.Context.instance()
+    feed_sock = ctx.socket(zmq.PULL)
+    feed_sock.setsockopt(zmq.RCVHWM, sconfig.getint('feed_hwm'))
+    feed_sock.bind(sconfig['feed_address'])
+    query_sock = ctx.socket(zmq.REP)
+    query_sock.bind(sconfig['query_address'])
+    logger.debug('feed_address = %r', sconfig['feed_address'])
+    logger.debug('query_address = %r', sconfig['query_address'])
+
+    searcher = Searcher(index,
+                        stats_interval=sconfig.getfloat('stats_interval'))
+    searcher.run(feed_sock, query_sock)
+
+
+def spawn_bridge_workers(config):
+    workers = []
+    for shard in range(config['bridge'].getint('shards')):
+        workers.extend(spawn_workers(bridge_worker, (config, shard), 1))
+    return workers
 
 
 def spawn_workers(target, args, nr):
@@ -166,4 +312,6 @@ PROCESS_WORKERS = {
     'http_proxy': http_proxy_worker,
     'http': http_worker,
     'bridge': bridge_worker,
+    'recorder': recorder_worker,
+    'search': search_worker,
 }
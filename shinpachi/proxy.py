@@ -1,15 +1,18 @@
-import itertools
 import asyncio
-import errno
 import socket
 import re
-import zmq
+from .socks import (Socks5Handshake, SocksError,
+                    MethodRequest, METHOD_NO_AUTH, METHOD_NO_ACCEPTABLE,
+                    REP_SUCCEEDED, build_method_reply, build_reply,
+                    reply_for_exception)
+from .splice import SpliceRelay
+from .capture import CaptureBudget
+from .network import (getaddrinfo_async, ConnectionRacer)
 from .log import logger
 
 
 # TODO:
 #   * Write tests
-#   * Move protocol parsing code to another module
 
 
 def get_peername_bytes(peername):
@@ -27,14 +30,35 @@ class ProtocolError(Exception):
 
 
 class ProxyPipe(object):
-    def __init__(self, *eps, pub=None):
+    def __init__(self, *eps, pub=None, write_limits=None, splice=False,
+                 policy=None):
         for ep in eps:
             if ep.get_pipe() is not None:
                 raise RuntimeError('Endpoint already configured')
             ep.set_pipe(self)
         self.endpoints = eps
         self.pub = pub
-        self.ep_topics = {}
+        # ep -> (subscription generation, capture wanted)
+        self.ep_wanted = {}
+        self.closed = False
+        # ep -> CaptureBudget, for the data coming from ep
+        self.budgets = {}
+        if policy is not None and policy.max_bytes > 0:
+            for ep in eps:
+                self.budgets[ep] = CaptureBudget(policy.max_bytes)
+
+        if write_limits is not None:
+            high, low = write_limits
+            for ep in eps:
+                ep.transport.set_write_buffer_limits(high=high, low=low)
+
+        self.splice = splice and len(eps) == 2
+        self.splicer = None
+        if self.splice:
+            if self.pub is not None:
+                self.pub.add_watcher(self)
+            # Let the handshake replies go out first
+            asyncio.get_event_loop().call_soon(self.update_relay_mode)
 
     def get_ep_topics(self, ep):
         for dst_ep in self.endpoints[:]:
@@ -42,18 +66,45 @@ class ProxyPipe(object):
                 continue
             yield ep.gen_topic(dst=dst_ep.peername_bytes)
 
+    def capture_wanted(self, ep):
+        generation = self.pub.generation
+        cached = self.ep_wanted.get(ep)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+
+        wanted = False
+        for topic in self.get_ep_topics(ep):
+            if self.pub.wanted(topic):
+                wanted = True
+                break
+        self.ep_wanted[ep] = (generation, wanted)
+        return wanted
+
     def publish_from(self, ep, data):
-        if self.pub is not None:
-            ep_topics = self.get_ep_topics(ep)
-            topic_data = b':'.join(itertools.chain(ep_topics, [b'\r\n' + data]))
-            try:
-                self.pub.send(topic_data, flags=zmq.NOBLOCK)
-            except zmq.ZMQError as e:
-                if e.errno != errno.EAGAIN:
-                    raise e
-                else:
-                    # TODO: do something?
-                    logger.warning('PUB queue overflow')
+        if self.pub is None:
+            return
+
+        budget = self.budgets.get(ep)
+        if not self.capture_wanted(ep):
+            if budget is not None:
+                budget.count(len(data))
+            return
+
+        if budget is not None and data:
+            data = budget.take(data)
+            if not data:
+                return
+
+        for topic in self.get_ep_topics(ep):
+            if budget is not None and budget.truncated and not data:
+                self.pub.send_notice(topic, 'truncated',
+                                     **budget.notice_fields())
+            self.pub.send(topic, data)
+
+    def spliced_from(self, ep, size):
+        budget = self.budgets.get(ep)
+        if budget is not None:
+            budget.skip(size)
 
     def send_from(self, ep, data):
         for dst_ep in self.endpoints:
@@ -63,7 +114,76 @@ class ProxyPipe(object):
 
         self.publish_from(ep, data)
 
+        if self.splice and self.splicer is None:
+            self.update_relay_mode()
+
+    def subscriptions_changed(self):
+        self.update_relay_mode()
+
+    def update_relay_mode(self):
+        if not self.splice or self.closed:
+            return
+
+        captured = self.pub is not None \
+            and any(self.capture_wanted(ep)
+                    and not self.budget_exhausted(ep)
+                    for ep in self.endpoints)
+        if self.splicer is not None:
+            if captured:
+                self.stop_splicing()
+        elif not captured and self.can_splice():
+            self.start_splicing()
+
+    def budget_exhausted(self, ep):
+        budget = self.budgets.get(ep)
+        return budget is not None and budget.exhausted
+
+    def can_splice(self):
+        for ep in self.endpoints:
+            if getattr(ep, 'closed', False) \
+                    or getattr(ep, 'read_pausers', 0) > 0 \
+                    or ep.transport.get_write_buffer_size() > 0:
+                return False
+        return True
+
+    def start_splicing(self):
+        try:
+            self.splicer = SpliceRelay(asyncio.get_event_loop(), self)
+        except OSError as e:
+            logger.warning('Failed to set up splice relay: %r', e)
+            self.splice = False
+            return
+        self.splicer.start()
+
+    def stop_splicing(self):
+        splicer, self.splicer = self.splicer, None
+        for src_ep, data in splicer.stop():
+            self.send_from(src_ep, data)
+
+    def pause_to(self, ep):
+        # `ep` can't keep up, stop reading from the other side
+        for src_ep in self.endpoints:
+            if src_ep is ep:
+                continue
+            src_ep.pause_reading()
+
+    def resume_to(self, ep):
+        for src_ep in self.endpoints:
+            if src_ep is ep:
+                continue
+            src_ep.resume_reading()
+
+        if self.splice and self.splicer is None:
+            self.update_relay_mode()
+
     def close(self):
+        self.closed = True
+        splicer, self.splicer = self.splicer, None
+        if splicer is not None:
+            splicer.release()
+        if self.splice and self.pub is not None:
+            self.pub.remove_watcher(self)
+
         for ep in self.endpoints:
             closed = getattr(ep, 'closed', False)
             if not closed:
@@ -83,6 +203,32 @@ class ProxyPipeEpMixin(object):
     def to_me(self, data):
         self.transport.write(data)
 
+    def pause_pipe_peers(self):
+        p_pipe = self.get_pipe()
+        if p_pipe is not None:
+            p_pipe.pause_to(self)
+
+    def resume_pipe_peers(self):
+        p_pipe = self.get_pipe()
+        if p_pipe is not None:
+            p_pipe.resume_to(self)
+
+    def pause_reading(self):
+        # More than one peer may ask us to pause
+        self.read_pausers = getattr(self, 'read_pausers', 0) + 1
+        if self.read_pausers == 1 and not getattr(self, 'closed', False):
+            logger.debug('Pausing reading from %r', self.peername)
+            self.transport.pause_reading()
+
+    def resume_reading(self):
+        read_pausers = getattr(self, 'read_pausers', 0)
+        if read_pausers <= 0:
+            return
+        self.read_pausers = read_pausers - 1
+        if self.read_pausers == 0 and not getattr(self, 'closed', False):
+            logger.debug('Resuming reading from %r', self.peername)
+            self.transport.resume_reading()
+
     def close_transport(self):
         transport = getattr(self, 'transport', None)
         if transport is None:
@@ -92,7 +238,7 @@ class ProxyPipeEpMixin(object):
 
 class TopicMixin(object):
     TOPIC_RE = re.compile(
-        b'^(([0-9]+(\\.[0-9]+){3})|\\[([:0-9a-fA-F]+)\\]):([0-9]+)-(([0-9]+(\\.[0-9]+){3})|\\[([:0-9a-fA-F]+)\\]):([0-9]+):\r\n')
+        b'^(([0-9]+(\\.[0-9]+){3})|\\[([:0-9a-fA-F]+)\\]):([0-9]+)-(([0-9]+(\\.[0-9]+){3})|\\[([:0-9a-fA-F]+)\\]):([0-9]+)$')
 
     def gen_topic(self, src=None, dst=None):
         if src is not None:
@@ -121,11 +267,6 @@ class TopicMixin(object):
         self.uplink_topic = None
         self.downlink_topic = None
 
-    def add_topic(self, data, src=None, dst=None):
-        topic = self.gen_topic(src=src, dst=dst)
-        topic_data = b''.join([topic, b':\r\n', data])
-        return topic_data
-
 
 class BaseProtocol(asyncio.Protocol, ProxyPipeEpMixin):
     def connection_made(self, transport):
@@ -143,6 +284,12 @@ class BaseProtocol(asyncio.Protocol, ProxyPipeEpMixin):
         else:
             self.close_transport()
 
+    def pause_writing(self):
+        self.pause_pipe_peers()
+
+    def resume_writing(self):
+        self.resume_pipe_peers()
+
 
 class ProxyClientProtocol(BaseProtocol, TopicMixin):
     def data_received(self, data):
@@ -153,31 +300,61 @@ class ProxyClientProtocol(BaseProtocol, TopicMixin):
 
 
 @asyncio.coroutine
-def new_proxy_connection(host, port, proto_factory):
+def new_proxy_connection(host, port, proto_factory, resolver=None):
     logger.debug('Proxy client connecting to %s:%d', host, port)
     loop = asyncio.get_event_loop()
-    client_transport, client_proto = yield from \
-        loop.create_connection(proto_factory,
-                               host=host,
-                               port=port)
+    if resolver is None:
+        addr_infos = yield from getaddrinfo_async(loop, host, port)
+    else:
+        addr_infos = yield from resolver.getaddrinfo(host, port)
+
+    racer = ConnectionRacer(proto_factory, addr_infos, loop=loop)
+    try:
+        client_transport, client_proto = yield from racer.connect()
+    finally:
+        logger.debug('Connection attempts to %s:%d: %r',
+                     host, port, racer.attempts)
     if client_transport and client_proto:
         logger.debug('Connection made to %s:%d', host, port)
+        client_proto.connect_attempts = racer.attempts
     return client_transport, client_proto
 
 
 class SocksServerProtocol(BaseProtocol, TopicMixin):
-    def __init__(self, pub=None):
+    def __init__(self, pub=None, write_limits=None, splice=False,
+                 resolver=None, policies=None, sampler=None):
         super().__init__()
         self.pub = pub
-        self.recv_buf = bytearray()
-        self.set_current_handler(self.handle_noop)
-
-    def connection_made(self, transport):
-        super().connection_made(transport)
-        self.set_current_handler(self.handle_method_request)
+        self.policies = policies
+        self.capture_policy = None
+        self.sampler = sampler
+        self.sampled = True
+        self.resolver = resolver
+        self.write_limits = write_limits
+        self.splice = splice
+        self.handshake = Socks5Handshake()
+        # Data sent by the client before the tunnel is up
+        self.early_data = []
 
     def data_received(self, data):
-        self.current_handler(data)
+        if self.handshake is None:
+            self.pipe.send_from(self, data)
+        elif self.handshake.done:
+            self.early_data.append(data)
+        else:
+            try:
+                requests, rest = self.handshake.feed(data)
+            except SocksError as e:
+                self.handle_handshake_error(e)
+                return
+
+            for req in requests:
+                if isinstance(req, MethodRequest):
+                    self.handle_method_request(req)
+                else:
+                    self.handle_connect_request(req)
+            if rest:
+                self.early_data.append(rest)
 
     def connection_lost(self, exc):
         connect_task = getattr(self, 'connect_task', None)
@@ -186,6 +363,7 @@ class SocksServerProtocol(BaseProtocol, TopicMixin):
         super().connection_lost(exc)
 
     def proxy_connection_done(self, future):
+        self.connect_task = None
         try:
             client_transport, client_proto = future.result()
             exc = None
@@ -198,88 +376,45 @@ class SocksServerProtocol(BaseProtocol, TopicMixin):
 
         if client_transport is not None \
                 and client_proto is not None:
-            p_pipe = ProxyPipe(client_proto, self, pub=self.pub)
-            self.transport.write(b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00')
-            self.set_current_handler(self.handle_data_stream)
+            p_pipe = ProxyPipe(client_proto, self,
+                               pub=self.pub if self.sampled else None,
+                               write_limits=self.write_limits,
+                               splice=self.splice,
+                               policy=self.capture_policy)
+            self.transport.write(build_reply(
+                REP_SUCCEEDED, client_transport.get_extra_info('sockname')))
+            self.handshake = None
+            early_data, self.early_data = self.early_data, None
+            for data in early_data:
+                p_pipe.send_from(self, data)
         elif exc is None:
             logger.debug('Task cancelled: %r', future)
         else:
             logger.debug('Failed to connect to remote host: %r', exc)
+            self.transport.write(build_reply(reply_for_exception(exc)))
             self.close_transport()
 
-    def check_protocol_version(self, data):
-        return data[0] == 0x05
-
-    def set_current_handler(self, handler):
-        self.current_handler = handler
-        if len(self.recv_buf) > 0:
-            self.current_handler(b'')
-
-    def handle_noop(self, data):
-        logger.warning('Connection %r hit `handle_noop`',
-                       self.peername)
-
-    def handle_method_request(self, data):
-        self.recv_buf.extend(data)
-        data = self.recv_buf
-        if not self.check_protocol_version(data):
-            logger.debug('Version %d mismatch', data[0])
-            self.transport.write(b'\x05\xff')
-            self.close_transport()
-            return
-
-        if len(data) < 2:
-            self.recv_buf = data
-        elif len(data) < data[1] + 2:
-            self.recv_buf = data
-        else:
-            self.transport.write(b'\x05\x00')      # no authentication
-            self.recv_buf = data[(data[1] + 2):]
-            self.set_current_handler(self.handle_connect_request)
-
-    def handle_connect_request(self, data):
-        self.recv_buf.extend(data)
-        data = self.recv_buf
-        if not self.check_protocol_version(data):
-            raise ProtocolError('Version {} mismatch'.format(data[0]))
-
-        if len(data) < 5:
-            self.recv_buf = data
+    def handle_handshake_error(self, exc):
+        logger.debug('SOCKS handshake failed for %r: %r', self.peername, exc)
+        if exc.stage == 'method':
+            self.transport.write(build_method_reply(METHOD_NO_ACCEPTABLE))
         else:
-            command = data[1]
-            if command != 0x01:
-                # TODO: Should tell the client
-                raise ProtocolError('Commands other than CONNECT are not supported')
-
-            address_type = data[3]
-            if address_type == 0x01:    # IPv4
-                address_len = 4
-            elif address_type == 0x03:  # domain name
-                address_len = data[4]
-                address_len += 1
-            else:
-                # TODO: tell the client
-                raise ProtocolError('Address type {} not supported'.format(address_type))
-
-            if len(data) < address_len + 6:
-                self.recv_buf = data
-            else:
-                if address_type == 0x01:        # IPv4
-                    address = '{}.{}.{}.{}'.format(
-                        data[4], data[5], data[6], data[7])
-                else:       # domain name
-                    address = data[5:5+address_len-1].decode('utf8')
-
-                dst_port = data[4+address_len:]
-                dst_port = (dst_port[0] << 8) + dst_port[1]
-
-                self.recv_buf = data[(address_len + 6):]
-
-                self.connect_task = asyncio.Task(
-                    new_proxy_connection(address, dst_port, ProxyClientProtocol))
-                self.connect_task.add_done_callback(self.proxy_connection_done)
-
-    def handle_data_stream(self, data):
-        self.pipe.send_from(self, data)
-
-
+            self.transport.write(build_reply(exc.reply))
+        self.close_transport()
+
+    def handle_method_request(self, req):
+        self.transport.write(build_method_reply(METHOD_NO_AUTH))
+
+    def handle_connect_request(self, req):
+        if self.sampler is not None:
+            self.sampled = self.sampler.sample(
+                host=req.address, port=req.port, client_ip=self.peername[0])
+        if self.policies is not None:
+            self.capture_policy = self.policies.for_host(req.address)
+        self.connect_task = self.start_connect(req.address, req.port)
+        self.connect_task.add_done_callback(self.proxy_connection_done)
+
+    def start_connect(self, host, port):
+        return asyncio.Task(
+            new_proxy_connection(host, port, ProxyClientProtocol,
+                                 resolver=self.resolver))
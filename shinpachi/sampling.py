@@ -0,0 +1,173 @@
+import asyncio
+import fnmatch
+import ipaddress
+import json
+import os
+import random
+import time
+from .log import logger
+
+
+__all__ = ['SampleRule', 'FlowSampler', 'create_flow_sampler',
+           'get_sampling_stats', 'SAMPLING_STATS_KEY']
+
+
+# Redis hash where the proxy workers leave their counters, by PID
+SAMPLING_STATS_KEY = 'shinpachi.sampling_stats'
+
+
+ACTION_SAMPLE = 'sample'
+ACTION_SKIP = 'skip'
+
+
+class SampleRule(object):
+    """Matches flows on their destination, client and HTTP request line.
+
+    Every criterion is a list, and an empty list matches anything. A
+    matching flow is skipped if `action` is 'skip', or captured with a
+    probability of `percent`% if `action` is 'sample'.
+    """
+
+    def __init__(self, name, action=ACTION_SAMPLE, percent=100.0,
+                 hosts=(), ports=(), clients=(), methods=(), paths=()):
+        if action not in (ACTION_SAMPLE, ACTION_SKIP):
+            raise ValueError('Unknown sampling action: {}'.format(action))
+        self.name = name
+        self.action = action
+        self.percent = percent
+        self.hosts = [h.lower() for h in hosts]
+        self.ports = set(ports)
+        self.clients = [ipaddress.ip_network(c, strict=False)
+                        for c in clients]
+        self.methods = set(m.upper() for m in methods)
+        self.paths = list(paths)
+
+        self.matched = 0
+        self.sampled = 0
+
+    def match(self, host, port, client_ip, method, path):
+        if self.ports and port not in self.ports:
+            return False
+        if self.methods and (method is None or method not in self.methods):
+            return False
+        if self.hosts:
+            if host is None:
+                return False
+            host = host.lower()
+            if not any(fnmatch.fnmatchcase(host, h) for h in self.hosts):
+                return False
+        if self.paths:
+            if path is None \
+                    or not any(fnmatch.fnmatchcase(path, p)
+                               for p in self.paths):
+                return False
+        if self.clients:
+            try:
+                addr = ipaddress.ip_address(client_ip)
+            except ValueError:
+                return False
+            if not any(addr in net for net in self.clients):
+                return False
+        return True
+
+    def decide(self):
+        self.matched += 1
+        if self.action == ACTION_SKIP:
+            return False
+        if self.percent >= 100 or random.random() * 100 < self.percent:
+            self.sampled += 1
+            return True
+        return False
+
+    def stats(self):
+        return {'matched': self.matched, 'sampled': self.sampled}
+
+
+class FlowSampler(object):
+    """Decides, once per flow, whether the flow gets captured at all.
+
+    Rules are tried in order, and the first matching one decides.
+    Flows no rule matches are captured with a probability of
+    `default_percent`%.
+    """
+
+    def __init__(self, rules=(), default_percent=100.0):
+        self.rules = list(rules)
+        self.default = SampleRule('default', percent=default_percent)
+
+    def sample(self, host=None, port=None, client_ip=None,
+               method=None, path=None):
+        for rule in self.rules:
+            if rule.match(host, port, client_ip, method, path):
+                return rule.decide()
+        return self.default.decide()
+
+    def stats(self):
+        stats = {r.name: r.stats() for r in self.rules}
+        stats[self.default.name] = self.default.stats()
+        return stats
+
+    @asyncio.coroutine
+    def log_stats_loop(self, interval, redis=None):
+        """Logs the counters every `interval` seconds, and saves them
+        in Redis too, so that /stats.json can show them.
+        """
+        pid = str(os.getpid())
+        while True:
+            yield from asyncio.sleep(interval)
+            stats = self.stats()
+            logger.info('Sampling stats: %r', stats)
+            if redis is None:
+                continue
+            try:
+                yield from redis.hset(
+                    SAMPLING_STATS_KEY, pid,
+                    json.dumps({'time': time.time(), 'rules': stats}))
+            except Exception:
+                logger.exception('Failed to save the sampling stats')
+
+
+@asyncio.coroutine
+def get_sampling_stats(redis, max_age):
+    """Returns {PID: per-rule counters} of the proxy workers that saved
+    their counters in the last `max_age` seconds, and forgets the others.
+    """
+    saved = yield from redis.hgetall_asdict(SAMPLING_STATS_KEY)
+    now = time.time()
+    stats = {}
+    stale = []
+    for pid, value in saved.items():
+        value = json.loads(value)
+        if now - value['time'] > max_age:
+            stale.append(pid)
+        else:
+            stats[pid] = value['rules']
+    if stale:
+        yield from redis.hdel(SAMPLING_STATS_KEY, stale)
+    return stats
+
+
+def create_flow_sampler(config):
+    """Returns None when sampling is disabled, so that every flow is
+    a candidate for capturing.
+    """
+    sconfig = config['sampling']
+    if not sconfig.getboolean('enabled'):
+        return None
+
+    rules = []
+    for section in config.sections():
+        if not section.startswith('sample:'):
+            continue
+        rconfig = config[section]
+        rules.append(SampleRule(
+            section[len('sample:'):].strip(),
+            action=rconfig.get('action', ACTION_SAMPLE).strip().lower(),
+            percent=rconfig.getfloat('percent', 100.0),
+            hosts=rconfig.get('hosts', '').split(),
+            ports=[int(p) for p in rconfig.get('ports', '').split()],
+            clients=rconfig.get('clients', '').split(),
+            methods=rconfig.get('methods', '').split(),
+            paths=rconfig.get('paths', '').split()))
+
+    return FlowSampler(rules, sconfig.getfloat('default_percent'))
@@ -0,0 +1,255 @@
+import array
+import collections
+import errno
+import json
+import re
+import struct
+import time
+import zlib
+import zmq
+from .log import logger
+
+
+__all__ = ['tokenize', 'SearchIndex', 'Searcher', 'FEED_HEADER']
+
+
+# Tokens are runs of letters, digits and underscores, so that both the
+# indexed data and the queries get split at the same places
+TOKEN_RE = re.compile(b'[0-9A-Za-z_]{3,}')
+MAX_TOKEN_BYTES = 64
+
+# Rough per-token memory cost of the dict entry and the posting array
+TOKEN_OVERHEAD = 160
+
+# A trailing partial token
+TAIL_RE = re.compile(
+    '[0-9A-Za-z_]{{1,{}}}$'.format(MAX_TOKEN_BYTES).encode('ascii'))
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# epoch, flow id; followed by the topic and data frames
+FEED_HEADER = struct.Struct('>II')
+
+MAX_SEARCH_LIMIT = 1000
+
+
+def tokenize(data):
+    """Returns the set of (lowercased, truncated) tokens in `data`."""
+    return set(t[:MAX_TOKEN_BYTES] for t in TOKEN_RE.findall(data.lower()))
+
+
+class FlowTextState(object):
+    """What's needed to keep tokenizing one direction of a flow across
+    capture messages.
+    """
+
+    __slots__ = ('tail', 'indexed', 'inflater', 'head_done')
+
+    def __init__(self):
+        # A token may be cut between two messages
+        self.tail = b''
+        self.indexed = 0
+        self.inflater = None
+        self.head_done = False
+
+
+class SearchIndex(object):
+    """An inverted index from tokens to flow ids.
+
+    Postings go to the newest of up to `generations` generations, each
+    a dict of token -> array of flow ids. A new generation is started
+    once the current one takes more than its share of `max_bytes`, and
+    the oldest one is dropped, so eviction is cheap and always takes
+    the oldest flows first.
+    """
+
+    def __init__(self, max_bytes, generations=8, max_bytes_per_flow=1048576):
+        self.max_bytes = max_bytes
+        self.nr_generations = generations
+        self.generation_bytes = max_bytes // generations
+        self.max_bytes_per_flow = max_bytes_per_flow
+        # [(postings, estimated bytes)], oldest first
+        self.generations = collections.deque([({}, 0)])
+        # (flow id, topic) -> FlowTextState
+        self.flow_states = collections.OrderedDict()
+        self.max_flow_states = 65536
+        self.indexed_messages = 0
+        self.evicted_generations = 0
+
+    def clear(self):
+        self.generations = collections.deque([({}, 0)])
+        self.flow_states.clear()
+
+    def flow_state(self, flow_id, topic):
+        key = (flow_id, topic)
+        state = self.flow_states.get(key)
+        if state is None:
+            state = self.flow_states[key] = FlowTextState()
+            if len(self.flow_states) > self.max_flow_states:
+                self.flow_states.popitem(last=False)
+        return state
+
+    def decode(self, state, data):
+        """Returns the text to index for a capture message."""
+        if not state.head_done:
+            end = data.find(b'\r\n\r\n')
+            if end < 0:
+                return data
+            state.head_done = True
+            head, body = data[:(end + 4)], data[(end + 4):]
+            if body.startswith(GZIP_MAGIC):
+                state.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            return head + self.inflate(state, body)
+        return self.inflate(state, data)
+
+    def inflate(self, state, data):
+        if state.inflater is None or not data:
+            return data
+        try:
+            return state.inflater.decompress(data, self.max_bytes_per_flow)
+        except zlib.error:
+            state.inflater = None
+            return b''
+
+    def add(self, flow_id, topic, data):
+        if not data:
+            self.flow_states.pop((flow_id, topic), None)
+            return
+        state = self.flow_state(flow_id, topic)
+        if state.indexed >= self.max_bytes_per_flow:
+            return
+
+        text = state.tail + self.decode(state, bytes(data))
+        text = text[:(self.max_bytes_per_flow - state.indexed)]
+        state.indexed += len(text)
+        # The last token may go on in the next message, so it's indexed
+        # both as it is and joined with the start of the next one
+        match = TAIL_RE.search(text)
+        state.tail = text[match.start():] if match is not None else b''
+
+        postings, size = self.generations[-1]
+        for token in tokenize(text):
+            flows = postings.get(token)
+            if flows is None:
+                flows = postings[token] = array.array('I')
+                size += TOKEN_OVERHEAD + len(token)
+            if not flows or flows[-1] != flow_id:
+                flows.append(flow_id)
+                size += flows.itemsize
+        self.generations[-1] = (postings, size)
+        self.indexed_messages += 1
+
+        if size > self.generation_bytes:
+            self.generations.append(({}, 0))
+            if len(self.generations) > self.nr_generations:
+                self.generations.popleft()
+                self.evicted_generations += 1
+
+    def search(self, query, limit=50):
+        """Returns the ids of the flows having every token of `query`,
+        newest first.
+        """
+        if isinstance(query, str):
+            query = query.encode('utf8')
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        limit = max(1, min(int(limit), MAX_SEARCH_LIMIT))
+
+        found = []
+        for postings, _size in reversed(self.generations):
+            lists = [postings.get(t) for t in tokens]
+            if not all(lists):
+                continue
+            lists.sort(key=len)
+            matching = set(lists[0])
+            for flows in lists[1:]:
+                matching.intersection_update(flows)
+                if not matching:
+                    break
+            found.extend(sorted(matching, reverse=True))
+            if len(found) >= limit:
+                break
+
+        # A flow may span generations
+        seen = set()
+        result = []
+        for flow_id in found:
+            if flow_id not in seen:
+                seen.add(flow_id)
+                result.append(flow_id)
+        return result[:limit]
+
+    def stats(self):
+        return {
+            'generations': len(self.generations),
+            'bytes': sum(size for _postings, size in self.generations),
+            'max_bytes': self.max_bytes,
+            'tokens': sum(len(p) for p, _size in self.generations),
+            'indexed_messages': self.indexed_messages,
+            'evicted_generations': self.evicted_generations,
+        }
+
+
+class Searcher(object):
+    """Feeds a SearchIndex with the messages the recorder pushes, and
+    answers the queries coming in on a REP socket.
+    """
+
+    def __init__(self, index, stats_interval=60.0):
+        self.index = index
+        self.stats_interval = stats_interval
+        self.epoch = None
+
+    def feed(self, frames):
+        epoch, flow_id = FEED_HEADER.unpack(frames[0])
+        if epoch != self.epoch:
+            # The recorder restarted, and numbers flows differently
+            if self.epoch is not None:
+                logger.info('Recorder restarted, clearing the search index')
+            self.index.clear()
+            self.epoch = epoch
+        self.index.add(flow_id, frames[1], frames[2])
+
+    def handle_query(self, request):
+        try:
+            params = json.loads(request.decode('utf8'))
+            if not isinstance(params, dict) or 'q' not in params:
+                raise ValueError('Query must be an object with `q`')
+            start = time.monotonic()
+            ids = self.index.search(params['q'], params.get('limit', 50))
+            result = {'ids': ids,
+                      'time': time.monotonic() - start}
+        except (ValueError, TypeError) as e:
+            result = {'error': str(e)}
+        return json.dumps(result).encode('utf8')
+
+    def run(self, feed_sock, query_sock, poll_interval=1.0):
+        poller = zmq.Poller()
+        poller.register(feed_sock, zmq.POLLIN)
+        poller.register(query_sock, zmq.POLLIN)
+
+        last_stats = time.monotonic()
+        while True:
+            events = dict(poller.poll(poll_interval * 1000))
+
+            # Queries first, they are waiting for an answer
+            if query_sock in events:
+                request = query_sock.recv()
+                query_sock.send(self.handle_query(request))
+
+            if feed_sock in events:
+                for _ in range(1000):
+                    try:
+                        frames = feed_sock.recv_multipart(flags=zmq.NOBLOCK)
+                    except zmq.ZMQError as e:
+                        if e.errno == errno.EAGAIN:
+                            break
+                        raise e
+                    self.feed(frames)
+
+            now = time.monotonic()
+            if self.stats_interval > 0 \
+                    and now - last_stats >= self.stats_interval:
+                last_stats = now
+                logger.info('Search index stats: %r', self.index.stats())
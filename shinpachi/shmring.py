@@ -0,0 +1,189 @@
+import os
+import fcntl
+import mmap
+import struct
+import errno
+import multiprocessing
+import zmq
+from .log import logger
+
+
+__all__ = ['SharedRing', 'RingProducer', 'MessageTooLarge',
+           'setup_bridge_rings', 'get_bridge_ring']
+
+
+# Positions are ever-increasing byte counts, and they live in separate
+# cache lines, since they are written by different processes
+_POS = struct.Struct('=Q')
+_WRITE_POS_OFFSET = 0
+_READ_POS_OFFSET = 64
+_DATA_OFFSET = 128
+
+# data length, topic length, kind
+_RECORD = struct.Struct('=IHB')
+
+KIND_DATA = 0
+KIND_NOTICE = 1
+
+
+class MessageTooLarge(ValueError):
+    """The message can never fit in the ring, however long we wait."""
+
+
+class SharedRing(object):
+    """A multi-producer, single-consumer message ring in shared memory.
+
+    The memory is an anonymous shared mapping, so the ring must be
+    created before forking the processes that use it. Producers
+    serialize on a lock, and wake the consumer up through a pipe when
+    they write to an empty ring.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.mem = mmap.mmap(-1, _DATA_OFFSET + capacity)
+        self.lock = multiprocessing.Lock()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.wakeup_r
+
+    def load_pos(self, offset):
+        return _POS.unpack_from(self.mem, offset)[0]
+
+    def store_pos(self, offset, pos):
+        _POS.pack_into(self.mem, offset, pos)
+
+    def copy_in(self, pos, data):
+        size = len(data)
+        start = pos % self.capacity
+        first = min(size, self.capacity - start)
+        self.mem[(_DATA_OFFSET + start):(_DATA_OFFSET + start + first)] = \
+            data[:first]
+        if first < size:
+            self.mem[_DATA_OFFSET:(_DATA_OFFSET + size - first)] = \
+                data[first:]
+
+    def copy_out(self, pos, size):
+        start = pos % self.capacity
+        first = min(size, self.capacity - start)
+        data = self.mem[(_DATA_OFFSET + start):(_DATA_OFFSET + start + first)]
+        if first < size:
+            data += self.mem[_DATA_OFFSET:(_DATA_OFFSET + size - first)]
+        return data
+
+    def put(self, topic, data, kind=KIND_DATA):
+        """Returns False if there's not enough room."""
+        size = _RECORD.size + len(topic) + len(data)
+        if size > self.capacity:
+            raise MessageTooLarge('Message too large for the ring')
+
+        with self.lock:
+            write_pos = self.load_pos(_WRITE_POS_OFFSET)
+            if write_pos + size - self.load_pos(_READ_POS_OFFSET) \
+                    > self.capacity:
+                return False
+            self.copy_in(write_pos,
+                         _RECORD.pack(len(data), len(topic), kind))
+            self.copy_in(write_pos + _RECORD.size, topic)
+            self.copy_in(write_pos + _RECORD.size + len(topic), data)
+            self.store_pos(_WRITE_POS_OFFSET, write_pos + size)
+
+        # Check the read position *after* publishing the write position,
+        # so that either the consumer sees our message, or we see that
+        # it caught up and is going to sleep
+        if self.load_pos(_READ_POS_OFFSET) == write_pos:
+            try:
+                os.write(self.wakeup_w, b'\0')
+            except (BlockingIOError, InterruptedError):
+                # There's a wakeup pending already
+                pass
+        return True
+
+    def get_all(self):
+        """Yields (topic, data, kind) until the ring is empty.
+
+        Only the consumer process may call this.
+        """
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        read_pos = self.load_pos(_READ_POS_OFFSET)
+        write_pos = self.load_pos(_WRITE_POS_OFFSET)
+        while read_pos < write_pos:
+            data_len, topic_len, kind = \
+                _RECORD.unpack(self.copy_out(read_pos, _RECORD.size))
+            topic = self.copy_out(read_pos + _RECORD.size, topic_len)
+            data = self.copy_out(read_pos + _RECORD.size + topic_len,
+                                 data_len)
+            read_pos += _RECORD.size + topic_len + data_len
+            self.store_pos(_READ_POS_OFFSET, read_pos)
+            yield (topic, data, kind)
+            if read_pos == write_pos:
+                write_pos = self.load_pos(_WRITE_POS_OFFSET)
+
+    def used(self):
+        return self.load_pos(_WRITE_POS_OFFSET) \
+            - self.load_pos(_READ_POS_OFFSET)
+
+
+class RingProducer(object):
+    """Gives a SharedRing the send methods of the XPUB socket that
+    CapturePublisher normally writes to.
+    """
+
+    # The ring can't be polled for free space, so retry this often
+    retry_interval = 0.01
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.topic = None
+
+    def send(self, data, flags=0, copy=True):
+        if flags & zmq.SNDMORE:
+            self.topic = data
+            return
+        topic, self.topic = self.topic, None
+        if not self.ring.put(topic, data):
+            raise zmq.ZMQError(errno.EAGAIN)
+
+    def send_multipart(self, frames, flags=0, copy=True):
+        if len(frames) > 2:
+            ok = self.ring.put(frames[0], frames[2], KIND_NOTICE)
+        else:
+            ok = self.ring.put(frames[0], frames[1])
+        if not ok:
+            raise zmq.ZMQError(errno.EAGAIN)
+
+    def close(self):
+        pass
+
+
+_bridge_rings = None
+
+
+def setup_bridge_rings(config):
+    """Creates the rings for the `shm` bridge transport.
+
+    Must be called in the main process before the workers are forked.
+    """
+    global _bridge_rings
+    if config['bridge']['transport'] != 'shm':
+        return
+    capacity = config['bridge'].getint('ring_bytes')
+    shards = config['bridge'].getint('shards')
+    _bridge_rings = [SharedRing(capacity) for _ in range(shards)]
+    logger.debug('Created %d bridge ring(s) of %d bytes', shards, capacity)
+
+
+def get_bridge_ring(shard):
+    if _bridge_rings is None:
+        raise RuntimeError('Bridge rings not set up, the shm transport '
+                           'needs workers forked from the main process')
+    return _bridge_rings[shard]
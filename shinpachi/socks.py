@@ -0,0 +1,211 @@
+import asyncio
+import errno
+import socket
+import collections
+
+
+__all__ = ['Socks5Handshake', 'SocksError',
+           'MethodRequest', 'ConnectRequest',
+           'build_method_reply', 'build_reply', 'reply_for_exception']
+
+
+SOCKS_VERSION = 0x05
+
+# Authentication methods
+METHOD_NO_AUTH = 0x00
+METHOD_NO_ACCEPTABLE = 0xff
+
+# Commands
+CMD_CONNECT = 0x01
+
+# Address types
+ATYP_IPV4 = 0x01
+ATYP_DOMAIN = 0x03
+ATYP_IPV6 = 0x04
+
+# Reply codes, see RFC 1928, section 6
+REP_SUCCEEDED = 0x00
+REP_GENERAL_FAILURE = 0x01
+REP_NOT_ALLOWED = 0x02
+REP_NETWORK_UNREACHABLE = 0x03
+REP_HOST_UNREACHABLE = 0x04
+REP_CONNECTION_REFUSED = 0x05
+REP_TTL_EXPIRED = 0x06
+REP_COMMAND_NOT_SUPPORTED = 0x07
+REP_ADDRESS_TYPE_NOT_SUPPORTED = 0x08
+
+
+MethodRequest = collections.namedtuple(
+    'MethodRequest', ['methods'])
+ConnectRequest = collections.namedtuple(
+    'ConnectRequest', ['address_type', 'address', 'port'])
+
+
+class SocksError(Exception):
+    def __init__(self, msg, stage, reply=REP_GENERAL_FAILURE):
+        super().__init__(msg)
+        self.stage = stage
+        self.reply = reply
+
+
+class Socks5Handshake(object):
+    """Incremental parser for the SOCKS5 handshake.
+
+    Bytes are parsed in place through a memoryview. Only an incomplete
+    message at the end of a read gets copied, into `pending`, and the
+    parser carries on from there when more data arrives.
+    """
+
+    STATE_METHOD_REQUEST = 0
+    STATE_CONNECT_REQUEST = 1
+    STATE_DONE = 2
+
+    def __init__(self):
+        self.state = self.STATE_METHOD_REQUEST
+        self.pending = None
+
+    @property
+    def done(self):
+        return self.state == self.STATE_DONE
+
+    def feed(self, data):
+        """Returns a list of parsed requests, and the bytes that follow
+        the handshake, which belong to the tunnel.
+        """
+        if self.pending is not None:
+            self.pending.extend(data)
+            data = self.pending
+            self.pending = None
+
+        requests = []
+        with memoryview(data) as view:
+            offset = 0
+            while self.state != self.STATE_DONE:
+                if self.state == self.STATE_METHOD_REQUEST:
+                    req, offset = self.parse_method_request(view, offset)
+                    next_state = self.STATE_CONNECT_REQUEST
+                else:
+                    req, offset = self.parse_connect_request(view, offset)
+                    next_state = self.STATE_DONE
+
+                if req is None:
+                    # Incomplete, wait for more data
+                    if offset < len(view):
+                        self.pending = bytearray(view[offset:])
+                    return (requests, b'')
+
+                requests.append(req)
+                self.state = next_state
+
+            rest = bytes(view[offset:]) if offset < len(view) else b''
+
+        return (requests, rest)
+
+    def parse_method_request(self, view, offset):
+        avail = len(view) - offset
+        if avail < 1:
+            return (None, offset)
+        if view[offset] != SOCKS_VERSION:
+            raise SocksError('Version {} mismatch'.format(view[offset]),
+                             'method')
+        if avail < 2:
+            return (None, offset)
+
+        nmethods = view[offset + 1]
+        if avail < nmethods + 2:
+            return (None, offset)
+
+        methods = view[(offset + 2):(offset + 2 + nmethods)]
+        if METHOD_NO_AUTH not in methods:
+            raise SocksError('No acceptable authentication method',
+                             'method')
+        return (MethodRequest(bytes(methods)), offset + 2 + nmethods)
+
+    def parse_connect_request(self, view, offset):
+        avail = len(view) - offset
+        if avail < 1:
+            return (None, offset)
+        if view[offset] != SOCKS_VERSION:
+            raise SocksError('Version {} mismatch'.format(view[offset]),
+                             'connect')
+        # VER, CMD, RSV, ATYP, and the first byte of DST.ADDR
+        if avail < 5:
+            return (None, offset)
+
+        command = view[offset + 1]
+        address_type = view[offset + 3]
+        if address_type == ATYP_IPV4:
+            address_len = 4
+            address_start = offset + 4
+        elif address_type == ATYP_IPV6:
+            address_len = 16
+            address_start = offset + 4
+        elif address_type == ATYP_DOMAIN:
+            address_len = view[offset + 4]
+            address_start = offset + 5
+        else:
+            raise SocksError(
+                'Address type {} not supported'.format(address_type),
+                'connect', REP_ADDRESS_TYPE_NOT_SUPPORTED)
+
+        port_start = address_start + address_len
+        if len(view) < port_start + 2:
+            return (None, offset)
+
+        if command != CMD_CONNECT:
+            raise SocksError(
+                'Command {} not supported'.format(command),
+                'connect', REP_COMMAND_NOT_SUPPORTED)
+
+        address_view = view[address_start:port_start]
+        if address_type == ATYP_IPV4:
+            address = socket.inet_ntop(socket.AF_INET, address_view)
+        elif address_type == ATYP_IPV6:
+            address = socket.inet_ntop(socket.AF_INET6, address_view)
+        else:
+            try:
+                address = str(address_view, 'ascii')
+            except UnicodeDecodeError:
+                raise SocksError('Bad domain name', 'connect')
+        port = (view[port_start] << 8) + view[port_start + 1]
+
+        return (ConnectRequest(address_type, address, port), port_start + 2)
+
+
+def build_method_reply(method):
+    return bytes([SOCKS_VERSION, method])
+
+
+def build_reply(reply, sockname=None):
+    if sockname is None:
+        return bytes([SOCKS_VERSION, reply, 0x00, ATYP_IPV4,
+                      0, 0, 0, 0, 0, 0])
+
+    if len(sockname) == 2:      # IPv4
+        address_type = ATYP_IPV4
+        address = socket.inet_pton(socket.AF_INET, sockname[0])
+    else:                       # IPv6
+        address_type = ATYP_IPV6
+        address = socket.inet_pton(socket.AF_INET6, sockname[0])
+    port = sockname[1]
+
+    return b''.join([bytes([SOCKS_VERSION, reply, 0x00, address_type]),
+                     address,
+                     bytes([(port >> 8) & 0xff, port & 0xff])])
+
+
+def reply_for_exception(exc):
+    if isinstance(exc, ConnectionRefusedError):
+        return REP_CONNECTION_REFUSED
+    if isinstance(exc, socket.gaierror):
+        return REP_HOST_UNREACHABLE
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError)):
+        return REP_TTL_EXPIRED
+    if isinstance(exc, OSError):
+        if exc.errno == errno.ENETUNREACH:
+            return REP_NETWORK_UNREACHABLE
+        if exc.errno == errno.EHOSTUNREACH:
+            return REP_HOST_UNREACHABLE
+        if exc.errno == errno.ETIMEDOUT:
+            return REP_TTL_EXPIRED
+    return REP_GENERAL_FAILURE
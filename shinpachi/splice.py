@@ -0,0 +1,185 @@
+import os
+import sys
+import errno
+from .log import logger
+
+
+__all__ = ['SPLICE_AVAILABLE', 'SpliceRelay']
+
+
+# os.splice() appeared in Python 3.10, and splice(2) is Linux-only
+SPLICE_AVAILABLE = sys.platform.startswith('linux') and hasattr(os, 'splice')
+
+SPLICE_CHUNK_SIZE = 65536
+
+
+class _SpliceDirection(object):
+    """Moves bytes from one socket to another through a pipe.
+
+    The bytes go socket -> pipe -> socket with splice(2), so they never
+    get copied into userspace.
+    """
+
+    def __init__(self, relay, src_ep, dst_ep):
+        self.relay = relay
+        self.loop = relay.loop
+        self.src_ep = src_ep
+        self.dst_ep = dst_ep
+        self.src_fd = relay.dup_fd(src_ep)
+        self.dst_fd = relay.dup_fd(dst_ep)
+        self.pipe_r, self.pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.buffered = 0
+        self.waiting_write = False
+        self.eof = False
+        self.flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+
+    def start(self):
+        self.loop.add_reader(self.src_fd, self.read_ready)
+
+    def read_ready(self):
+        try:
+            n = os.splice(self.src_fd, self.pipe_w,
+                          SPLICE_CHUNK_SIZE, flags=self.flags)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self.relay.failed(exc)
+            return
+
+        if n == 0:
+            logger.debug('EOF from %r while splicing', self.src_ep.peername)
+            self.eof = True
+            self.loop.remove_reader(self.src_fd)
+        else:
+            self.buffered += n
+            self.relay.pipe.spliced_from(self.src_ep, n)
+        self.flush()
+
+    def write_ready(self):
+        self.flush()
+
+    def flush(self):
+        while self.buffered > 0:
+            try:
+                n = os.splice(self.pipe_r, self.dst_fd,
+                              self.buffered, flags=self.flags)
+            except (BlockingIOError, InterruptedError):
+                if not self.waiting_write:
+                    # The destination is full, stop reading until it
+                    # drains, so that the pipe acts as our only buffer
+                    self.waiting_write = True
+                    self.loop.remove_reader(self.src_fd)
+                    self.loop.add_writer(self.dst_fd, self.write_ready)
+                return
+            except OSError as exc:
+                self.relay.failed(exc)
+                return
+            self.buffered -= n
+
+        if self.waiting_write:
+            self.waiting_write = False
+            self.loop.remove_writer(self.dst_fd)
+            if not self.eof:
+                self.loop.add_reader(self.src_fd, self.read_ready)
+
+        if self.eof:
+            # Everything is delivered, tear the tunnel down
+            self.relay.close()
+
+    def take_buffered(self):
+        chunks = []
+        while self.buffered > 0:
+            try:
+                c = os.read(self.pipe_r, self.buffered)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not c:
+                break
+            chunks.append(c)
+            self.buffered -= len(c)
+        self.buffered = 0
+        return b''.join(chunks)
+
+    def close(self):
+        if self.waiting_write:
+            self.loop.remove_writer(self.dst_fd)
+        elif not self.eof:
+            self.loop.remove_reader(self.src_fd)
+        for fd in (self.src_fd, self.dst_fd, self.pipe_r, self.pipe_w):
+            os.close(fd)
+
+
+class SpliceRelay(object):
+    """Relays a two-endpoint ProxyPipe in kernel space.
+
+    The asyncio transports are paused while the relay is active. We
+    watch duplicated descriptors of the same sockets instead, since the
+    originals are still registered by their transports.
+    """
+
+    def __init__(self, loop, p_pipe):
+        if len(p_pipe.endpoints) != 2:
+            raise RuntimeError('Only two-endpoint pipes can be spliced')
+        self.loop = loop
+        self.pipe = p_pipe
+        self.active = False
+        self.directions = []
+        ep_a, ep_b = p_pipe.endpoints
+        try:
+            self.directions.append(_SpliceDirection(self, ep_a, ep_b))
+            self.directions.append(_SpliceDirection(self, ep_b, ep_a))
+        except Exception:
+            for d in self.directions:
+                d.close()
+            raise
+
+    def dup_fd(self, ep):
+        sock = ep.transport.get_extra_info('socket')
+        return os.dup(sock.fileno())
+
+    def start(self):
+        for ep in self.pipe.endpoints:
+            ep.pause_reading()
+        for d in self.directions:
+            d.start()
+        self.active = True
+        logger.debug('Splicing pipe %r', self.pipe)
+
+    def stop(self):
+        """Hands the pipe back to userspace relaying.
+
+        Returns (src_ep, data) pairs for the bytes that were still
+        sitting in the kernel pipes.
+        """
+        if not self.active:
+            return []
+        self.active = False
+
+        pending = []
+        for d in self.directions:
+            data = d.take_buffered()
+            if data:
+                pending.append((d.src_ep, data))
+            d.close()
+        for ep in self.pipe.endpoints:
+            ep.resume_reading()
+        logger.debug('Stopped splicing pipe %r', self.pipe)
+        return pending
+
+    def failed(self, exc):
+        if exc.errno not in (errno.ECONNRESET, errno.EPIPE):
+            logger.warning('Splice relay failed: %r', exc)
+        else:
+            logger.debug('Splice relay closed: %r', exc)
+        self.close()
+
+    def release(self):
+        if not self.active:
+            return
+        self.active = False
+        for d in self.directions:
+            d.close()
+
+    def close(self):
+        self.release()
+        self.pipe.close()
@@ -0,0 +1,819 @@
+import os
+import mmap
+import time
+import errno
+import struct
+import array
+import bisect
+import hashlib
+import binascii
+import collections
+import concurrent.futures
+import zmq
+from .capture import parse_capture_message
+from .config import get_abs_path
+from .shmring import (KIND_DATA, KIND_NOTICE)
+from .flowindex import handle_query, HEADER_SCAN_BYTES
+from .search import FEED_HEADER
+from .log import logger
+
+
+__all__ = ['Segment', 'BlobStore', 'CaptureStore', 'Recorder',
+           'create_capture_store', 'get_capture_store_reader',
+           'get_capture_store_executor']
+
+
+# timestamp, data length, topic length, kind
+_RECORD = struct.Struct('>dIHB')
+
+# Records of this kind hold the digest of a blob instead of the data
+KIND_BLOB = 2
+
+# magic, number of topics, first timestamp, last timestamp
+_IDX_HEADER = struct.Struct('=4sIdd')
+# topic length, number of offsets
+_IDX_TOPIC = struct.Struct('=HI')
+# number of blobs referenced
+_IDX_BLOBS = struct.Struct('=I')
+# blob digest, number of references
+_IDX_BLOB_REF = struct.Struct('=20sI')
+_IDX_MAGIC = b'SPX2'
+
+_OFFSET_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+
+_SEGMENT_SUFFIX = '.seg'
+_INDEX_SUFFIX = '.idx'
+
+# Message bodies are stored in pieces of this size, cut at the same
+# offsets every time, so that a body dedups however it was chunked
+BODY_PIECE_BYTES = 4194304
+# A message that got no data for this many seconds is written as is
+MESSAGE_MAX_IDLE = 30.0
+
+
+class Segment(object):
+    """A file of capture records, and the offsets of each flow's records.
+
+    Records are appended to the last segment of a store only. Once a
+    segment is full, its index is saved next to it, so that it doesn't
+    have to be scanned again. Reads go through a read-only mmap, so the
+    data stays in the page cache instead of the Python heap.
+    """
+
+    def __init__(self, dir_path, seq):
+        self.seq = seq
+        self.path = os.path.join(dir_path,
+                                 '{:016d}{}'.format(seq, _SEGMENT_SUFFIX))
+        self.idx_path = os.path.join(dir_path,
+                                     '{:016d}{}'.format(seq, _INDEX_SUFFIX))
+        # topic -> array of record offsets
+        self.index = {}
+        # blob digest -> number of records referencing it
+        self.blob_refs = collections.Counter()
+        # Bytes of complete records indexed so far
+        self.size = 0
+        self.first_ts = None
+        self.last_ts = None
+        self.mm = None
+        self.mm_size = 0
+
+    def add_entry(self, topic, offset, ts, size):
+        offsets = self.index.get(topic)
+        if offsets is None:
+            offsets = self.index[topic] = array.array(_OFFSET_TYPECODE)
+        offsets.append(offset)
+        # Messages put back together are written after records that
+        # were captured later
+        if self.first_ts is None or ts < self.first_ts:
+            self.first_ts = ts
+        if self.last_ts is None or ts > self.last_ts:
+            self.last_ts = ts
+        self.size = offset + size
+
+    def map(self):
+        """(Re)maps the file if it grew since the last call."""
+        try:
+            file_size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return False
+        if file_size <= self.mm_size:
+            return self.mm is not None
+        self.unmap()
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), file_size, access=mmap.ACCESS_READ)
+        self.mm_size = file_size
+        return True
+
+    def unmap(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+            self.mm_size = 0
+
+    def scan(self):
+        """Indexes the records after `self.size`, stopping at the first
+        incomplete one (e.g. one that's still being written).
+        """
+        if not self.map():
+            return
+        mm = self.mm
+        offset = self.size
+        while offset + _RECORD.size <= self.mm_size:
+            ts, data_len, topic_len, kind = _RECORD.unpack_from(mm, offset)
+            size = _RECORD.size + topic_len + data_len
+            if offset + size > self.mm_size:
+                break
+            topic_start = offset + _RECORD.size
+            data_start = topic_start + topic_len
+            if kind == KIND_BLOB:
+                self.blob_refs[mm[data_start:(data_start + data_len)]] += 1
+            self.add_entry(mm[topic_start:data_start], offset, ts, size)
+            offset += size
+
+    def read(self, offset):
+        """Returns (timestamp, topic, data, kind) of the record at
+        `offset`.
+        """
+        if self.mm is None or offset + _RECORD.size > self.mm_size:
+            self.map()
+        ts, data_len, topic_len, kind = \
+            _RECORD.unpack_from(self.mm, offset)
+        topic_start = offset + _RECORD.size
+        data_start = topic_start + topic_len
+        if data_start + data_len > self.mm_size:
+            self.map()
+        mm = self.mm
+        return (ts, mm[topic_start:data_start],
+                mm[data_start:(data_start + data_len)], kind)
+
+    def records(self):
+        """Yields (timestamp, topic, data, kind) of every indexed
+        record, in the order they were written.
+        """
+        offset = 0
+        while offset < self.size:
+            record = self.read(offset)
+            yield record
+            offset += _RECORD.size + len(record[1]) + len(record[2])
+
+    def load_index(self):
+        try:
+            with open(self.idx_path, 'rb') as f:
+                buf = f.read()
+        except FileNotFoundError:
+            return False
+
+        try:
+            magic, nr_topics, first_ts, last_ts = \
+                _IDX_HEADER.unpack_from(buf, 0)
+            if magic != _IDX_MAGIC:
+                return False
+            pos = _IDX_HEADER.size
+            index = {}
+            for _ in range(nr_topics):
+                topic_len, count = _IDX_TOPIC.unpack_from(buf, pos)
+                pos += _IDX_TOPIC.size
+                topic = buf[pos:(pos + topic_len)]
+                pos += topic_len
+                offsets = array.array(_OFFSET_TYPECODE)
+                offsets.frombytes(buf[pos:(pos + count * offsets.itemsize)])
+                pos += count * offsets.itemsize
+                if len(offsets) != count:
+                    return False
+                index[topic] = offsets
+
+            blob_refs = collections.Counter()
+            nr_blobs, = _IDX_BLOBS.unpack_from(buf, pos)
+            pos += _IDX_BLOBS.size
+            for _ in range(nr_blobs):
+                digest, count = _IDX_BLOB_REF.unpack_from(buf, pos)
+                pos += _IDX_BLOB_REF.size
+                blob_refs[digest] = count
+        except struct.error:
+            return False
+
+        self.index = index
+        self.blob_refs = blob_refs
+        self.first_ts = first_ts if first_ts >= 0 else None
+        self.last_ts = last_ts if last_ts >= 0 else None
+        self.size = os.path.getsize(self.path)
+        return True
+
+    def save_index(self):
+        parts = [_IDX_HEADER.pack(
+            _IDX_MAGIC, len(self.index),
+            -1 if self.first_ts is None else self.first_ts,
+            -1 if self.last_ts is None else self.last_ts)]
+        for topic, offsets in self.index.items():
+            parts.append(_IDX_TOPIC.pack(len(topic), len(offsets)))
+            parts.append(topic)
+            parts.append(offsets.tobytes())
+        parts.append(_IDX_BLOBS.pack(len(self.blob_refs)))
+        for digest, count in self.blob_refs.items():
+            parts.append(_IDX_BLOB_REF.pack(digest, count))
+        tmp_path = self.idx_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(parts))
+        os.rename(tmp_path, self.idx_path)
+
+    def remove(self):
+        self.unmap()
+        for path in (self.path, self.idx_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class BlobStore(object):
+    """Content-addressed payloads, one file per distinct payload.
+
+    Files are named after the SHA-1 of their content, and removed when
+    the last record referencing them goes away. The reference counts
+    live in memory only, and are rebuilt from the segment indexes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # digest -> [references, size]
+        self.blobs = {}
+        self.bytes = 0
+        self.dedup_hits = 0
+        self.dedup_bytes = 0
+
+    def blob_path(self, digest):
+        name = binascii.hexlify(digest).decode('ascii')
+        return os.path.join(self.path, name[:2], name[2:])
+
+    def put(self, data):
+        """Stores `data` if it's not there yet, and takes a reference
+        to it. Returns the digest.
+        """
+        digest = hashlib.sha1(data).digest()
+        blob = self.blobs.get(digest)
+        if blob is not None:
+            blob[0] += 1
+            self.dedup_hits += 1
+            self.dedup_bytes += len(data)
+            return digest
+
+        path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+        self.blobs[digest] = [1, len(data)]
+        self.bytes += len(data)
+        return digest
+
+    def get(self, digest):
+        try:
+            with open(self.blob_path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            logger.warning('Missing capture blob %s',
+                           binascii.hexlify(digest).decode('ascii'))
+            return b''
+
+    def add_refs(self, blob_refs):
+        """Takes references for the blobs of an existing segment."""
+        for digest, count in blob_refs.items():
+            blob = self.blobs.get(digest)
+            if blob is None:
+                try:
+                    size = os.path.getsize(self.blob_path(digest))
+                except FileNotFoundError:
+                    continue
+                blob = self.blobs[digest] = [0, size]
+                self.bytes += size
+            blob[0] += count
+
+    def release_refs(self, blob_refs):
+        """Drops the references of a removed segment, and deletes the
+        blobs nothing refers to anymore.
+        """
+        for digest, count in blob_refs.items():
+            blob = self.blobs.get(digest)
+            if blob is None:
+                continue
+            blob[0] -= count
+            if blob[0] <= 0:
+                del self.blobs[digest]
+                self.bytes -= blob[1]
+                try:
+                    os.unlink(self.blob_path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def collect_orphans(self):
+        """Deletes the blob files with no references, e.g. ones written
+        right before a crash.
+        """
+        try:
+            subdirs = os.listdir(self.path)
+        except FileNotFoundError:
+            return
+        removed = 0
+        for subdir in subdirs:
+            subdir_path = os.path.join(self.path, subdir)
+            for name in os.listdir(subdir_path):
+                try:
+                    digest = binascii.unhexlify(subdir + name)
+                except (binascii.Error, ValueError):
+                    digest = None
+                if digest is None or digest not in self.blobs:
+                    os.unlink(os.path.join(subdir_path, name))
+                    removed += 1
+        if removed > 0:
+            logger.info('Removed %d orphaned capture blob(s)', removed)
+
+    def stats(self):
+        return {
+            'blobs': len(self.blobs),
+            'blob_bytes': self.bytes,
+            'dedup_hits': self.dedup_hits,
+            'dedup_bytes': self.dedup_bytes,
+        }
+
+
+class PendingMessage(object):
+    """The chunks of a message being put back together, and the times
+    they were captured at.
+    """
+
+    __slots__ = ('chunks', 'stamps', 'size', 'head_done', 'last_ts')
+
+    def __init__(self):
+        self.chunks = []
+        self.stamps = []
+        self.size = 0
+        self.head_done = False
+        self.last_ts = None
+
+    def add(self, data, ts):
+        self.chunks.append(data)
+        self.stamps.append(ts)
+        self.size += len(data)
+        self.last_ts = ts
+
+    def take(self):
+        """Returns (data, stamp_at), `stamp_at(pos)` being the capture
+        time of the chunk byte `pos` of `data` came in, and empties the
+        message.
+        """
+        offsets = []
+        pos = 0
+        for c in self.chunks:
+            offsets.append(pos)
+            pos += len(c)
+        stamps = self.stamps
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.stamps = []
+        self.size = 0
+        return (data,
+                lambda pos: stamps[bisect.bisect_right(offsets, pos) - 1])
+
+
+class CaptureStore(object):
+    """Capture records in size-rotated segment files under `path`.
+
+    One process (the recorder) opens the store for writing, and appends
+    to the last segment, rotating it at `segment_bytes`. The oldest
+    segments are deleted once the store takes more than `max_bytes`.
+    Other processes can open the store with `readonly=True`, and call
+    refresh() to pick up what was recorded since.
+
+    Payloads of at least `blob_min_bytes` go to a BlobStore under
+    `path`/blobs, so that the same payload captured over and over only
+    takes disk space once. 0 turns that off. The data of a flow arrives
+    in chunks cut wherever the proxy happened to read, so the writer
+    puts each message (the data going one way until the other end
+    speaks, or the flow ends) back together first, and stores an HTTP
+    head apart from the body that follows it. The message is written
+    when it's done, so readers don't see it until then, with the times
+    its pieces were captured at. At most `message_buffer_bytes` are
+    held for all the messages, the largest one being written early
+    when there's more.
+    """
+
+    def __init__(self, path, segment_bytes, max_bytes, readonly=False,
+                 blob_min_bytes=0, message_buffer_bytes=268435456):
+        if segment_bytes >= 2 ** 32:
+            raise ValueError('Segments must be smaller than 4GiB')
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        self.blob_min_bytes = blob_min_bytes
+        self.message_buffer_bytes = message_buffer_bytes
+        self.blobs = BlobStore(os.path.join(path, 'blobs'))
+        self.segments = []
+        self.file = None
+        self.removed = 0
+        # topic -> PendingMessage
+        self.messages = {}
+        self.buffered_bytes = 0
+        self.early_writes = 0
+
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+        self.refresh()
+        if not readonly:
+            for seg in self.segments:
+                self.blobs.add_refs(seg.blob_refs)
+            self.blobs.collect_orphans()
+            self.open_active()
+
+    def list_seqs(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        seqs = []
+        for name in names:
+            if name.endswith(_SEGMENT_SUFFIX):
+                try:
+                    seqs.append(int(name[:-len(_SEGMENT_SUFFIX)]))
+                except ValueError:
+                    pass
+        return sorted(seqs)
+
+    def refresh(self):
+        """Syncs the segment list with the directory, and indexes the
+        records appended since the last call.
+        """
+        known = {s.seq: s for s in self.segments}
+        seqs = self.list_seqs()
+        last_seq = seqs[-1] if seqs else None
+        prev_last = self.segments[-1].seq if self.segments else None
+
+        segments = []
+        for seq in seqs:
+            seg = known.pop(seq, None)
+            if seg is None:
+                seg = Segment(self.path, seq)
+                if seq == last_seq or not seg.load_index():
+                    seg.scan()
+                    if seq != last_seq and not self.readonly:
+                        seg.save_index()
+            elif seq == prev_last:
+                # It may have been written to (or completed) since
+                seg.scan()
+            segments.append(seg)
+
+        # Removed by the retention policy of the writer
+        for seg in known.values():
+            seg.unmap()
+        self.segments = segments
+
+    def open_active(self):
+        if self.segments:
+            seg = self.segments[-1]
+            with open(seg.path, 'r+b') as f:
+                # Drop an incomplete record left by a crash
+                f.truncate(seg.size)
+        else:
+            seg = Segment(self.path, 0)
+            self.segments.append(seg)
+        self.file = open(seg.path, 'ab')
+        self.enforce_retention()
+
+    def append(self, topic, data, kind=KIND_DATA, ts=None):
+        if ts is None:
+            ts = time.time()
+        if self.blob_min_bytes <= 0:
+            self.write(topic, data, kind, ts)
+            return
+
+        topic = bytes(topic)
+        src, sep, dst = topic.partition(b'-')
+        if sep:
+            # The other end speaking ends the message going this way
+            reverse = b''.join([dst, sep, src])
+            if reverse in self.messages:
+                self.write_message(reverse, done=True)
+        if kind == KIND_DATA and data:
+            msg = self.messages.get(topic)
+            if msg is None:
+                msg = self.messages[topic] = PendingMessage()
+            msg.add(data, ts)
+            self.buffered_bytes += len(data)
+            if msg.size >= BODY_PIECE_BYTES:
+                self.write_message(topic)
+            while self.buffered_bytes > self.message_buffer_bytes:
+                # The pieces of the largest message won't be cut at the
+                # usual offsets anymore, but that frees the most
+                largest = max(self.messages,
+                              key=lambda t: self.messages[t].size)
+                self.early_writes += 1
+                self.write_message(largest, force=True)
+        else:
+            if topic in self.messages:
+                self.write_message(topic, done=True)
+            self.write(topic, data, kind, ts)
+
+    def write_message(self, topic, done=False, force=False):
+        """Writes the pieces of the message buffered for `topic` that
+        are complete, or all that's buffered when `done` or `force`.
+        Only a `done` message is forgotten, the data coming after a
+        forced write still belongs to the same message.
+        """
+        msg = self.messages[topic]
+        self.buffered_bytes -= msg.size
+        data, stamp_at = msg.take()
+        pos = 0
+        if not msg.head_done:
+            msg.head_done = True
+            end = data.find(b'\r\n\r\n', 0, HEADER_SCAN_BYTES)
+            if end >= 0:
+                # The head has the Date and such, it never dedups
+                pos = end + 4
+                self.write(topic, data[:pos], KIND_DATA, stamp_at(0))
+
+        while len(data) - pos >= BODY_PIECE_BYTES \
+                or ((done or force) and pos < len(data)):
+            piece = data[pos:pos + BODY_PIECE_BYTES]
+            self.write(topic, piece, KIND_DATA, stamp_at(pos))
+            pos += len(piece)
+        if done:
+            del self.messages[topic]
+        elif pos < len(data):
+            msg.add(data[pos:], stamp_at(pos))
+            msg.last_ts = stamp_at(len(data) - 1)
+            self.buffered_bytes += msg.size
+
+    def write(self, topic, data, kind, ts):
+        digest = None
+        if kind == KIND_DATA and self.blob_min_bytes > 0 \
+                and len(data) >= self.blob_min_bytes:
+            # The blob is written first, so that a record never refers
+            # to a missing blob
+            digest = data = self.blobs.put(data)
+            kind = KIND_BLOB
+
+        size = _RECORD.size + len(topic) + len(data)
+        seg = self.segments[-1]
+        if seg.size > 0 and seg.size + size > self.segment_bytes:
+            self.rotate()
+            seg = self.segments[-1]
+
+        offset = seg.size
+        self.file.write(_RECORD.pack(ts, len(data), len(topic), kind))
+        self.file.write(topic)
+        self.file.write(data)
+        seg.add_entry(bytes(topic), offset, ts, size)
+        if digest is not None:
+            seg.blob_refs[digest] += 1
+
+    def flush(self):
+        if self.messages:
+            now = time.time()
+            for topic, msg in list(self.messages.items()):
+                if now - msg.last_ts >= MESSAGE_MAX_IDLE:
+                    self.write_message(topic, done=True)
+        if self.file is not None:
+            self.file.flush()
+
+    def rotate(self):
+        self.file.close()
+        seg = self.segments[-1]
+        seg.save_index()
+        seg.unmap()
+
+        new_seg = Segment(self.path, seg.seq + 1)
+        self.segments.append(new_seg)
+        self.file = open(new_seg.path, 'ab')
+        logger.debug('Rotated capture store to segment %d', new_seg.seq)
+
+        self.enforce_retention()
+
+    def enforce_retention(self):
+        # Leave room for the active segment to fill up
+        total = self.total_bytes() - self.segments[-1].size \
+            + self.segment_bytes
+        while total > self.max_bytes and len(self.segments) > 1:
+            seg = self.segments.pop(0)
+            blob_bytes = self.blobs.bytes
+            seg.remove()
+            self.blobs.release_refs(seg.blob_refs)
+            total -= seg.size + (blob_bytes - self.blobs.bytes)
+            self.removed += 1
+            logger.debug('Removed capture store segment %d', seg.seq)
+
+    def total_bytes(self):
+        return sum(s.size for s in self.segments) + self.blobs.bytes
+
+    def topics(self):
+        topics = set()
+        for seg in self.segments:
+            topics.update(seg.index)
+        return topics
+
+    def decode(self, topic, data, kind):
+        """Returns (data, notice) of a stored record."""
+        notice = None
+        if kind == KIND_NOTICE:
+            _topic, data, notice = parse_capture_message([topic, b'', data])
+        elif kind == KIND_BLOB:
+            data = self.blobs.get(data)
+        return (data, notice)
+
+    def read_flow(self, topic):
+        """Yields (timestamp, data, notice) of the stored messages of
+        `topic`, oldest first, `notice` being None or a dict.
+        """
+        self.flush()
+        for seg in self.segments:
+            offsets = seg.index.get(topic)
+            if not offsets:
+                continue
+            for offset in offsets:
+                ts, _topic, data, kind = seg.read(offset)
+                data, notice = self.decode(topic, data, kind)
+                yield (ts, data, notice)
+
+    def records(self):
+        """Yields (timestamp, topic, data, notice) of all the stored
+        messages, in the order they were recorded.
+        """
+        self.flush()
+        for seg in self.segments:
+            for ts, topic, data, kind in seg.records():
+                data, notice = self.decode(topic, data, kind)
+                yield (ts, topic, data, notice)
+
+    def oldest_ts(self):
+        for seg in self.segments:
+            if seg.first_ts is not None:
+                return seg.first_ts
+        return None
+
+    def stats(self):
+        stats = {
+            'segments': len(self.segments),
+            'bytes': self.total_bytes(),
+            'max_bytes': self.max_bytes,
+            'removed_segments': self.removed,
+            'open_messages': len(self.messages),
+            'buffered_bytes': self.buffered_bytes,
+            'early_writes': self.early_writes,
+        }
+        stats.update(self.blobs.stats())
+        return stats
+
+    def close(self):
+        if self.file is not None:
+            for topic in list(self.messages):
+                self.write_message(topic, done=True)
+            self.file.close()
+            self.file = None
+        for seg in self.segments:
+            seg.unmap()
+
+
+class Recorder(object):
+    """Appends everything the bridge publishes to a CaptureStore.
+
+    With a FlowIndex, the recorder also keeps it up to date, and
+    answers the queries coming in on `query_sock` (a REP socket). The
+    data of the indexed flows can also be pushed, with the flow ids,
+    to the search process through `feed_sock`, and is dropped when
+    that process can't keep up.
+    """
+
+    def __init__(self, store, index=None, flush_interval=1.0,
+                 stats_interval=60.0, feed_sock=None):
+        self.store = store
+        self.index = index
+        self.flush_interval = flush_interval
+        self.stats_interval = stats_interval
+        self.feed_sock = feed_sock
+        # Tells the search process when flow ids start over
+        self.epoch = int.from_bytes(os.urandom(4), 'big')
+        self.recorded = 0
+        self.feed_dropped = 0
+
+    def record(self, frames):
+        ts = time.time()
+        topic, data, notice = parse_capture_message(frames)
+        removed = self.store.removed
+        if notice is not None:
+            self.store.append(topic, frames[2], KIND_NOTICE, ts=ts)
+        else:
+            self.store.append(topic, data, ts=ts)
+        self.recorded += 1
+
+        if self.index is not None:
+            if self.store.removed != removed:
+                # Don't list flows whose data is gone
+                self.index.expire(self.store.oldest_ts())
+            flow_id = self.index.add(ts, topic, data, notice)
+            if self.feed_sock is not None and flow_id is not None \
+                    and notice is None:
+                self.feed(flow_id, topic, data)
+
+    def feed(self, flow_id, topic, data):
+        try:
+            self.feed_sock.send_multipart(
+                [FEED_HEADER.pack(self.epoch, flow_id), topic, data],
+                flags=zmq.NOBLOCK)
+        except zmq.ZMQError as e:
+            if e.errno != errno.EAGAIN:
+                raise e
+            self.feed_dropped += 1
+
+    def serve_queries(self, query_sock):
+        while True:
+            try:
+                request = query_sock.recv(flags=zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise e
+            query_sock.send(handle_query(self.index, request))
+
+    def run(self, sub_sock, query_sock=None):
+        poller = zmq.Poller()
+        poller.register(sub_sock, zmq.POLLIN)
+        if query_sock is not None:
+            poller.register(query_sock, zmq.POLLIN)
+
+        last_flush = last_stats = time.monotonic()
+        while True:
+            events = dict(poller.poll(self.flush_interval * 1000))
+            if sub_sock in events:
+                while True:
+                    try:
+                        frames = sub_sock.recv_multipart(flags=zmq.NOBLOCK)
+                    except zmq.ZMQError as e:
+                        if e.errno == errno.EAGAIN:
+                            break
+                        raise e
+                    self.record(frames)
+            if query_sock is not None and query_sock in events:
+                # Queries may read the store
+                self.store.flush()
+                self.serve_queries(query_sock)
+
+            now = time.monotonic()
+            if now - last_flush >= self.flush_interval:
+                last_flush = now
+                # So that readers in other processes see the records
+                self.store.flush()
+            if self.stats_interval > 0 \
+                    and now - last_stats >= self.stats_interval:
+                last_stats = now
+                stats = self.store.stats()
+                stats['recorded'] = self.recorded
+                if self.index is not None:
+                    stats['index'] = self.index.stats()
+                if self.feed_sock is not None:
+                    stats['search_feed_dropped'] = self.feed_dropped
+                logger.info('Recorder stats: %r', stats)
+
+
+def create_capture_store(config, readonly=False):
+    sconfig = config['store']
+    path = sconfig['path']
+    if config['misc']['config_file']:
+        path = get_abs_path(config, path)
+    else:
+        path = os.path.abspath(path)
+    return CaptureStore(path,
+                        sconfig.getint('segment_bytes'),
+                        sconfig.getint('max_bytes'),
+                        readonly=readonly,
+                        blob_min_bytes=sconfig.getint('dedup_min_bytes'),
+                        message_buffer_bytes=sconfig.getint(
+                            'dedup_buffer_bytes'))
+
+
+_store_reader = None
+
+
+def get_capture_store_reader(config):
+    """Returns this process' read-only view of the store, brought up to
+    date with what the recorder wrote.
+    """
+    global _store_reader
+    if _store_reader is None:
+        _store_reader = create_capture_store(config, readonly=True)
+    else:
+        _store_reader.refresh()
+    return _store_reader
+
+
+_store_executor = None
+
+
+def get_capture_store_executor():
+    """Returns the executor to read the store with, off the event loop.
+
+    It has a single thread, since the reader isn't thread-safe.
+    """
+    global _store_executor
+    if _store_executor is None:
+        _store_executor = concurrent.futures.ThreadPoolExecutor(1)
+    return _store_executor
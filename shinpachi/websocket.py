@@ -0,0 +1,274 @@
+import struct
+import zlib
+import aiohttp.websocket
+from aiohttp.websocket import (Message, WebSocketError,
+                               OPCODE_CONTINUATION, OPCODE_TEXT,
+                               OPCODE_BINARY, OPCODE_CLOSE, OPCODE_PING,
+                               OPCODE_PONG)
+
+
+__all__ = ['encode_frame', 'PerMessageDeflate', 'do_handshake']
+
+
+# What a sync-flushed deflate block ends with. It's left out of the
+# compressed messages (RFC 7692, section 7.2.1).
+DEFLATE_TAIL = b'\x00\x00\xff\xff'
+
+# Commands from the consoles are tiny, don't inflate more than this
+MAX_INFLATED_BYTES = 1048576
+
+
+def encode_frame(message, opcode=OPCODE_BINARY, rsv1=False):
+    """Returns a complete (unmasked, server-to-client) frame carrying
+    `message`, so that it can be written to any number of transports
+    without being encoded again.
+    """
+    if isinstance(message, str):
+        message = message.encode('utf8')
+    first_byte = 0x80 | opcode
+    if rsv1:
+        first_byte |= 0x40
+    msg_length = len(message)
+    if msg_length < 126:
+        header = struct.pack('!BB', first_byte, msg_length)
+    elif msg_length < (1 << 16):
+        header = struct.pack('!BBH', first_byte, 126, msg_length)
+    else:
+        header = struct.pack('!BBQ', first_byte, 127, msg_length)
+    return header + message
+
+
+def parse_extensions(header):
+    """Returns [(name, {param: value})] from a Sec-WebSocket-Extensions
+    header. Parameters without values map to None.
+    """
+    extensions = []
+    for offer in header.split(','):
+        parts = [p.strip() for p in offer.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for p in parts[1:]:
+            if not p:
+                continue
+            name, sep, value = p.partition('=')
+            params[name.strip().lower()] = \
+                value.strip().strip('"') if sep else None
+        extensions.append((parts[0].lower(), params))
+    return extensions
+
+
+class PerMessageDeflate(object):
+    """The permessage-deflate extension (RFC 7692), as negotiated with
+    one client.
+
+    Messages we send are compressed when they are at least `threshold`
+    bytes long. With `context_takeover`, the compressor keeps its
+    window between messages, which compresses the repetitive traffic
+    of a capture much better, at the cost of keeping the compressor's
+    memory around for the whole connection.
+    """
+
+    PARAMS = ('server_no_context_takeover', 'client_no_context_takeover',
+              'server_max_window_bits', 'client_max_window_bits')
+
+    def __init__(self, level=6, threshold=256, context_takeover=True,
+                 window_bits=15, client_context_takeover=True):
+        self.level = level
+        self.threshold = threshold
+        self.context_takeover = context_takeover
+        self.window_bits = window_bits
+        self.client_context_takeover = client_context_takeover
+        self.compressor = None
+        self.decompressor = None
+
+    @classmethod
+    def negotiate(cls, header, level=6, threshold=256,
+                  context_takeover=True):
+        """Returns (PerMessageDeflate, response header value) for the
+        first acceptable offer in `header`, or (None, None).
+        """
+        for name, params in parse_extensions(header):
+            if name != 'permessage-deflate':
+                continue
+            if any(p not in cls.PARAMS for p in params):
+                continue
+
+            response = ['permessage-deflate']
+            window_bits = 15
+            if 'server_max_window_bits' in params:
+                try:
+                    window_bits = int(params['server_max_window_bits'])
+                except (TypeError, ValueError):
+                    continue
+                # zlib can't do 8-bit windows for raw deflate streams
+                if not 9 <= window_bits <= 15:
+                    continue
+                response.append(
+                    'server_max_window_bits={}'.format(window_bits))
+            if 'server_no_context_takeover' in params:
+                context_takeover = False
+            if not context_takeover:
+                response.append('server_no_context_takeover')
+            client_context_takeover = \
+                'client_no_context_takeover' not in params
+            if not client_context_takeover:
+                response.append('client_no_context_takeover')
+
+            deflate = cls(level, threshold, context_takeover, window_bits,
+                          client_context_takeover)
+            return (deflate, '; '.join(response))
+        return (None, None)
+
+    def compress(self, payload):
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(
+                self.level, zlib.DEFLATED, -self.window_bits)
+        if self.context_takeover:
+            data = self.compressor.compress(payload) + \
+                self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            # A full flush forgets the window, so every message can be
+            # inflated on its own
+            data = self.compressor.compress(payload) + \
+                self.compressor.flush(zlib.Z_FULL_FLUSH)
+        if data.endswith(DEFLATE_TAIL):
+            data = data[:-len(DEFLATE_TAIL)]
+        return data
+
+    def decompress(self, payload):
+        if self.decompressor is None or self.decompressor.eof \
+                or not self.client_context_takeover:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        data = self.decompressor.decompress(payload + DEFLATE_TAIL,
+                                            MAX_INFLATED_BYTES)
+        if self.decompressor.unconsumed_tail:
+            raise WebSocketError('Inflated message too large')
+        return data
+
+    def encode_frame(self, message, opcode=OPCODE_BINARY):
+        if len(message) < self.threshold:
+            return encode_frame(message, opcode)
+        return encode_frame(self.compress(message), opcode, rsv1=True)
+
+
+def parse_frame(buf, rsv1_allowed):
+    """Returns the next frame, as (fin, rsv1, opcode, payload)."""
+    data = yield from buf.read(2)
+    first_byte, second_byte = struct.unpack('!BB', data)
+
+    fin = (first_byte >> 7) & 1
+    rsv1 = (first_byte >> 6) & 1
+    opcode = first_byte & 0xf
+
+    if (rsv1 and not rsv1_allowed) or first_byte & 0x30:
+        raise WebSocketError('Received frame with non-zero reserved bits')
+    if opcode > 0x7 and (fin == 0 or rsv1):
+        raise WebSocketError('Received bad control frame')
+
+    has_mask = (second_byte >> 7) & 1
+    length = second_byte & 0x7f
+    if opcode > 0x7 and length > 125:
+        raise WebSocketError(
+            'Control frame payload cannot be larger than 125 bytes')
+
+    if length == 126:
+        data = yield from buf.read(2)
+        length = struct.unpack_from('!H', data)[0]
+    elif length > 126:
+        data = yield from buf.read(8)
+        length = struct.unpack_from('!Q', data)[0]
+    if length > MAX_INFLATED_BYTES:
+        raise WebSocketError('Frame too large')
+
+    if has_mask:
+        mask = yield from buf.read(4)
+
+    if length:
+        payload = yield from buf.read(length)
+    else:
+        payload = b''
+
+    if has_mask and payload:
+        # XOR the whole payload at once, as a big integer
+        mask = (mask * (length // 4 + 1))[:length]
+        payload = (int.from_bytes(payload, 'big') ^
+                   int.from_bytes(mask, 'big')).to_bytes(length, 'big')
+
+    return fin, rsv1, opcode, payload
+
+
+def parse_message(buf, deflate):
+    fin, rsv1, opcode, payload = \
+        yield from parse_frame(buf, deflate is not None)
+
+    if opcode == OPCODE_CLOSE:
+        if len(payload) >= 2:
+            close_code = struct.unpack('!H', payload[:2])[0]
+            return Message(OPCODE_CLOSE, close_code, payload[2:])
+        elif payload:
+            raise WebSocketError('Invalid close frame')
+        return Message(OPCODE_CLOSE, '', '')
+    elif opcode == OPCODE_PING:
+        return Message(OPCODE_PING, '', '')
+    elif opcode == OPCODE_PONG:
+        return Message(OPCODE_PONG, '', '')
+    elif opcode not in (OPCODE_TEXT, OPCODE_BINARY):
+        raise WebSocketError('Unexpected opcode={!r}'.format(opcode))
+
+    # Only the first frame of a message says if it's compressed
+    compressed = rsv1
+    data = [payload]
+    size = len(payload)
+    while not fin:
+        fin, rsv1, _opcode, payload = yield from parse_frame(buf, False)
+        if _opcode != OPCODE_CONTINUATION:
+            raise WebSocketError(
+                'The opcode in non-fin frame is expected '
+                'to be zero, got {!r}'.format(_opcode))
+        size += len(payload)
+        if size > MAX_INFLATED_BYTES:
+            raise WebSocketError('Message too large')
+        data.append(payload)
+
+    data = b''.join(data)
+    if compressed:
+        data = deflate.decompress(data)
+    if opcode == OPCODE_TEXT:
+        return Message(OPCODE_TEXT, data.decode('utf-8'), '')
+    else:
+        return Message(OPCODE_BINARY, data, '')
+
+
+def make_parser(deflate):
+    def websocket_parser(out, buf):
+        while True:
+            message = yield from parse_message(buf, deflate)
+            out.feed_data(message)
+
+            if message.tp == OPCODE_CLOSE:
+                out.feed_eof()
+                break
+    return websocket_parser
+
+
+def do_handshake(method, headers, transport, deflate_options=None):
+    """Like aiohttp.websocket.do_handshake(), but also negotiates
+    permessage-deflate when `deflate_options` (keyword arguments for
+    PerMessageDeflate.negotiate()) are given.
+
+    Returns (status, response headers, parser, writer, deflate), where
+    `deflate` is a PerMessageDeflate, or None when not negotiated.
+    """
+    status, response_headers, parser, writer = \
+        aiohttp.websocket.do_handshake(method, headers, transport)[:4]
+
+    deflate = None
+    offer = headers.get('SEC-WEBSOCKET-EXTENSIONS')
+    if deflate_options is not None and offer:
+        deflate, response = \
+            PerMessageDeflate.negotiate(offer, **deflate_options)
+        if deflate is not None:
+            response_headers.append(('SEC-WEBSOCKET-EXTENSIONS', response))
+    return (status, response_headers, make_parser(deflate), writer,
+            deflate)
@@ -928,6 +928,132 @@
         return {'topic': topic, 'complete': complete};
     }
 
+    var handle_notice = function (notice) {
+        if (notice['notice'] === 'dropped') {
+            if (streams[notice['topic']] !== undefined) {
+                streams[notice['topic']]['lossy'] = true;
+            }
+            var desc = 'Capture data lost for ' + notice['topic'] + ': '
+                + notice['messages'] + ' message(s), '
+                + notice['bytes'] + ' byte(s) dropped';
+            if (notice['reason'] === 'slow-console') {
+                desc += ', the console could not keep up';
+            }
+            if (notice['head'] !== undefined && notice['head'] !== '') {
+                desc += ' (' + notice['head'] + ')';
+            }
+            log_event({
+                'class': 'local-msg',
+                'brief_desc': desc
+            });
+        } else if (notice['notice'] === 'truncated') {
+            if (streams[notice['topic']] !== undefined) {
+                streams[notice['topic']]['truncated'] = true;
+            }
+            log_event({
+                'class': 'local-msg',
+                'brief_desc': 'Capture truncated for ' + notice['topic'] + ': '
+                    + notice['captured_bytes'] + ' of '
+                    + notice['total_bytes'] + ' byte(s) captured'
+            });
+        }
+    };
+
+    var handle_capture_msg = function (msg) {
+        var parsed_msg = parse_msg(msg);
+
+        if (parsed_msg === null) {
+            // ignore illegal messages
+            console.log(msg);
+            return;
+        }
+
+        if (parsed_msg['complete']) {
+            var s = streams[parsed_msg['topic']];
+            var src_addr = enclose_addr(s['src_addr']);
+            var dst_addr = enclose_addr(s['dst_addr']);
+            var src_addr_port = src_addr + ':' + s['src_port'];
+            var dst_addr_port = dst_addr + ':' + s['dst_port'];
+
+            var subs_match = false;
+            for (var c in subscriptions) {
+                if (subscriptions[c].type === 'trigger') {
+                    if (src_addr === subscriptions[c].ep1
+                            || dst_addr === subscriptions[c].ep1
+                            || src_addr_port === subscriptions[c].ep1
+                            || dst_addr_port === subscriptions[c].ep1) {
+                        subs_match = true;
+                        break;
+                    }
+                } else {    // subscriptions[c].type === subscribe
+                    var cases_to_test = [
+                        [src_addr, dst_addr],
+                        [dst_addr, src_addr],
+                        [src_addr_port, dst_addr],
+                        [dst_addr, src_addr_port],
+                        [src_addr, dst_addr_port],
+                        [dst_addr_port, src_addr],
+                        [src_addr_port, dst_addr_port],
+                        [dst_addr_port, src_addr_port]
+                    ];
+                    for (var i = 0; i < cases_to_test.length; i ++) {
+                        if (cases_to_test[i][0] === subscriptions[c].ep1
+                                && cases_to_test[i][1] === subscriptions[c].ep2) {
+                            subs_match = true;
+                            break;
+                        }
+                    }
+                    if (subs_match === true) {
+                        break;
+                    }
+                }
+            }
+
+            if (subs_match) {
+                var ev_item;
+
+                if (s['type'] === 'http-req') {
+                    ev_item = log_event({
+                        'stream': s
+                    });
+                } else {
+                    if (s['type'] === 'http-rep') {
+                        ev_item = log_event({
+                            'stream': s
+                        });
+                    } else {
+                        var raw_msg = msg.slice(s.topic.length);
+                        ev_item = log_event({
+                            'stream': s,
+                            'raw_data': new Blob([binary_string_to_arraybuffer(raw_msg)])
+                        });
+                    }
+                }
+
+                append_to_flow(s, ev_item);
+
+                delete streams[parsed_msg['topic']];
+            }
+        }
+    };
+
+    var split_batch = function (batch) {
+        // Binary frames carry one or more messages, each prefixed with
+        // its length as a big-endian uint32
+        var msgs = [];
+        var pos = 0;
+        while (pos + 4 <= batch.length) {
+            var len = ((batch.charCodeAt(pos) << 24)
+                | (batch.charCodeAt(pos + 1) << 16)
+                | (batch.charCodeAt(pos + 2) << 8)
+                | batch.charCodeAt(pos + 3)) >>> 0;
+            pos += 4;
+            msgs.push(batch.slice(pos, pos + len));
+            pos += len;
+        }
+        return msgs;
+    };
+
     var init_ws_conn = function (conn) {
         conn.onopen = function() {
             log_event({
@@ -957,83 +1083,17 @@
         };
 
         conn.onmessage = function(e) {
+            if (typeof e.data === 'string') {
+                // Text frames are notices from the server
+                handle_notice(JSON.parse(e.data));
+                return;
+            }
+
             var rd = new FileReader();
             rd.addEventListener('loadend', function() {
-                var msg = rd.result;
-                var parsed_msg = parse_msg(msg);
-
-                if (parsed_msg === null) {
-                    // ignore illegal messages
-                    console.log(msg);
-                    return;
-                }
-
-                if (parsed_msg['complete']) {
-                    var s = streams[parsed_msg['topic']];
-                    var src_addr = enclose_addr(s['src_addr']);
-                    var dst_addr = enclose_addr(s['dst_addr']);
-                    var src_addr_port = src_addr + ':' + s['src_port'];
-                    var dst_addr_port = dst_addr + ':' + s['dst_port'];
-
-                    var subs_match = false;
-                    for (var c in subscriptions) {
-                        if (subscriptions[c].type === 'trigger') {
-                            if (src_addr === subscriptions[c].ep1
-                                    || dst_addr === subscriptions[c].ep1
-                                    || src_addr_port === subscriptions[c].ep1
-                                    || dst_addr_port === subscriptions[c].ep1) {
-                                subs_match = true;
-                                break;
-                            }
-                        } else {    // subscriptions[c].type === subscribe
-                            var cases_to_test = [
-                                [src_addr, dst_addr],
-                                [dst_addr, src_addr],
-                                [src_addr_port, dst_addr],
-                                [dst_addr, src_addr_port],
-                                [src_addr, dst_addr_port],
-                                [dst_addr_port, src_addr],
-                                [src_addr_port, dst_addr_port],
-                                [dst_addr_port, src_addr_port]
-                            ];
-                            for (var i = 0; i < cases_to_test.length; i ++) {
-                                if (cases_to_test[i][0] === subscriptions[c].ep1
-                                        && cases_to_test[i][1] === subscriptions[c].ep2) {
-                                    subs_match = true;
-                                    break;
-                                }
-                            }
-                            if (subs_match === true) {
-                                break;
-                            }
-                        }
-                    }
-
-                    if (subs_match) {
-                        var ev_item;
-
-                        if (s['type'] === 'http-req') {
-                            ev_item = log_event({
-                                'stream': s
-                            });
-                        } else {
-                            if (s['type'] === 'http-rep') {
-                                ev_item = log_event({
-                                    'stream': s
-                                });
-                            } else {
-                                var raw_msg = msg.slice(s.topic.length);
-                                ev_item = log_event({
-                                    'stream': s,
-                                    'raw_data': new Blob([binary_string_to_arraybuffer(raw_msg)])
-                                });
-                            }
-                        }
-
-                        append_to_flow(s, ev_item);
-
-                        delete streams[parsed_msg['topic']];
-                    }
+                var msgs = split_batch(rd.result);
+                for (var i = 0; i < msgs.length; i++) {
+                    handle_capture_msg(msgs[i]);
                 }
             });
             rd.readAsBinaryString(e.data);